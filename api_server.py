@@ -0,0 +1,386 @@
+"""Local HTTP API for the audio processor.
+
+    python api_server.py --host 127.0.0.1 --port 8502
+
+A small asyncio HTTP/1.1 server (standard library only) in front of the
+same ``JobManager`` the Streamlit app uses. The event loop only parses
+requests and moves bytes; renders and downloads run in the job manager's
+process pool, and file reads and writes go to a thread.
+
+Endpoints (JSON unless noted):
+
+    GET    /health                    liveness and job counts
+    GET    /metrics                   per-operation metrics (Prometheus text format)
+    POST   /jobs?tempo=&bass=&quality=&format=&filename=
+                                      body: audio file; queues one render
+    POST   /batch?preset=0.75:10&preset=1.25:0:High&format=&filename=
+                                      body: audio file; one render per preset
+    POST   /downloads                 body: {"url": ...}; queues a download
+    GET    /jobs/<id>                 job status
+    GET    /jobs/<id>/result          streams the output file (wav, flac or ogg)
+    DELETE /jobs/<id>                 cancels a running job or forgets a finished one
+
+``format`` is one of ``wav16`` (default), ``wav24``, ``flac`` or ``ogg``.
+Job status includes ``estimated_seconds`` and ``eta_seconds`` from the
+host's cost model (see ``estimator.py``). Submissions get ``503`` with
+``Retry-After`` when the pool is full or, with ``--max-backlog``, when the
+estimated work queued per worker is longer than that.
+
+``/metrics`` covers the operations of every worker process (see
+``metrics.py``); ``--metrics-log`` also writes each one as a JSON line.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import metrics
+from audio_processor import OUTPUT_FORMATS, QUALITIES
+from batch import parse_preset
+from jobs import FINISHED_STATES, JobManager, JobQueueFull
+from utils import content_digest, is_supported_format
+
+# Largest accepted request body
+MAX_BODY_BYTES = 512 * 1024**2
+
+# Chunk size for streaming result files
+STREAM_CHUNK_BYTES = 256 * 1024
+
+# Finished jobs and their files are dropped this long after they finish
+RESULT_TTL_SECONDS = 3600
+
+# Content type of result files by extension
+CONTENT_TYPES = {extension: mime for _, _, _, extension, mime in OUTPUT_FORMATS.values()}
+
+REASONS = {
+    200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+class HTTPError(Exception):
+    """Error turned into a JSON error response"""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class Request:
+    """Parsed HTTP request"""
+
+    def __init__(self, method, target, headers, body):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path.rstrip('/') or '/'
+        self.query = parse_qs(parts.query)
+        self.headers = headers
+        self.body = body
+
+    def param(self, name, default=None):
+        values = self.query.get(name)
+        return values[0] if values else default
+
+    def json(self):
+        try:
+            return json.loads(self.body or b'{}')
+        except ValueError:
+            raise HTTPError(400, "Body is not valid JSON")
+
+
+async def read_request(reader):
+    """Read one request from the connection, or None when the client closed it"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'chunked' in headers.get('transfer-encoding', ''):
+        raise HTTPError(400, "Chunked request bodies are not supported; send Content-Length")
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HTTPError(400, "Invalid Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, f"Request body larger than {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return Request(method.upper(), target, headers, body)
+
+
+def write_head(writer, status, headers):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+
+def write_json(writer, status, payload, headers=None):
+    body = json.dumps(payload).encode()
+    write_head(writer, status, {
+        'Content-Type': 'application/json',
+        'Content-Length': str(len(body)),
+        **(headers or {}),
+    })
+    writer.write(body)
+
+
+class APIServer:
+    """Routes HTTP requests to a JobManager"""
+
+    def __init__(self, job_manager):
+        self.job_manager = job_manager
+        self.started = time.time()
+        self.requests = 0
+
+    async def handle_connection(self, reader, writer):
+        """Serve requests on one keep-alive connection"""
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as e:
+                    write_json(writer, e.status, {'error': str(e)}, {'Connection': 'close'})
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                self.requests += 1
+                await self.dispatch(request, writer)
+                await writer.drain()
+                if request.headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request, writer):
+        parts = [part for part in request.path.split('/') if part]
+        try:
+            if parts == ['health'] and request.method == 'GET':
+                return write_json(writer, 200, self.health())
+            if parts == ['metrics'] and request.method == 'GET':
+                return self.write_metrics(writer)
+            if parts == ['jobs'] and request.method == 'POST':
+                return write_json(writer, 202, await self.submit_render(request))
+            if parts == ['batch'] and request.method == 'POST':
+                return write_json(writer, 202, await self.submit_batch(request))
+            if parts == ['downloads'] and request.method == 'POST':
+                return write_json(writer, 202, await self.submit_download(request))
+            if len(parts) == 2 and parts[0] == 'jobs':
+                if request.method == 'GET':
+                    return write_json(writer, 200, self.job_status(parts[1]))
+                if request.method == 'DELETE':
+                    return write_json(writer, 200, await self.delete_job(parts[1]))
+                raise HTTPError(405, f"{request.method} not allowed on /jobs/<id>")
+            if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result' and request.method == 'GET':
+                return await self.stream_result(parts[1], writer)
+            raise HTTPError(404, f"No route for {request.method} {request.path}")
+        except HTTPError as e:
+            write_json(writer, e.status, {'error': str(e)}, e.headers)
+        except JobQueueFull as e:
+            write_json(writer, 503, {'error': str(e)}, {'Retry-After': '1'})
+        except Exception as e:
+            write_json(writer, 500, {'error': f"Failed to handle request: {str(e)}"})
+
+    def health(self):
+        return {
+            'status': 'ok',
+            'uptime_s': time.time() - self.started,
+            'requests': self.requests,
+            'max_pending': self.job_manager.max_pending,
+            'backlog_s': self.job_manager.backlog_seconds(),
+            **self.job_manager.counts(),
+        }
+
+    def write_metrics(self, writer):
+        body = metrics.render_prometheus().encode()
+        write_head(writer, 200, {
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+            'Content-Length': str(len(body)),
+        })
+        writer.write(body)
+
+    async def expire_results(self, interval=60):
+        """Periodically drop finished jobs that nobody deleted"""
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.job_manager.forget_finished, RESULT_TTL_SECONDS)
+
+    def _render_settings(self, request):
+        try:
+            tempo_factor = float(request.param('tempo', 1.0))
+            bass_boost = float(request.param('bass', 0))
+        except ValueError:
+            raise HTTPError(400, "tempo and bass must be numbers")
+        quality = request.param('quality', "Standard")
+        if quality not in QUALITIES:
+            raise HTTPError(400, f"quality must be one of {', '.join(QUALITIES)}")
+        return {'tempo_factor': tempo_factor, 'bass_boost': bass_boost, 'quality': quality}
+
+    def _output_format(self, request):
+        output_format = request.param('format', 'wav16')
+        if output_format not in OUTPUT_FORMATS:
+            raise HTTPError(400, f"format must be one of {', '.join(OUTPUT_FORMATS)}")
+        return output_format
+
+    def _upload(self, request):
+        """(bytes, suffix, digest) of the uploaded audio file"""
+        if not request.body:
+            raise HTTPError(400, "Request body must contain an audio file")
+        filename = request.param('filename', 'upload.wav')
+        if not is_supported_format(filename):
+            raise HTTPError(400, f"Unsupported format: {filename}")
+        return request.body, os.path.splitext(filename)[1].lower(), content_digest(request.body)
+
+    async def submit_render(self, request):
+        settings = self._render_settings(request)
+        output_format = self._output_format(request)
+        input_bytes, suffix, input_digest = self._upload(request)
+        job_id = await asyncio.to_thread(
+            self.job_manager.submit_render, input_bytes, suffix, input_digest,
+            settings['tempo_factor'], settings['bass_boost'], settings['quality'], output_format
+        )
+        return {'job_id': job_id, 'format': output_format, **settings}
+
+    async def submit_batch(self, request):
+        try:
+            presets = [parse_preset(text) for text in request.query.get('preset', [])]
+        except Exception as e:
+            raise HTTPError(400, str(e))
+        if not presets:
+            raise HTTPError(400, "At least one preset=tempo:bass[:quality] is required")
+        output_format = self._output_format(request)
+        input_bytes, suffix, input_digest = self._upload(request)
+
+        # All or nothing: if the pool fills up part way, cancel what was queued
+        job_ids = []
+        try:
+            for preset in presets:
+                job_ids.append(await asyncio.to_thread(
+                    self.job_manager.submit_render, input_bytes, suffix, input_digest,
+                    preset['tempo_factor'], preset['bass_boost'], preset['quality'], output_format
+                ))
+        except JobQueueFull:
+            for job_id in job_ids:
+                self.job_manager.cancel(job_id)
+            raise
+        return {'jobs': [{'job_id': job_id, 'format': output_format, **preset}
+                         for job_id, preset in zip(job_ids, presets)]}
+
+    async def submit_download(self, request):
+        url = request.json().get('url')
+        if not url:
+            raise HTTPError(400, "Body must be JSON with a 'url'")
+        job_id = await asyncio.to_thread(self.job_manager.submit_download, url)
+        return {'job_id': job_id, 'url': url}
+
+    def job_status(self, job_id):
+        status = self.job_manager.status(job_id)
+        if status is None:
+            raise HTTPError(404, f"Unknown job {job_id}")
+        # The result path is internal; clients fetch /jobs/<id>/result
+        status['result'] = f"/jobs/{job_id}/result" if status['result'] else None
+        return status
+
+    async def delete_job(self, job_id):
+        status = self.job_status(job_id)
+        if status['state'] in FINISHED_STATES:
+            await asyncio.to_thread(self.job_manager.forget, job_id)
+            return {'job_id': job_id, 'deleted': True}
+        self.job_manager.cancel(job_id)
+        return {'job_id': job_id, 'cancelling': True}
+
+    async def stream_result(self, job_id, writer):
+        status = self.job_manager.status(job_id)
+        if status is None:
+            raise HTTPError(404, f"Unknown job {job_id}")
+        if status['state'] not in FINISHED_STATES or not status['result']:
+            raise HTTPError(409, f"Job {job_id} is {status['state']}, no result to fetch")
+
+        path = status['result']
+        content_type = CONTENT_TYPES.get(os.path.splitext(path)[1], 'application/octet-stream')
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            write_head(writer, 200, {
+                'Content-Type': content_type,
+                'Content-Length': str(size),
+                'Content-Disposition': f'attachment; filename="{os.path.basename(path)}"',
+            })
+            while True:
+                chunk = await asyncio.to_thread(f.read, STREAM_CHUNK_BYTES)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+
+
+async def serve(host, port, job_manager):
+    api = APIServer(job_manager)
+    server = await asyncio.start_server(api.handle_connection, host, port)
+    expiry = asyncio.create_task(api.expire_results())
+
+    # Stop cleanly on Ctrl-C or SIGTERM so the worker pool is shut down too
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            # Not available on Windows event loops
+            pass
+
+    print(f"Serving on http://{host}:{port}", flush=True)
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        expiry.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the audio processor over HTTP")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to bind")
+    parser.add_argument('--port', type=int, default=8502, help="Port to listen on")
+    parser.add_argument('--workers', type=int, default=None, help="Render worker processes (default: CPU count)")
+    parser.add_argument('--max-pending', type=int, default=None, help="Unfinished jobs before submissions get 503")
+    parser.add_argument('--max-backlog', type=float, default=None,
+                        help="Estimated render seconds queued per worker before submissions get 503")
+    parser.add_argument('--metrics-log', default=None, metavar='PATH',
+                        help="Append every operation's metrics as a JSON line to PATH ('-' for stderr)")
+    parser.add_argument('--memory-sample-every', type=int, default=metrics.MEMORY_SAMPLE_EVERY, metavar='N',
+                        help="Trace allocations of one operation in N (0 to turn off)")
+    args = parser.parse_args()
+
+    if args.metrics_log:
+        metrics.configure_log(args.metrics_log)
+    metrics.set_memory_sampling(args.memory_sample_every)
+
+    job_manager = JobManager(max_workers=args.workers, max_pending=args.max_pending,
+                             max_backlog_seconds=args.max_backlog)
+    try:
+        asyncio.run(serve(args.host, args.port, job_manager))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        job_manager.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,23 @@ import os
 import tempfile
 import io
 from pathlib import Path
-from audio_processor import AudioProcessor
+from audio_processor import AudioProcessor, OUTPUT_FORMATS, QUALITIES
 from video_downloader import VideoDownloader
-from utils import get_file_size, format_duration, is_supported_format
+from render_cache import RenderCache, DecodeCache
+from jobs import JobManager, JobQueueFull, DONE, FAILED, FINISHED_STATES
+from preview import PreviewRenderer
+from waveform import cached_peak_pyramid
+import startup
+from utils import get_file_size, format_duration, is_supported_format, content_digest, file_digest
+
+# Disk budget for cached renders shared by all sessions on this host
+RENDER_CACHE_MAX_BYTES = 2 * 1024**3
+
+# Disk budget for decoded PCM shared by all sessions and processes on this host
+DECODE_CACHE_MAX_BYTES = 8 * 1024**3
+
+# How often a running job's progress is refreshed, in seconds
+JOB_POLL_SECONDS = 0.5
 
 # Configure page
 st.set_page_config(
@@ -15,19 +29,87 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+@st.cache_resource
+def get_render_cache():
+    """Render cache shared by every session in this server process"""
+    return RenderCache(max_bytes=RENDER_CACHE_MAX_BYTES)
+
+@st.cache_resource
+def get_decode_cache():
+    """Decoded-audio cache shared by every session in this server process"""
+    return DecodeCache(max_bytes=DECODE_CACHE_MAX_BYTES)
+
+@st.cache_resource
+def start_warm_up():
+    """Warm up this server process's DSP chain (previews run here) in the background, once"""
+    return startup.start_warm_up()
+
+def get_engine_speeds():
+    """Throughput of each quality option on this host in x realtime, from its cost model"""
+    # The model is refined by every finished render; no benchmark run on the first page load
+    cost_model = get_job_manager().cost_model
+    return {quality: cost_model.realtime_factor('tempo', quality) for quality in QUALITIES}
+
+@st.cache_resource
+def get_job_manager():
+    """Worker pool that runs renders and downloads for every session"""
+    return JobManager()
+
+class AudioFile:
+    """A downloaded track on disk, in its native container, standing in for an uploaded file"""
+    
+    def __init__(self, path, name, job_id=None):
+        self.path = path
+        self.name = name
+        # Download job that owns the file, kept until the track is replaced
+        self.job_id = job_id
+        self._digest = None
+    
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = file_digest(self.path)
+        return self._digest
+    
+    def getvalue(self):
+        return Path(self.path).read_bytes()
+    
+    def read(self):
+        return self.getvalue()
+
+def set_original_audio(audio_file):
+    """Make audio_file the track to process, releasing the download job behind the previous one"""
+    previous = st.session_state.original_audio
+    if isinstance(previous, AudioFile) and previous is not audio_file and previous.job_id is not None:
+        get_job_manager().forget(previous.job_id)
+    st.session_state.original_audio = audio_file
+
 # Initialize session state
 if 'processed_audio' not in st.session_state:
     st.session_state.processed_audio = None
 if 'original_audio' not in st.session_state:
     st.session_state.original_audio = None
 if 'processor' not in st.session_state:
-    st.session_state.processor = AudioProcessor()
+    st.session_state.processor = AudioProcessor(decode_cache=get_decode_cache())
 if 'downloader' not in st.session_state:
     st.session_state.downloader = VideoDownloader()
 if 'video_info' not in st.session_state:
     st.session_state.video_info = None
+if 'render_job' not in st.session_state:
+    st.session_state.render_job = None
+if 'render_error' not in st.session_state:
+    st.session_state.render_error = None
+if 'download_job' not in st.session_state:
+    st.session_state.download_job = None
+if 'download_title' not in st.session_state:
+    st.session_state.download_title = None
+if 'download_error' not in st.session_state:
+    st.session_state.download_error = None
+if 'preview_renderer' not in st.session_state:
+    st.session_state.preview_renderer = None
 
 def main():
+    start_warm_up()
     st.title("🎵 AI Audio Processor")
     st.markdown("**Create slowed, sped-up, and bass-boosted versions of your favorite songs!**")
     
@@ -158,10 +240,18 @@ def main():
         
         # Processing quality
         st.subheader("Quality Settings")
+        engine_speeds = get_engine_speeds()
         quality = st.selectbox(
             "Processing Quality",
-            ["Standard", "High"],
-            help="Higher quality takes longer but produces better results"
+            QUALITIES,
+            format_func=lambda option: f"{option} (~{engine_speeds[option]:.0f}x realtime)",
+            help="Higher quality takes longer but produces better results • Fast stretches the waveform directly, good for speech and drums • Vinyl changes speed and pitch together, like a record played faster (nightcore), and is the quickest • Speeds are measured on this server"
+        )
+        output_format = st.selectbox(
+            "Output Format",
+            list(OUTPUT_FORMATS),
+            format_func=lambda option: OUTPUT_FORMATS[option][0],
+            help="OGG is about a tenth the size of WAV and quickest to download • FLAC and WAV are lossless"
         )
     
     # Main content area
@@ -187,7 +277,7 @@ def main():
                 st.success(f"✅ File uploaded: **{uploaded_file.name}** ({file_size})")
                 
                 # Store original audio in session state
-                st.session_state.original_audio = uploaded_file
+                set_original_audio(uploaded_file)
                 st.session_state.video_info = None  # Clear video info
                 
                 # Play original audio
@@ -227,8 +317,15 @@ def main():
                         st.write(f"**Uploader:** {info['uploader']}")
                         
                         # Download audio button
-                        if st.button("⬇️ Download Audio", type="primary"):
+                        if st.button("⬇️ Download Audio", type="primary", disabled=st.session_state.download_job is not None):
                             download_audio_from_url(video_url, info['title'])
+                    
+                    # Progress of a running download
+                    if st.session_state.download_job is not None:
+                        download_job_status()
+                    if st.session_state.download_error:
+                        st.error(f"❌ Error downloading audio: {st.session_state.download_error}")
+                        st.error("Please check the URL and try again.")
                 else:
                     st.warning("⚠️ Please enter a valid video URL")
             
@@ -247,25 +344,47 @@ def main():
         st.header("⚡ Process Audio")
         
         if st.session_state.original_audio is not None:
+            # Live preview of a short window; the full render happens on export
+            with st.expander("🎧 Live Preview", expanded=True):
+                preview_audio(st.session_state.original_audio, tempo_factor, bass_boost, quality)
+            
             # Process button
-            if st.button("🚀 Process Audio", type="primary", use_container_width=True):
-                process_audio(st.session_state.original_audio, tempo_factor, bass_boost, quality)
+            if st.button("🚀 Process Audio", type="primary", use_container_width=True, disabled=st.session_state.render_job is not None, help="Full-quality render of the whole track for download"):
+                process_audio(st.session_state.original_audio, tempo_factor, bass_boost, quality, output_format)
+            if st.session_state.render_job is None:
+                show_render_estimate(st.session_state.original_audio, tempo_factor, bass_boost, quality, output_format)
+            
+            # Progress of a running render
+            if st.session_state.render_job is not None:
+                render_job_status()
+            if st.session_state.render_error:
+                st.error(f"❌ Error processing audio: {st.session_state.render_error}")
+                st.error("Please try with a different file or adjust the settings.")
             
             # Show processed audio if available
             if st.session_state.processed_audio is not None:
+                processed = st.session_state.processed_audio
+                _, _, _, extension, mime = OUTPUT_FORMATS[processed['output_format']]
                 st.subheader("🎧 Processed Audio")
-                st.audio(st.session_state.processed_audio, format='audio/wav')
+                st.audio(processed['path'], format=mime)
+                
+                cache_stats = get_render_cache().stats()
+                st.caption(f"Render cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+                if processed['job_id'] is not None:
+                    show_render_breakdown(processed['job_id'])
                 
                 # Download button
                 original_name = st.session_state.original_audio.name if hasattr(st.session_state.original_audio, 'name') else "audio"
                 file_name_base = original_name.rsplit('.', 1)[0] if '.' in original_name else original_name
-                st.download_button(
-                    label="💾 Download Processed Audio",
-                    data=st.session_state.processed_audio,
-                    file_name=f"processed_{file_name_base}.wav",
-                    mime="audio/wav",
-                    use_container_width=True
-                )
+                # Served from the rendered file's handle, which Streamlit 1.49 accepts as data
+                with open(processed['path'], 'rb') as processed_file:
+                    st.download_button(
+                        label="💾 Download Processed Audio",
+                        data=processed_file,
+                        file_name=f"processed_{file_name_base}{extension}",
+                        mime=mime,
+                        use_container_width=True
+                    )
         else:
             st.info("👆 Please upload an audio file or download from a video URL first")
     
@@ -292,128 +411,226 @@ def main():
         **⚙️ Quality Settings:**
         - **Standard**: Faster processing, good quality (recommended)
         - **High**: Slower processing, maximum quality (for special tracks)
+        - **Fast**: Time-domain stretch (WSOLA), about 4x quicker than Standard; crisp on speech and drums, can sound rougher on dense music
+        - **Vinyl**: Speed and pitch change together, like a sped-up record (nightcore); the fastest option
         """)
 
-def process_audio(uploaded_file, tempo_factor, bass_boost, quality):
-    """Process the uploaded audio file with specified settings"""
-    try:
-        # Show processing status
-        with st.spinner("🔄 Processing audio... This may take a moment."):
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            # Save uploaded file temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                input_path = tmp_file.name
-            
-            status_text.text("Loading audio file...")
-            progress_bar.progress(20)
-            
-            # Load audio
-            audio_data, sample_rate = st.session_state.processor.load_audio(input_path)
-            
-            status_text.text("Applying tempo changes...")
-            progress_bar.progress(40)
-            
-            # Apply tempo change
-            if tempo_factor != 1.0:
-                audio_data = st.session_state.processor.change_tempo(audio_data, tempo_factor, quality)
-            
-            status_text.text("Boosting bass frequencies...")
-            progress_bar.progress(70)
-            
-            # Apply bass boost
-            if bass_boost > 0:
-                audio_data = st.session_state.processor.boost_bass(audio_data, sample_rate, bass_boost)
-            
-            status_text.text("Saving processed audio...")
-            progress_bar.progress(90)
-            
-            # Convert to bytes for download
-            output_buffer = io.BytesIO()
-            st.session_state.processor.save_audio(audio_data, sample_rate, output_buffer)
-            processed_audio_bytes = output_buffer.getvalue()
-            
-            # Store in session state
-            st.session_state.processed_audio = processed_audio_bytes
-            
-            progress_bar.progress(100)
-            status_text.text("✅ Processing complete!")
-            
-            # Clean up temporary file
+def get_preview_renderer(audio_file):
+    """Preview renderer and waveform peak pyramid for the current track, decoded once per track"""
+    # Uploads carry a file_id; downloaded tracks stay the same object in session state
+    source_id = getattr(audio_file, 'file_id', None) or id(audio_file)
+    cached = st.session_state.preview_renderer
+    if cached is not None and cached[0] == source_id:
+        return cached[1], cached[2]
+    
+    if isinstance(audio_file, AudioFile):
+        # Downloads are decoded straight from their file
+        digest = audio_file.digest
+        audio_data, sample_rate = st.session_state.processor.load_audio(audio_file.path, digest=digest)
+    else:
+        input_bytes = audio_file.getvalue()
+        digest = content_digest(input_bytes)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{audio_file.name.split('.')[-1]}") as tmp_file:
+            tmp_file.write(input_bytes)
+            input_path = tmp_file.name
+        try:
+            audio_data, sample_rate = st.session_state.processor.load_audio(input_path, digest=digest)
+        finally:
             os.unlink(input_path)
-            
-            st.success("🎉 Audio processed successfully!")
+    
+    renderer = PreviewRenderer(st.session_state.processor, audio_data, sample_rate)
+    peaks = cached_peak_pyramid(st.session_state.processor.decode_cache, digest, audio_data, sample_rate)
+    st.session_state.preview_renderer = (source_id, renderer, peaks)
+    return renderer, peaks
+
+def show_waveform(peaks, start_seconds, end_seconds, points=600):
+    """Min/max envelope of the original track between two times, from its peak pyramid"""
+    envelope = peaks.view(start_seconds, end_seconds, points)
+    chart = {
+        'seconds': envelope['time'],
+        'max': envelope['max'].max(axis=0),
+        'min': envelope['min'].min(axis=0),
+    }
+    st.area_chart(chart, x='seconds', y=['max', 'min'], height=120, color=['#1f77b4', '#1f77b4'])
+
+def preview_audio(audio_file, tempo_factor, bass_boost, quality):
+    """Render and play a short window of the track with the current settings"""
+    if not st.toggle("Preview while adjusting", value=True, help="Re-render a short window whenever a setting changes"):
+        return
+    try:
+        renderer, peaks = get_preview_renderer(audio_file)
+        
+        col_seek, col_length = st.columns([3, 1])
+        with col_seek:
+            start_seconds = st.slider(
+                "Preview from",
+                min_value=0,
+                max_value=max(int(renderer.duration) - 1, 1),
+                value=0,
+                step=1,
+                help="Seek point in the original track, in seconds"
+            )
+        with col_length:
+            window_seconds = st.select_slider("Length", options=[10, 15, 20], value=15, format_func=lambda s: f"{s}s")
+        fast = st.checkbox("⚡ Fast preview", help="Preview at a lower sample rate for quicker updates")
+        # Input span the preview window covers
+        show_waveform(peaks, start_seconds, start_seconds + window_seconds * tempo_factor)
+        
+        preview = renderer.render(start_seconds, window_seconds, tempo_factor, bass_boost, quality, proxy=fast)
+        st.audio(preview, format='audio/wav')
+        st.caption(f"Preview rendered in {renderer.last_render_seconds * 1000:.0f} ms • {format_duration(start_seconds)} onwards")
+        
+    except Exception as e:
+        st.error(f"❌ Error rendering preview: {str(e)}")
+
+def set_processed_audio(path, output_format, job_id=None):
+    """Show a rendered file, releasing the job that produced the previous one"""
+    previous = st.session_state.processed_audio
+    if previous is not None and previous['job_id'] is not None:
+        get_job_manager().forget(previous['job_id'])
+    st.session_state.processed_audio = {'path': path, 'output_format': output_format, 'job_id': job_id}
+
+def show_render_estimate(audio_file, tempo_factor, bass_boost, quality, output_format):
+    """Caption with the render time this host's cost model expects, plus any wait for a worker"""
+    try:
+        job_manager = get_job_manager()
+        if isinstance(audio_file, AudioFile):
+            seconds = job_manager.estimate_render(audio_file.path, audio_file.digest, tempo_factor, bass_boost,
+                                                  quality, output_format)
+        else:
+            input_bytes = audio_file.getvalue()
+            seconds = job_manager.estimate_render(
+                io.BytesIO(input_bytes), content_digest(input_bytes), tempo_factor, bass_boost, quality, output_format,
+                size_bytes=len(input_bytes)
+            )
+        caption = f"⏱️ Estimated render time: about {format_duration(max(seconds, 1))}"
+        wait = job_manager.backlog_seconds()
+        if wait >= 1:
+            caption += f" • about {format_duration(wait)} of other renders queued"
+        st.caption(caption)
+    except Exception:
+        # Only a hint; never block processing on it
+        pass
+
+def show_render_breakdown(job_id):
+    """Caption with the time each top-level operation of a finished render took"""
+    status = get_job_manager().status(job_id)
+    if status is None:
+        return
+    operations = [operation for operation in status['operations'] if operation['parent'] is None]
+    if operations:
+        st.caption("⏱️ " + " • ".join(f"{operation['operation']} {operation['wall_seconds']:.2f}s"
+                                      for operation in operations))
+
+def process_audio(uploaded_file, tempo_factor, bass_boost, quality, output_format):
+    """Queue the uploaded audio file for processing with specified settings"""
+    try:
+        st.session_state.render_error = None
+        
+        # Same file and settings as an earlier render: reuse its output
+        render_cache = get_render_cache()
+        if isinstance(uploaded_file, AudioFile):
+            input_digest = uploaded_file.digest
+        else:
+            input_bytes = uploaded_file.getvalue()
+            input_digest = content_digest(input_bytes)
+        cache_key = render_cache.make_key(input_digest, tempo_factor, bass_boost, quality, output_format)
+        cached_path = render_cache.get_path(cache_key, output_format)
+        if cached_path is not None:
+            set_processed_audio(cached_path, output_format)
             st.rerun()
-            
+        
+        # Render in a worker process; render_job_status polls it
+        if isinstance(uploaded_file, AudioFile):
+            st.session_state.render_job = get_job_manager().submit_render_file(
+                uploaded_file.path, input_digest, tempo_factor, bass_boost, quality, output_format
+            )
+        else:
+            suffix = f".{uploaded_file.name.split('.')[-1]}"
+            st.session_state.render_job = get_job_manager().submit_render(
+                input_bytes, suffix, input_digest, tempo_factor, bass_boost, quality, output_format
+            )
+        st.session_state.render_format = output_format
+        st.rerun()
+        
+    except JobQueueFull:
+        st.warning("⏳ The server is busy with other renders. Please try again in a moment.")
     except Exception as e:
         st.error(f"❌ Error processing audio: {str(e)}")
         st.error("Please try with a different file or adjust the settings.")
 
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_status():
+    """Show the running render's progress and collect its output when done"""
+    job_manager = get_job_manager()
+    job_id = st.session_state.render_job
+    status = job_manager.status(job_id) if job_id is not None else None
+    if status is None:
+        return
+    
+    if status['state'] not in FINISHED_STATES:
+        st.progress(int(status['progress'] * 100))
+        eta = f" (about {format_duration(status['eta_seconds'])} left)" if status['eta_seconds'] is not None else ""
+        st.text(f"🔄 {status['message']}{eta}")
+        if st.button("✖️ Cancel", key="cancel_render"):
+            job_manager.cancel(job_id)
+        return
+    
+    if status['state'] == DONE:
+        # Served from the job's output file; the job is kept until it's replaced
+        set_processed_audio(status['result'], st.session_state.render_format, job_id)
+    else:
+        if status['state'] == FAILED:
+            st.session_state.render_error = status['error']
+        job_manager.forget(job_id)
+    st.session_state.render_job = None
+    st.rerun(scope="app")
+
 def download_audio_from_url(video_url, video_title):
-    """Download audio from video URL and prepare for processing"""
+    """Queue a download of the video's audio for processing"""
     try:
-        # Show download status
-        with st.spinner("🔄 Downloading audio... This may take a moment."):
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            status_text.text("Getting video information...")
-            progress_bar.progress(20)
-            
-            # Download audio using the video downloader
-            temp_dir = tempfile.mkdtemp()
-            
-            status_text.text("Downloading audio from video...")
-            progress_bar.progress(60)
-            
-            audio_file_path = st.session_state.downloader.download_audio(video_url, temp_dir)
-            
-            status_text.text("Converting audio for processing...")
-            progress_bar.progress(80)
-            
-            # Read the downloaded audio file as bytes
-            with open(audio_file_path, 'rb') as f:
-                audio_bytes = f.read()
-            
-            # Create a file-like object that mimics uploaded file
-            class AudioFile:
-                def __init__(self, data, name):
-                    self._data = data
-                    self.name = name
-                
-                def getvalue(self):
-                    return self._data
-                
-                def read(self):
-                    return self._data
-            
-            # Clean filename for processing
-            safe_filename = f"{video_title[:50]}.wav"
-            downloaded_audio = AudioFile(audio_bytes, safe_filename)
-            
-            # Store as original audio for processing
-            st.session_state.original_audio = downloaded_audio
-            st.session_state.video_info = None  # Clear video info after download
-            
-            # Clean up temporary files
-            st.session_state.downloader.cleanup_temp_files(temp_dir)
-            
-            progress_bar.progress(100)
-            status_text.text("✅ Audio downloaded successfully!")
-            
-            st.success("🎉 Audio downloaded and ready for processing!")
-            
-            # Show audio player
-            st.subheader("🎧 Downloaded Audio")
-            st.audio(audio_bytes, format='audio/wav')
-            
-            st.rerun()
-            
+        st.session_state.download_error = None
+        # The worker downloads from the info Get Video Info already extracted
+        st.session_state.download_job = get_job_manager().submit_download(
+            video_url, info=st.session_state.downloader.cached_info(video_url)
+        )
+        st.session_state.download_title = video_title
+        st.rerun()
+        
+    except JobQueueFull:
+        st.warning("⏳ The server is busy with other jobs. Please try again in a moment.")
     except Exception as e:
         st.error(f"❌ Error downloading audio: {str(e)}")
         st.error("Please check the URL and try again.")
 
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def download_job_status():
+    """Show the running download's progress and load the audio when done"""
+    job_manager = get_job_manager()
+    job_id = st.session_state.download_job
+    status = job_manager.status(job_id) if job_id is not None else None
+    if status is None:
+        return
+    
+    if status['state'] not in FINISHED_STATES:
+        st.progress(int(status['progress'] * 100))
+        st.text(f"🔄 {status['message']}")
+        if st.button("✖️ Cancel", key="cancel_download"):
+            job_manager.cancel(job_id)
+        return
+    
+    if status['state'] == DONE:
+        # Processed from the job's file in its native container; the job is kept until the track is replaced
+        safe_filename = f"{st.session_state.download_title[:50]}{os.path.splitext(status['result'])[1]}"
+        set_original_audio(AudioFile(status['result'], safe_filename, job_id))
+        st.session_state.video_info = None  # Clear video info after download
+    else:
+        if status['state'] == FAILED:
+            st.session_state.download_error = status['error']
+        # Also removes the job's download directory
+        job_manager.forget(job_id)
+    st.session_state.download_job = None
+    st.rerun(scope="app")
+
 if __name__ == "__main__":
     main()
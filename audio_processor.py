@@ -1,21 +1,810 @@
-import librosa
 import numpy as np
 import soundfile as sf
-import scipy.signal
-from scipy import signal
-import io
-import tempfile
 import os
+import time
+from abc import ABC, abstractmethod
+from fractions import Fraction
+from functools import lru_cache
+from metrics import instrumented
+from utils import file_digest
+
+# scipy.signal, scipy.fft and librosa are imported in the functions that use
+# them: together they take about a second to import, which every process
+# that only needs this module's constants (the app, job workers, the API
+# server) would otherwise pay at startup. See startup.py for the warm-up.
+
+# Bump whenever a change alters rendered output, so cached renders are not reused
+ENGINE_VERSION = "5"
+
+# Working precision of the processing chain: float32 by default, float64
+# for mastering. Decoding stays float32 either way, which is exact for
+# 16- and 24-bit sources.
+PRECISIONS = {
+    'standard': np.float32,
+    'mastering': np.float64,
+}
+
+# Encoded output formats: name -> (label, soundfile format, subtype, file
+# extension, MIME type). 16- and 24-bit PCM is written with TPDF dither.
+OUTPUT_FORMATS = {
+    'ogg': ("OGG Vorbis (smallest)", 'OGG', 'VORBIS', '.ogg', 'audio/ogg'),
+    'flac': ("FLAC 16-bit (lossless)", 'FLAC', 'PCM_16', '.flac', 'audio/flac'),
+    'wav16': ("WAV 16-bit", 'WAV', 'PCM_16', '.wav', 'audio/wav'),
+    'wav24': ("WAV 24-bit", 'WAV', 'PCM_24', '.wav', 'audio/wav'),
+}
+
+# Output format save_audio uses for each precision when none is given
+DEFAULT_OUTPUT_FORMATS = {
+    'standard': 'wav16',
+    'mastering': 'wav24',
+}
+
+# Frames per block when filtering or writing in place
+BLOCK_FRAMES = 65536
+
+# Samples per channel above which the high-quality bass EQ filters in the FFT
+# domain (20 minutes at 44.1 kHz): the overlap-add FIR keeps the working
+# dtype, where sosfiltfilt makes float64 copies of the whole track
+EQ_FFT_THRESHOLD = 20 * 60 * 44100
+
+# Largest denominator of the rational approximation of a Vinyl speed factor
+VINYL_MAX_DENOMINATOR = 100
+
+
+def speed_ratio(speed_factor):
+    """Speed factor as a Fraction with a small denominator, for polyphase resampling"""
+    return Fraction(speed_factor).limit_denominator(VINYL_MAX_DENOMINATOR)
+
+
+def _zero_padded(audio, start, stop, dtype):
+    """Samples start:stop of (channels, samples) audio, with zeros outside the signal"""
+    if start >= 0 and stop <= audio.shape[-1]:
+        return audio[:, start:stop]
+    segment = np.zeros((audio.shape[0], stop - start), dtype=dtype)
+    src_lo, src_hi = max(start, 0), min(stop, audio.shape[-1])
+    if src_hi > src_lo:
+        segment[:, src_lo - start:src_hi - start] = audio[:, src_lo:src_hi]
+    return segment
+
+
+def _overlap_add(buffer, frames, hop_length):
+    """Overlap-add (..., n_fft, n_frames) frames into buffer starting at sample 0"""
+    n_fft, n_frames = frames.shape[-2], frames.shape[-1]
+    overlap = n_fft // hop_length
+    # View the buffer as hop-sized rows so every frame segment lands with one add
+    rows = buffer[..., :(n_frames + overlap - 1) * hop_length]
+    rows = rows.reshape(rows.shape[:-1] + (n_frames + overlap - 1, hop_length))
+    for k in range(overlap):
+        segment = frames[..., k * hop_length:(k + 1) * hop_length, :]
+        rows[..., k:k + n_frames, :] += np.swapaxes(segment, -1, -2)
+
+
+class TimeStretchEngine(ABC):
+    """Interface of the time-stretch engines behind the quality options.
+
+    Engines implement ``stretch(audio_data, rate, out=None, progress=None)``
+    for (channels, samples) or (samples,) audio. ``run`` calls it and
+    records the input length and wall time, from which ``realtime_factor``
+    reports the engine's throughput.
+    """
+
+    name = None
+
+    # Whether the engine resynthesizes from a spectrogram and so can apply
+    # a per-bin gain (spectral_gain) on the way, see change_tempo_and_boost_bass
+    spectral = False
+
+    # Whether the engine runs scipy.fft worker threads and takes a workers argument
+    threaded = True
+
+    # (input samples, seconds) of the last run
+    last_run = None
+
+    @abstractmethod
+    def stretch(self, audio_data, rate, out=None, progress=None):
+        """Stretched copy of audio_data (into out if given), rate times faster"""
+
+    def run(self, audio_data, rate, out=None, progress=None):
+        """stretch() and record how long it took"""
+        started = time.perf_counter()
+        result = self.stretch(audio_data, rate, out=out, progress=progress)
+        self.last_run = (audio_data.shape[-1], time.perf_counter() - started)
+        return result
+
+    def realtime_factor(self, sample_rate):
+        """Seconds of input processed per second in the last run, or None"""
+        if self.last_run is None or self.last_run[1] <= 0:
+            return None
+        samples, seconds = self.last_run
+        return samples / sample_rate / seconds
+
+
+class PhaseVocoder(TimeStretchEngine):
+    """Batched phase-vocoder time stretch for (channels, samples) audio.
+
+    One STFT runs over all channels at once through ``scipy.fft`` worker
+    threads, in chunks of frames so the full spectrogram is never held in
+    memory. The phase advance is taken per bin from the loudest channel and
+    shared by every channel, which keeps the inter-channel phase (and so the
+    stereo image) stable. Mono input gives the same result as
+    ``librosa.effects.time_stretch`` up to phase-accumulator rounding.
+
+    All buffers use ``dtype`` (float32 or float64) and the matching complex
+    type; the phase accumulator is always float64.
+
+    ``spectral_gain``, if given, is a complex gain per rfft bin applied to
+    every stretched frame before resynthesis, so an EQ can ride along with
+    the stretch instead of making its own pass over the output.
+    """
+
+    name = 'phase_vocoder'
+    spectral = True
+
+    def __init__(self, hop_length=512, n_fft=2048, workers=-1, chunk_frames=64, dtype=np.float32,
+                 spectral_gain=None):
+        from scipy import signal
+
+        if n_fft % hop_length:
+            raise ValueError("n_fft must be a multiple of hop_length")
+        self.hop_length = hop_length
+        self.n_fft = n_fft
+        self.workers = workers
+        self.chunk_frames = chunk_frames
+        self.dtype = np.dtype(dtype)
+        self.complex_dtype = np.result_type(self.dtype, np.complex64)
+        self.spectral_gain = spectral_gain
+
+        # Periodic Hann window for analysis and synthesis
+        self.window = signal.get_window('hann', n_fft, fftbins=True).astype(self.dtype)
+        self.window_sq = self.window ** 2
+
+    def stretch(self, audio_data, rate, out=None, progress=None):
+        """Time-stretch (channels, samples) or (samples,) audio by rate.
+
+        progress, if given, is called with the completed fraction after
+        each chunk of frames.
+        """
+        mono = audio_data.ndim == 1
+        audio = np.atleast_2d(audio_data)
+        channels, n_samples = audio.shape
+        n_fft, hop = self.n_fft, self.hop_length
+
+        n_frames = 1 + n_samples // hop
+        n_steps = int(np.ceil(n_frames / rate))
+        length = int(round(n_samples / rate))
+
+        # Preallocated overlap-add buffer: the only full-length allocation
+        buffer_len = max((n_steps - 1) * hop + n_fft, length + n_fft // 2)
+        buffer = np.zeros((channels, buffer_len), dtype=self.dtype)
+
+        phase_acc = None
+        for first in range(0, n_steps, self.chunk_frames):
+            steps = np.arange(first, min(first + self.chunk_frames, n_steps)) * rate
+            frame_lo = int(steps[0])
+            frame_hi = int(steps[-1]) + 2
+            n_analyzed = min(frame_hi, n_frames) - frame_lo
+            segment = self._padded_segment(audio, frame_lo * hop, (frame_lo + n_analyzed - 1) * hop + n_fft)
+            spectrum = self.analyze(segment, 0, n_analyzed)
+            if spectrum.shape[-1] < frame_hi - frame_lo:
+                # Zero columns past the last frame simplify the boundary
+                spectrum = np.pad(spectrum, ((0, 0), (0, 0), (0, frame_hi - frame_lo - spectrum.shape[-1])))
+
+            stretched, phase_acc = self.vocode(spectrum, steps - frame_lo, phase_acc)
+            self.synthesize(stretched, buffer[:, first * hop:])
+            if progress is not None:
+                progress(min(first + self.chunk_frames, n_steps) / n_steps)
+
+        # Normalize by the sum of squared windows, then drop the centering pad
+        self._normalize(buffer, n_steps)
+        result = buffer[:, n_fft // 2:n_fft // 2 + length]
+
+        if mono:
+            result = result[0]
+        if out is not None:
+            out[...] = result
+            return out
+        return result
+
+    def _padded_segment(self, audio, start, stop):
+        """Samples start:stop of audio as if zero-padded by n_fft // 2 on both sides"""
+        pad = self.n_fft // 2
+        return _zero_padded(audio, start - pad, stop - pad, self.dtype)
+
+    def _normalize(self, buffer, n_frames):
+        """Divide buffer in place by the squared-window envelope of n_frames frames.
+
+        Away from the edges the envelope repeats every hop, so only the
+        first and last few hop-sized rows need their own sums.
+        """
+        hop = self.hop_length
+        overlap = self.n_fft // hop
+        n_rows = n_frames + overlap - 1
+        rows = buffer[..., :n_rows * hop]
+        rows = rows.reshape(rows.shape[:-1] + (n_rows, hop))
+        segments = self.window_sq.reshape(overlap, hop)
+        tiny = np.finfo(self.dtype).tiny
+
+        def divide(row, envelope):
+            rows[..., row, :] /= np.where(envelope > tiny, envelope, 1.0).astype(self.dtype)
+
+        # Row r holds window segment k of every frame r - k in [0, n_frames)
+        edges = set(range(min(overlap - 1, n_rows))) | set(range(max(n_frames, 0), n_rows))
+        for row in sorted(edges):
+            divide(row, segments[max(0, row - n_frames + 1):min(overlap - 1, row) + 1].sum(axis=0))
+        interior = rows[..., overlap - 1:n_frames, :]
+        interior /= segments.sum(axis=0)
+
+    def analyze(self, padded, first_frame, n_frames):
+        """STFT of n_frames frames of padded (channels, samples) audio"""
+        from scipy import fft
+
+        hop = self.hop_length
+        start = first_frame * hop
+        segment = padded[:, start:start + (n_frames - 1) * hop + self.n_fft]
+        frames = np.lib.stride_tricks.sliding_window_view(segment, self.n_fft, axis=-1)[:, ::hop]
+        spectrum = fft.rfft(frames * self.window, axis=-1, workers=self.workers)
+        return np.swapaxes(spectrum, -1, -2).astype(self.complex_dtype, copy=False)
+
+    def vocode(self, spectrum, steps, phase_acc=None):
+        """Phase-vocode (channels, bins, frames) at fractional frame positions steps.
+
+        Returns the stretched spectrum and the phase accumulator to pass to
+        the next call, so long inputs can be processed chunk by chunk.
+        """
+        index = steps.astype(np.intp)
+        alpha = (steps - index).astype(self.dtype)
+
+        magnitude = np.abs(spectrum)
+        angle = np.angle(spectrum)
+
+        # Linear magnitude interpolation between neighbouring frames
+        mag = magnitude[..., index]
+        mag *= 1.0 - alpha
+        mag += alpha * magnitude[..., index + 1]
+
+        # Reference phase per bin and frame from the loudest channel
+        reference = angle[0]
+        if spectrum.shape[0] > 1:
+            reference = reference.copy()
+            loudest = magnitude[0].copy()
+            for channel in range(1, spectrum.shape[0]):
+                louder = magnitude[channel] > loudest
+                np.copyto(reference, angle[channel], where=louder)
+                np.copyto(loudest, magnitude[channel], where=louder)
+        ref0 = reference[:, index]
+
+        # The expected advance plus the wrapped deviation from it is, modulo
+        # 2 pi, just the raw phase difference between the two frames
+        increment = reference[:, index + 1] - ref0
+
+        # Accumulate the shared phase in float64, starting from the first frame
+        if phase_acc is None:
+            phase_acc = ref0[:, 0].astype(np.float64)
+        accumulated = np.empty(increment.shape, dtype=np.float64)
+        accumulated[:, 0] = phase_acc
+        np.cumsum(increment[:, :-1], axis=-1, dtype=np.float64, out=accumulated[:, 1:])
+        accumulated[:, 1:] += phase_acc[:, np.newaxis]
+        next_phase = np.mod(accumulated[:, -1] + increment[:, -1], 2.0 * np.pi)
+
+        # Each channel keeps its own phase offset from the reference
+        phase = angle[..., index]
+        phase -= ref0
+        accumulated -= 2.0 * np.pi * np.floor(accumulated / (2.0 * np.pi))
+        phase += accumulated.astype(self.dtype)
+
+        stretched = np.empty(phase.shape, dtype=self.complex_dtype)
+        np.multiply(mag, np.cos(phase), out=stretched.real)
+        np.multiply(mag, np.sin(phase), out=stretched.imag)
+        return stretched, next_phase
+
+    def synthesize(self, spectrum, buffer):
+        """Inverse-FFT, window and overlap-add spectrum into buffer"""
+        from scipy import fft
+
+        if self.spectral_gain is not None:
+            spectrum = spectrum * self.spectral_gain.astype(self.complex_dtype)[:, np.newaxis]
+        frames = fft.irfft(spectrum, n=self.n_fft, axis=-2, workers=self.workers)
+        frames *= self.window[:, np.newaxis]
+        _overlap_add(buffer, frames, self.hop_length)
+
+    def envelope(self, n_frames, buffer):
+        """Add the squared-window envelope of n_frames frames into buffer"""
+        frames = np.broadcast_to(self.window_sq[:, np.newaxis], (self.n_fft, n_frames))
+        _overlap_add(buffer, frames, self.hop_length)
+
+
+class WSOLA(TimeStretchEngine):
+    """Time-domain WSOLA (waveform-similarity overlap-add) time stretch.
+
+    Output frames of ``frame_length`` samples are overlap-added every
+    ``frame_length // 2`` samples with a periodic Hann window, which sums to
+    one at that overlap. Each frame is read near its nominal input position,
+    shifted by up to ``tolerance`` samples so it best continues the waveform
+    of the previous frame. Nothing is transformed back from a spectrum, so
+    this is much cheaper than the phase vocoder and keeps transients sharp
+    on speech and drums; dense tonal material can sound rougher.
+
+    The search is vectorized per chunk of frames: a batched FFT
+    cross-correlation on a ``decimation``-times decimated copy scores every
+    coarse shift against the previous frame's continuation (taken at its
+    nominal position), and a batched dot product refines the winner at full
+    rate. Only picking the best shift, which depends on the previous pick,
+    runs frame by frame. All channels share one shift, found on their mix,
+    which keeps the stereo image.
+    """
+
+    name = 'wsola'
+
+    def __init__(self, frame_length=2048, tolerance=512, decimation=4, workers=-1, chunk_frames=256,
+                 dtype=np.float32):
+        from scipy import fft, signal
+
+        if frame_length % (2 * decimation) or tolerance % decimation:
+            raise ValueError("frame_length // 2 and tolerance must be multiples of decimation")
+        self.frame_length = frame_length
+        self.hop_length = frame_length // 2
+        self.tolerance = tolerance
+        self.decimation = decimation
+        self.workers = workers
+        self.chunk_frames = chunk_frames
+        self.dtype = np.dtype(dtype)
+        self.window = signal.get_window('hann', frame_length, fftbins=True).astype(self.dtype)
+
+        # Candidates cover twice the tolerance either side of the nominal
+        # start, so the previous frame's shift can be taken into account
+        self._fft_size = fft.next_fast_len((self.hop_length + 4 * tolerance) // decimation)
+
+    def frame_starts(self, frames, rate):
+        """Nominal input start of each output frame; frame k is centered on input sample k * hop * rate"""
+        return np.round(frames * (self.hop_length * rate)).astype(np.intp) - self.frame_length // 2
+
+    def input_span(self, first, last, rate):
+        """Input samples [lo, hi) read by frames first to last - 1"""
+        starts = self.frame_starts(np.array([first - 1, first, last - 1]), rate)
+        lo = min(starts[0] + self.hop_length, starts[1] - 2 * self.tolerance)
+        hi = starts[2] + 2 * self.tolerance + self.frame_length
+        return int(lo), int(hi)
+
+    def stretch(self, audio_data, rate, out=None, progress=None):
+        """Time-stretch (channels, samples) or (samples,) audio by rate.
+
+        progress, if given, is called with the completed fraction after
+        each chunk of frames.
+        """
+        mono = audio_data.ndim == 1
+        audio = np.atleast_2d(audio_data)
+        channels, n_samples = audio.shape
+        hop = self.hop_length
+
+        length = int(round(n_samples / rate))
+        n_frames = -(-length // hop) + 1
+        buffer = np.zeros((channels, (n_frames + 1) * hop), dtype=self.dtype)
+
+        shift = None
+        for first in range(0, n_frames, self.chunk_frames):
+            last = min(first + self.chunk_frames, n_frames)
+            lo, hi = self.input_span(first, last, rate)
+            segment = _zero_padded(audio, lo, hi, self.dtype)
+            positions, shift = self.choose_positions(segment.mean(axis=0), lo, np.arange(first, last), rate, shift)
+            self.synthesize(segment, lo, positions, buffer[:, first * hop:])
+            if progress is not None:
+                progress(last / n_frames)
+
+        # Drop the half frame before the first frame's center
+        result = buffer[:, self.frame_length // 2:self.frame_length // 2 + length]
+
+        if mono:
+            result = result[0]
+        if out is not None:
+            out[...] = result
+            return out
+        return result
+
+    def choose_positions(self, mix, base, frames, rate, shift=None):
+        """Input start of every frame in frames, searched on mix (the channel mean from sample base).
+
+        shift is the search state after the previous frame, None before the
+        first frame. Returns the positions and the state after the last
+        frame, so long inputs can be processed chunk by chunk.
+        """
+        from scipy import fft
+
+        hop, tolerance, factor = self.hop_length, self.tolerance, self.decimation
+        n = len(frames)
+        starts = self.frame_starts(frames, rate)
+        continuations = self.frame_starts(frames - 1, rate) + hop - base
+
+        # Row gathers from strided views instead of element-wise indexing
+        windows = np.lib.stride_tricks.sliding_window_view
+        templates = windows(mix, hop)[continuations]
+        candidates = windows(mix, hop + 4 * tolerance)[starts - 2 * tolerance - base]
+        coarse_shift, fine_shift = shift if shift is not None else (None, None)
+
+        # Coarse search: every lag at once on sums of factor samples taken
+        # every factor samples, one batched FFT cross-correlation for all frames
+        size = self._fft_size
+        box = mix[:len(mix) - factor + 1].copy()
+        for k in range(1, factor):
+            box += mix[k:len(mix) - factor + 1 + k]
+        coarse_templates = windows(box, hop - factor + 1)[:, ::factor][continuations]
+        coarse_candidates = windows(box, hop + 4 * tolerance - factor + 1)[:, ::factor][starts - 2 * tolerance - base]
+        correlation = fft.irfft(
+            np.conj(fft.rfft(coarse_templates, size, axis=-1, workers=self.workers))
+            * fft.rfft(coarse_candidates, size, axis=-1, workers=self.workers),
+            size, axis=-1, workers=self.workers
+        )[:, :4 * tolerance // factor + 1]
+        coarse = self._normalize(correlation, coarse_candidates, hop // factor)
+
+        # With the previous frame shifted by s0, shift s is at lag s - s0 + 2 * tolerance
+        reach = tolerance // factor
+        coarse_shifts = np.empty(n, dtype=np.intp)
+        previous = np.empty(n, dtype=np.intp)
+        for i in range(n):
+            previous[i] = coarse_shift if coarse_shift is not None else 0
+            if coarse_shift is None:
+                coarse_shift = 0
+            else:
+                lo = reach - coarse_shift
+                coarse_shift = int(np.argmax(coarse[i, lo:lo + 2 * reach + 1])) - reach
+            coarse_shifts[i] = coarse_shift
+
+        # Fine search at full rate around each coarse lag: both this frame's
+        # and the previous frame's shift can move by up to factor - 1
+        reach = 2 * factor - 2
+        first_lag = np.clip(factor * (coarse_shifts - previous) + 2 * tolerance - reach, 0, 4 * tolerance - 2 * reach)
+        spans = windows(candidates, hop + 2 * reach, axis=-1)[np.arange(n), first_lag]
+        correlation = np.einsum('kjm,km->kj', windows(spans, hop, axis=-1), templates)
+        fine = self._normalize(correlation, spans, hop)
+
+        positions = np.empty(n, dtype=np.intp)
+        for i in range(n):
+            if fine_shift is None:
+                fine_shift = 0
+            else:
+                # Shift s is at index s + offset of this frame's fine lags
+                offset = 2 * tolerance - fine_shift - first_lag[i]
+                lo = max(factor * coarse_shifts[i] - factor + 1, -tolerance) + offset
+                hi = min(factor * coarse_shifts[i] + factor - 1, tolerance) + offset
+                lo, hi = max(lo, 0), min(hi, 2 * reach)
+                fine_shift = int(np.argmax(fine[i, lo:hi + 1])) + lo - offset
+            positions[i] = starts[i] + fine_shift
+        return positions, (coarse_shift, fine_shift)
+
+    def _normalize(self, correlation, candidates, width):
+        """Divide correlation by the energy of each width-sample candidate window"""
+        # Running sums in float64, which are exact enough to difference
+        power = np.zeros(candidates.shape[:-1] + (candidates.shape[-1] + 1,))
+        np.cumsum(np.square(candidates, dtype=np.float64), axis=-1, out=power[..., 1:])
+        n_lags = correlation.shape[-1]
+        energy = power[..., width:width + n_lags] - power[..., :n_lags]
+        floor = 1e-6 * energy.max(axis=-1, keepdims=True) + np.finfo(np.float64).tiny
+        return correlation / np.sqrt(np.maximum(energy, floor))
+
+    def synthesize(self, segment, base, positions, buffer):
+        """Window the frames of segment (input from sample base) at positions and overlap-add into buffer"""
+        frames = np.lib.stride_tricks.sliding_window_view(segment, self.frame_length, axis=-1)[:, positions - base]
+        frames = frames.astype(self.dtype, copy=False)
+        frames *= self.window
+        _overlap_add(buffer, np.swapaxes(frames, -1, -2), self.hop_length)
+
+
+class VinylResampler(TimeStretchEngine):
+    """"Vinyl" speed change: tempo and pitch together by polyphase resampling"""
+
+    name = 'resample'
+    threaded = False
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+
+    def stretch(self, audio_data, rate, out=None, progress=None):
+        from scipy import signal
+
+        # Playing faster by p/q means keeping q output samples for every p input samples
+        ratio = speed_ratio(rate)
+        resampled = signal.resample_poly(audio_data, ratio.denominator, ratio.numerator, axis=-1)
+        if progress is not None:
+            progress(1.0)
+
+        if out is not None:
+            out[...] = resampled
+            return out
+        return resampled.astype(self.dtype, copy=False)
+
+
+# Time-stretch engine and its settings behind each quality option: two
+# phase-vocoder hop sizes, the time-domain WSOLA engine, and "Vinyl", which
+# changes tempo and pitch together like a record played faster
+QUALITY_ENGINES = {
+    "Standard": (PhaseVocoder, {'hop_length': 512}),
+    "High": (PhaseVocoder, {'hop_length': 256}),
+    "Fast": (WSOLA, {}),
+    "Vinyl": (VinylResampler, {}),
+}
+QUALITIES = tuple(QUALITY_ENGINES)
+
+
+def time_stretch_engine(quality, workers=-1, dtype=np.float32):
+    """Engine instance for a quality option"""
+    engine_class, options = QUALITY_ENGINES[quality]
+    if engine_class.threaded:
+        options = dict(options, workers=workers)
+    return engine_class(dtype=dtype, **options)
+
+
+# Largest bass boost applied inside the phase vocoder: above it the fused
+# stretch drifts from the sequential chain by more than FUSED_TOLERANCE_DB
+# in some bands (benchmark.py --fused), so stronger boosts filter separately
+FUSED_MAX_BOOST_DB = 3.0
+
+
+def fuses_tempo_and_bass(tempo_factor, boost_db, quality):
+    """Whether these settings apply the bass boost inside the tempo change"""
+    return (tempo_factor != 1.0 and 0 < boost_db <= FUSED_MAX_BOOST_DB
+            and QUALITY_ENGINES[quality][0].spectral)
+
+
+@lru_cache(maxsize=64)
+def _design_bass_boost(sample_rate, boost_db, freq_cutoff=250):
+    """Low-pass SOS and mix gain for a bass boost, cached per (sample_rate, gain)"""
+    from scipy import signal
+
+    # Bass frequencies: 20-250 Hz, with peak around 60-80 Hz
+    sos = signal.butter(
+        N=2,  # Filter order
+        Wn=freq_cutoff / (sample_rate / 2),  # Normalized frequency
+        btype='low',
+        output='sos'
+    )
+    
+    # Convert dB to linear gain
+    gain_linear = 10**(boost_db / 20.0)
+    return sos, gain_linear
+
+
+class BassBoostFilter:
+    """Reusable bass-boost stage: low-pass the signal and mix the bass back in.
+
+    All channels go through a single ``sosfilt`` call along the last axis.
+    The filter state is carried between calls, so a stream can be fed in
+    chunks and give the same result as one call on the whole signal.
+    The recursion and its state run in float64 (a float32 low-pass this
+    narrow drifts by more than a 16-bit LSB); output is stored as ``dtype``.
+    """
+
+    def __init__(self, sample_rate, boost_db, freq_cutoff=250, dtype=np.float32):
+        self.sos, self.gain_linear = _design_bass_boost(sample_rate, boost_db, freq_cutoff)
+        self.dtype = np.dtype(dtype)
+        self.zi = None
+
+    def reset(self):
+        """Forget the filter state before starting a new stream"""
+        self.zi = None
+
+    def process(self, block, out=None):
+        """Boost a (channels, samples) or (samples,) block, continuing the stream.
+
+        With out (which may be block itself) the result is written there
+        BLOCK_FRAMES samples at a time instead of into a new array.
+        """
+        if block.shape[-1] == 0:
+            return block if out is None else out
+        if self.zi is None:
+            # Zero initial conditions, as a one-shot sosfilt uses
+            self.zi = np.zeros((self.sos.shape[0],) + block.shape[:-1] + (2,))
+        
+        if out is None:
+            return self._process(block).astype(self.dtype, copy=False)
+        for start in range(0, block.shape[-1], BLOCK_FRAMES):
+            out[..., start:start + BLOCK_FRAMES] = self._process(block[..., start:start + BLOCK_FRAMES])
+        return out
+
+    def frequency_response(self, n_fft):
+        """Complex response of the boost at the n_fft // 2 + 1 rfft bins"""
+        from scipy import signal
+
+        _, lowpass = signal.sosfreqz(self.sos, worN=np.linspace(0, np.pi, n_fft // 2 + 1))
+        # Same mix as _process: 1 + (lowpass - 1) * (gain - 1)
+        return 1.0 + (lowpass - 1.0) * (self.gain_linear - 1)
+
+    def _process(self, block):
+        from scipy import signal
+
+        block = block.astype(np.float64)
+        bass, self.zi = signal.sosfilt(self.sos, block, axis=-1, zi=self.zi)
+        
+        # block + (bass - block) * (gain - 1), computed in the filter output
+        bass -= block
+        bass *= self.gain_linear - 1
+        bass += block
+        return bass
+
+
+class ParametricEQ:
+    """Zero-phase parametric EQ applied in a single pass over all channels.
+
+    Each band is an ``iirpeak`` resonator run forwards and backwards and
+    blended with its input, so its zero-phase response is
+    ``(1 - mix) + mix * |H(w)|**2``. Whenever that response stays
+    non-negative it factors into one biquad, and the whole EQ becomes one
+    cascaded SOS applied with ``sosfiltfilt``. Responses that cannot be
+    factored (``mix > 1``) are filtered in the FFT domain with the same
+    response; ``fft_threshold`` also sends inputs longer than that many
+    samples there. ``method`` records which path the last call took.
+
+    Away from the ends the result matches the old per-band ``filtfilt``
+    chain (to 1e-8 on the SOS path, 1e-5 on the FFT path). The first and
+    last few thousand samples can differ by up to a few tenths, since
+    ``sosfiltfilt`` pads the cascade once where ``filtfilt`` padded each
+    band, and the FFT path zero-pads, so the resonators' start-up
+    transients differ.
+    """
+
+    def __init__(self, sample_rate, bands, fft_threshold=None, n_taps=2**16):
+        from scipy import signal
+
+        self.sample_rate = sample_rate
+        self.fft_threshold = fft_threshold
+        self.n_taps = n_taps
+
+        # (b, a, mix) for every band
+        self.bands = []
+        for freq, q_factor, mix in bands:
+            b, a = signal.iirpeak(freq / (sample_rate / 2), Q=q_factor)
+            self.bands.append((b, a, mix))
+
+        self.sos = self._design_sos()
+        self.method = None
+
+    def _design_sos(self):
+        """Cascade one factored biquad per band, or None if any band can't factor"""
+        sections = []
+        for b, a, mix in self.bands:
+            if mix > 1:
+                return None
+
+            # Autocorrelation (lags 0..2) of the band's zero-phase numerator
+            lags = (1 - mix) * np.correlate(a, a, 'full')[2:] + mix * np.correlate(b, b, 'full')[2:]
+
+            # Minimum-phase factor: the two roots on or inside the unit circle
+            roots = np.roots(np.concatenate([lags[::-1], lags[1:]]))
+            roots = roots[np.argsort(np.abs(roots))][:2]
+            numerator = np.real(np.poly(roots))
+            numerator *= np.sqrt(lags[0] / np.dot(numerator, numerator))
+
+            sections.append(np.concatenate([numerator, a / a[0]]))
+        return np.array(sections)
+
+    def response(self, n_fft):
+        """Real zero-phase response on the rfft grid of size n_fft"""
+        from scipy import signal
+
+        response = np.ones(n_fft // 2 + 1)
+        for b, a, mix in self.bands:
+            _, h = signal.freqz(b, a, worN=n_fft // 2 + 1, include_nyquist=True)
+            response *= (1 - mix) + mix * np.abs(h) ** 2
+        return response
+
+    def apply(self, audio_data):
+        """Filter (channels, samples) or (samples,) audio along the last axis"""
+        from scipy import signal
+
+        long_input = self.fft_threshold is not None and audio_data.shape[-1] > self.fft_threshold
+        if self.sos is not None and not long_input:
+            self.method = 'sos'
+            return signal.sosfiltfilt(self.sos, audio_data, axis=-1)
+
+        self.method = 'fft'
+        return self._apply_fft(audio_data)
+
+    def _apply_fft(self, audio_data):
+        """Overlap-add convolution with a windowed zero-phase FIR of the response"""
+        from scipy import signal
+
+        kernel = np.fft.fftshift(np.fft.irfft(self.response(self.n_taps), n=self.n_taps))
+        kernel = np.append(kernel, kernel[0]) * signal.get_window('hann', self.n_taps + 1, fftbins=False)
+        kernel = kernel.astype(np.result_type(audio_data.dtype, np.float32))
+        kernel = kernel.reshape((1,) * (audio_data.ndim - 1) + (-1,))
+        return signal.oaconvolve(audio_data, kernel, mode='same', axes=-1)
+
+
+class AudioEncoder:
+    """Encodes (channels, samples) float blocks into an audio file as they arrive.
+
+    Integer PCM subtypes are quantized here with TPDF dither (the difference
+    of two uniform variates, +-1 LSB peak) rather than rounded by
+    libsndfile. The dither comes from a seeded generator, so the same audio
+    always encodes to the same file however it is split into blocks.
+    """
+
+    # Bit depth of the subtypes that get dither
+    PCM_BITS = {'PCM_16': 16, 'PCM_24': 24}
+
+    def __init__(self, target, sample_rate, channels, file_format='WAV', subtype='PCM_16', dither_seed=0):
+        self.bits = self.PCM_BITS.get(subtype)
+        self._rng = np.random.default_rng(dither_seed)
+        self._file = sf.SoundFile(target, 'w', sample_rate, channels, subtype=subtype, format=file_format)
+
+    @classmethod
+    def for_format(cls, target, sample_rate, channels, output_format):
+        """Encoder for one of OUTPUT_FORMATS"""
+        _, file_format, subtype, _, _ = OUTPUT_FORMATS[output_format]
+        return cls(target, sample_rate, channels, file_format, subtype)
+
+    def write(self, block):
+        """Encode a (channels, samples) or (samples,) float block"""
+        for start in range(0, block.shape[-1], BLOCK_FRAMES):
+            # soundfile wants (samples, channels)
+            frames = np.atleast_2d(block[..., start:start + BLOCK_FRAMES]).T
+            if self.bits is not None:
+                frames = self._quantize(frames)
+            self._file.write(frames)
+
+    def _quantize(self, frames):
+        """Dithered integer samples; 24-bit ones in the top bytes of int32"""
+        full_scale = 2 ** (self.bits - 1)
+        noise = self._rng.random(frames.shape + (2,))
+        # float64, which holds 24-bit steps plus the dither exactly
+        quantized = frames.astype(np.float64) * full_scale
+        quantized += noise[..., 0] - noise[..., 1]
+        np.rint(quantized, out=quantized)
+        np.clip(quantized, -full_scale, full_scale - 1, out=quantized)
+        if self.bits == 16:
+            return quantized.astype(np.int16)
+        return quantized.astype(np.int32) << 8
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
 class AudioProcessor:
-    def __init__(self):
+    def __init__(self, decode_cache=None, fft_workers=-1, precision='standard'):
         self.supported_formats = ['mp3', 'wav', 'flac', 'm4a', 'ogg']
+        # Optional DecodeCache shared between sessions and processes
+        self.decode_cache = decode_cache
+        # FFT threads per transform; 1 when several processes share the cores
+        self.fft_workers = fft_workers
+        # 'standard' works in float32, 'mastering' in float64 with 24-bit output
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {sorted(PRECISIONS)}")
+        self.precision = precision
+        self.dtype = np.dtype(PRECISIONS[precision])
     
-    def load_audio(self, file_path):
+    @instrumented('load_audio', bytes_in='file_path')
+    def load_audio(self, file_path, digest=None):
         """Load audio file and return audio data and sample rate"""
         try:
-            # Load audio with librosa (automatically handles various formats)
-            audio_data, sample_rate = librosa.load(file_path, sr=None, mono=False)
+            # Decoded before: memory-map the cached float32 PCM
+            if self.decode_cache is not None:
+                if digest is None:
+                    digest = file_digest(file_path)
+                cached = self.decode_cache.load(digest)
+                if cached is not None:
+                    return cached
+            
+            # libsndfile reads WAV, FLAC, OGG and MP3 itself; this is what
+            # librosa.load(sr=None, mono=False) does for them, without
+            # importing librosa
+            try:
+                with sf.SoundFile(file_path) as source:
+                    sample_rate = source.samplerate
+                    audio_data = source.read(dtype=np.float32, always_2d=False).T
+            except RuntimeError:
+                if not isinstance(file_path, (str, os.PathLike)):
+                    raise
+                # Other containers (m4a, webm) through librosa's audioread fallback
+                import librosa
+
+                audio_data, sample_rate = librosa.load(file_path, sr=None, mono=False, dtype=np.float32)
+            
+            if self.decode_cache is not None:
+                self.decode_cache.store(digest, audio_data, sample_rate)
             
             # If stereo, keep both channels
             if len(audio_data.shape) == 1:
@@ -28,98 +817,124 @@ class AudioProcessor:
         except Exception as e:
             raise Exception(f"Failed to load audio file: {str(e)}")
     
-    def change_tempo(self, audio_data, tempo_factor, quality="Standard"):
-        """Change the tempo of audio using phase vocoder"""
+    @instrumented('change_tempo', bytes_in='audio_data')
+    def change_tempo(self, audio_data, tempo_factor, quality="Standard", progress=None, out=None):
+        """Change the tempo of audio with the quality option's time-stretch engine"""
         try:
-            # Set hop length based on quality
-            hop_length = 256 if quality == "High" else 512
-            
-            if len(audio_data.shape) == 1:
-                # Mono audio
-                stretched_audio = librosa.effects.time_stretch(
-                    audio_data, 
-                    rate=tempo_factor,
-                    hop_length=hop_length
-                )
-            else:
-                # Stereo audio - process each channel separately
-                stretched_channels = []
-                for channel in audio_data:
-                    stretched_channel = librosa.effects.time_stretch(
-                        channel,
-                        rate=tempo_factor,
-                        hop_length=hop_length
-                    )
-                    stretched_channels.append(stretched_channel)
-                stretched_audio = np.array(stretched_channels)
+            # Phase vocoder, WSOLA or Vinyl resampling, see QUALITY_ENGINES
+            engine = time_stretch_engine(quality, workers=self.fft_workers, dtype=self.dtype)
+            stretched_audio = engine.run(audio_data, tempo_factor, out=out, progress=progress)
             
             return stretched_audio
             
         except Exception as e:
             raise Exception(f"Failed to change tempo: {str(e)}")
     
-    def boost_bass(self, audio_data, sample_rate, boost_db):
-        """Apply bass boost using a low-shelf filter"""
+    @instrumented('change_speed', bytes_in='audio_data')
+    def change_speed(self, audio_data, speed_factor, out=None):
+        """Change tempo and pitch together with polyphase resampling"""
         try:
-            # Design a low-shelf filter for bass boost
-            # Bass frequencies: 20-250 Hz, with peak around 60-80 Hz
-            freq_cutoff = 250  # Hz
+            return VinylResampler(dtype=self.dtype).run(audio_data, speed_factor, out=out)
             
-            # Convert dB to linear gain
-            gain_linear = 10**(boost_db / 20.0)
+        except Exception as e:
+            raise Exception(f"Failed to change speed: {str(e)}")
+    
+    def engine_realtime_factors(self, sample_rate=44100, seconds=5.0, tempo_factor=0.8):
+        """Throughput of every quality option in x realtime, measured on a synthetic stereo clip"""
+        # Tone plus noise: tonal content for the phase vocoder, broadband for WSOLA's search
+        rng = np.random.default_rng(0)
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        clip = 0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * rng.standard_normal((2, t.size))
+        clip = clip.astype(self.dtype)
+        
+        factors = {}
+        for quality in QUALITIES:
+            engine = time_stretch_engine(quality, workers=self.fft_workers, dtype=self.dtype)
+            # A short warm-up run first, so FFT plans are not part of the timing
+            engine.run(clip[:, :8192], tempo_factor)
+            engine.run(clip, tempo_factor)
+            factors[quality] = engine.realtime_factor(sample_rate)
+        return factors
+    
+    @instrumented('boost_bass', bytes_in='audio_data')
+    def boost_bass(self, audio_data, sample_rate, boost_db, out=None):
+        """Apply bass boost using a low-shelf filter.
+
+        Pass out=audio_data to boost a writable array in place.
+        """
+        try:
+            if out is None:
+                out = np.empty(audio_data.shape, dtype=self.dtype)
             
-            # Design low-shelf filter
-            sos = signal.butter(
-                N=2,  # Filter order
-                Wn=freq_cutoff / (sample_rate / 2),  # Normalized frequency
-                btype='low',
-                output='sos'
-            )
+            # One sosfilt over all channels with cached coefficients, block by block into out
+            boosted = BassBoostFilter(sample_rate, boost_db, dtype=self.dtype).process(audio_data, out=out)
             
-            if len(audio_data.shape) == 1:
-                # Mono audio
-                # Apply filter to boost bass
-                bass_boosted = signal.sosfilt(sos, audio_data)
-                # Mix with original (controlled bass boost)
-                mixed_audio = audio_data + (bass_boosted - audio_data) * (gain_linear - 1)
-                # Normalize to prevent clipping
-                return self.normalize_audio(mixed_audio)
-            else:
-                # Stereo audio
-                boosted_channels = []
-                for channel in audio_data:
-                    bass_boosted = signal.sosfilt(sos, channel)
-                    mixed_channel = channel + (bass_boosted - channel) * (gain_linear - 1)
-                    boosted_channels.append(self.normalize_audio(mixed_channel))
-                return np.array(boosted_channels)
+            # Normalize all channels together to keep the stereo balance
+            return self.normalize_audio(boosted, out=boosted)
                 
         except Exception as e:
             raise Exception(f"Failed to boost bass: {str(e)}")
     
-    def normalize_audio(self, audio_data, target_peak=0.95):
+    @instrumented('change_tempo_and_boost_bass', bytes_in='audio_data')
+    def change_tempo_and_boost_bass(self, audio_data, sample_rate, tempo_factor, boost_db, quality="Standard",
+                                    progress=None, out=None):
+        """change_tempo followed by boost_bass, fused into one pass where the settings allow.
+
+        Up to FUSED_MAX_BOOST_DB, phase-vocoder qualities apply the bass
+        boost's frequency response as a per-bin gain on the stretched
+        spectrogram before resynthesis, so no separate filter pass runs over
+        the output. The result matches the sequential chain in level per
+        frequency band to a fraction of a dB (``python benchmark.py --fused``
+        and tests/test_fused_parity.py check it); otherwise the two steps run
+        in turn.
+        """
+        try:
+            engine = time_stretch_engine(quality, workers=self.fft_workers, dtype=self.dtype)
+            if not fuses_tempo_and_bass(tempo_factor, boost_db, quality):
+                stretched = engine.run(audio_data, tempo_factor, out=out, progress=progress)
+                return self.boost_bass(stretched, sample_rate, boost_db, out=stretched)
+            
+            bass_filter = BassBoostFilter(sample_rate, boost_db, dtype=self.dtype)
+            engine.spectral_gain = bass_filter.frequency_response(engine.n_fft)
+            boosted = engine.run(audio_data, tempo_factor, out=out, progress=progress)
+            
+            # Normalize all channels together, as boost_bass does
+            return self.normalize_audio(boosted, out=boosted)
+            
+        except Exception as e:
+            raise Exception(f"Failed to change tempo and boost bass: {str(e)}")
+    
+    @instrumented('normalize_audio', bytes_in='audio_data')
+    def normalize_audio(self, audio_data, target_peak=0.95, out=None):
         """Normalize audio to prevent clipping"""
-        max_val = np.max(np.abs(audio_data))
+        # Peak from max and min: no full-size np.abs temporary
+        max_val = max(float(np.max(audio_data)), -float(np.min(audio_data))) if audio_data.size else 0.0
         if max_val > 0:
-            return audio_data * (target_peak / max_val)
+            return np.multiply(audio_data, target_peak / max_val, out=out)
         return audio_data
     
-    def save_audio(self, audio_data, sample_rate, output_buffer):
-        """Save audio data to a buffer in WAV format"""
+    @instrumented('save_audio', bytes_in='audio_data', bytes_out='output')
+    def save_audio(self, audio_data, sample_rate, output, output_format=None):
+        """Encode audio data block by block into a file path or file object.
+
+        output_format is a key of OUTPUT_FORMATS, by default WAV at the
+        processor's precision (16- or 24-bit).
+        """
         try:
-            # Ensure audio is in the correct format for soundfile
-            if len(audio_data.shape) == 1:
-                # Mono audio
-                sf.write(output_buffer, audio_data, sample_rate, format='WAV')
-            else:
-                # Stereo audio - transpose to (samples, channels) for soundfile
-                audio_transposed = audio_data.T
-                sf.write(output_buffer, audio_transposed, sample_rate, format='WAV')
+            output_format = output_format or DEFAULT_OUTPUT_FORMATS[self.precision]
+            channels = 1 if len(audio_data.shape) == 1 else audio_data.shape[0]
             
-            output_buffer.seek(0)  # Reset buffer position
+            # Blocks are converted and written one at a time, never the whole track
+            with AudioEncoder.for_format(output, sample_rate, channels, output_format) as encoder:
+                encoder.write(audio_data)
+            
+            if hasattr(output, 'seek'):
+                output.seek(0)  # Reset buffer position
             
         except Exception as e:
             raise Exception(f"Failed to save audio: {str(e)}")
     
+    @instrumented('get_audio_info', bytes_in='file_path')
     def get_audio_info(self, file_path):
         """Get basic information about an audio file"""
         try:
@@ -130,9 +945,10 @@ class AudioProcessor:
                 'channels': info.channels,
                 'format': info.format
             }
-        except Exception as e:
+        except Exception:
             return None
     
+    @instrumented('apply_high_quality_bass_boost', bytes_in='audio_data')
     def apply_high_quality_bass_boost(self, audio_data, sample_rate, boost_db):
         """Apply a more sophisticated bass boost using parametric EQ"""
         try:
@@ -140,31 +956,16 @@ class AudioProcessor:
             bass_frequencies = [60, 120, 180]  # Hz
             q_factor = 0.7  # Quality factor for the filter
             
-            processed_audio = audio_data.copy()
+            # Each band blends 30% of the boost into the signal
+            gain = 10**(boost_db / 20.0)
+            mix = (gain - 1) * 0.3
             
-            for freq in bass_frequencies:
-                # Create a peaking EQ filter for each bass frequency
-                nyquist = sample_rate / 2
-                normalized_freq = freq / nyquist
-                
-                # Design peaking filter
-                b, a = signal.iirpeak(normalized_freq, Q=q_factor)
-                
-                if len(audio_data.shape) == 1:
-                    # Mono audio
-                    filtered = signal.filtfilt(b, a, processed_audio)
-                    # Apply boost
-                    gain = 10**(boost_db / 20.0)
-                    processed_audio = processed_audio + (filtered - processed_audio) * (gain - 1) * 0.3
-                else:
-                    # Stereo audio
-                    for i, channel in enumerate(processed_audio):
-                        filtered = signal.filtfilt(b, a, channel)
-                        gain = 10**(boost_db / 20.0)
-                        processed_audio[i] = channel + (filtered - channel) * (gain - 1) * 0.3
-            
-            return self.normalize_audio(processed_audio)
+            # sosfiltfilt works in float64; bring the result back to the working precision
+            eq = ParametricEQ(sample_rate, [(freq, q_factor, mix) for freq in bass_frequencies],
+                              fft_threshold=EQ_FFT_THRESHOLD)
+            processed_audio = eq.apply(audio_data).astype(self.dtype, copy=False)
+            
+            return self.normalize_audio(processed_audio, out=processed_audio)
             
         except Exception as e:
-            # Fallback to simple bass boost
-            return self.boost_bass(audio_data, sample_rate, boost_db)
+            raise Exception(f"Failed to apply high quality bass boost: {str(e)}")
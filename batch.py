@@ -0,0 +1,237 @@
+"""Headless batch renderer for whole folders of tracks.
+
+    python batch.py INPUT OUTPUT_DIR --preset 0.75:10 --preset 1.25:0:High
+
+INPUT is a directory, searched recursively for supported formats, or a
+manifest: a text file with one input path per line. Every file is rendered
+with every preset (``tempo:bass[:quality]``) through the same chain as the
+app, into ``OUTPUT_DIR/<relative path>.<preset>.<ext>`` in the ``--format``
+chosen (16-bit WAV by default, 24-bit with ``--mastering``).
+
+Files are spread over worker processes, one file per task, so each file is
+decoded once and presets with the same tempo reuse the stretched audio.
+Each worker runs single-threaded FFTs, so throughput grows with the number
+of processes instead of every process competing for all cores.
+
+Results are appended to ``OUTPUT_DIR/manifest.jsonl`` as they finish, with
+per-file timings. Outputs are written under a temporary name and renamed
+when complete, so rerunning the same command skips finished outputs and
+resumes an interrupted run.
+
+Workers return the ``metrics`` records of their operations along with the
+results; ``--metrics PATH`` writes the totals in Prometheus text format
+when the run ends and ``--metrics-log PATH`` appends every record as a
+JSON line.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import metrics
+from audio_processor import DEFAULT_OUTPUT_FORMATS, OUTPUT_FORMATS, QUALITIES, AudioProcessor
+from estimator import CostModel, probe_audio
+from jobs import render_file
+from utils import file_digest, is_supported_format
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+# Worker-process state, created on first use
+_worker_state = {}
+
+
+def parse_preset(text):
+    """Parse 'tempo:bass[:quality]' into a preset dict"""
+    parts = text.split(':')
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError(f"Preset '{text}' is not tempo:bass[:quality]")
+    try:
+        tempo_factor = float(parts[0])
+        bass_boost = float(parts[1])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Preset '{text}' has a non-numeric tempo or bass")
+    quality = parts[2] if len(parts) == 3 else "Standard"
+    if quality not in QUALITIES:
+        raise argparse.ArgumentTypeError(f"Preset '{text}' quality must be one of {', '.join(QUALITIES)}")
+    return {'tempo_factor': tempo_factor, 'bass_boost': bass_boost, 'quality': quality}
+
+
+def preset_name(preset):
+    """Short file-name tag for a preset, e.g. t0.75_b10_standard"""
+    return f"t{preset['tempo_factor']:g}_b{preset['bass_boost']:g}_{preset['quality'].lower()}"
+
+
+def collect_inputs(input_path):
+    """Input files and the base directory their output paths are relative to"""
+    if os.path.isdir(input_path):
+        files = []
+        for root, _, names in os.walk(input_path):
+            files.extend(os.path.join(root, name) for name in names if is_supported_format(name))
+        return sorted(files), input_path
+
+    # Manifest: one path per line, relative paths resolved against its directory
+    manifest_dir = os.path.dirname(os.path.abspath(input_path))
+    files = []
+    with open(input_path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                files.append(os.path.normpath(os.path.join(manifest_dir, line)))
+    base_dir = os.path.commonpath([os.path.dirname(path) for path in files]) if files else manifest_dir
+    return files, base_dir
+
+
+def output_path_for(input_path, base_dir, output_dir, preset, output_format='wav16'):
+    relative = os.path.splitext(os.path.relpath(input_path, base_dir))[0]
+    return os.path.join(output_dir, f"{relative}.{preset_name(preset)}{OUTPUT_FORMATS[output_format][3]}")
+
+
+def _worker_resources(precision):
+    """Per-process AudioProcessor and stage cache"""
+    if 'processor' not in _worker_state:
+        from audio_processor import AudioProcessor
+        from stage_graph import IntermediateCache
+
+        # Operation records go back to the parent with each track's results
+        _worker_state['metrics'] = []
+        metrics.set_sink(_worker_state['metrics'].append)
+        _worker_state['processor'] = AudioProcessor(fft_workers=1, precision=precision)
+        _worker_state['intermediate_cache'] = IntermediateCache()
+    return _worker_state['processor'], _worker_state['intermediate_cache']
+
+
+def render_track(input_path, renders, precision='standard', output_format=None):
+    """Render one file with every (preset, output_path); (result records, metrics records)"""
+    processor, intermediate_cache = _worker_resources(precision)
+    info = processor.get_audio_info(input_path)
+    results = []
+    try:
+        digest = file_digest(input_path)
+        for preset, output_path in renders:
+            record = {
+                'input': input_path,
+                'output': output_path,
+                'preset': preset,
+                'audio_seconds': info['duration'] if info is not None else None,
+            }
+            start = time.perf_counter()
+            temp_path = output_path + '.part'
+            try:
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                with metrics.labelled(input=input_path, preset=preset_name(preset)):
+                    render_file(processor, intermediate_cache, input_path, digest,
+                                preset['tempo_factor'], preset['bass_boost'], preset['quality'], temp_path,
+                                output_format=output_format)
+                os.replace(temp_path, output_path)
+                record['status'] = 'done'
+            except Exception as e:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+                record['status'] = 'failed'
+                record['error'] = str(e)
+            record['seconds'] = time.perf_counter() - start
+            results.append(record)
+    finally:
+        # Stage outputs are only reused between presets of the same file
+        intermediate_cache.clear()
+    records = list(_worker_state['metrics'])
+    _worker_state['metrics'].clear()
+    return results, records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render folders of tracks with one or more presets")
+    parser.add_argument('input', help="Input directory or manifest file (one path per line)")
+    parser.add_argument('output_dir', help="Directory for rendered files and the results manifest")
+    parser.add_argument('--preset', type=parse_preset, action='append', required=True,
+                        help="tempo:bass[:quality], e.g. 0.75:10, 1.25:0:High, 0.9:0:Fast or 1.3:0:Vinyl (repeatable)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument('--mastering', action='store_true',
+                        help="Process in float64 and write 24-bit WAVs (about twice the memory)")
+    parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default=None,
+                        help="Output format (default: wav16, or wav24 with --mastering)")
+    parser.add_argument('--metrics', default=None, metavar='PATH',
+                        help="Write per-operation metrics in Prometheus text format to PATH at the end")
+    parser.add_argument('--metrics-log', default=None, metavar='PATH',
+                        help="Append every operation's metrics as a JSON line to PATH ('-' for stderr)")
+    args = parser.parse_args()
+    if args.metrics_log:
+        metrics.configure_log(args.metrics_log)
+    precision = 'mastering' if args.mastering else 'standard'
+    output_format = args.format or DEFAULT_OUTPUT_FORMATS[precision]
+
+    files, base_dir = collect_inputs(args.input)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Resume: only queue outputs that don't exist yet
+    tasks = []
+    skipped = 0
+    for input_path in files:
+        renders = []
+        for preset in args.preset:
+            output_path = output_path_for(input_path, base_dir, args.output_dir, preset, output_format)
+            if os.path.exists(output_path):
+                skipped += 1
+            else:
+                renders.append((preset, output_path))
+        if renders:
+            tasks.append((input_path, renders))
+
+    total = sum(len(renders) for _, renders in tasks)
+    print(f"{len(files)} files x {len(args.preset)} presets: {total} to render, {skipped} already done")
+    if not tasks:
+        return 0
+
+    # Header probes only; the host's cost model turns them into an ETA
+    model = CostModel.load()
+    probe_processor = AudioProcessor()
+    estimated = 0.0
+    for input_path, renders in tasks:
+        info = probe_audio(probe_processor, input_path)
+        estimated += sum(model.estimate(info, preset['tempo_factor'], preset['bass_boost'], preset['quality'],
+                                        output_format)['seconds'] for preset, _ in renders)
+    print(f"Estimated {estimated / max(1, args.jobs):.0f}s over {max(1, args.jobs)} workers")
+
+    done = failed = 0
+    audio_seconds = 0.0
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=max(1, args.jobs))
+    try:
+        with open(os.path.join(args.output_dir, MANIFEST_NAME), 'a') as manifest:
+            futures = [executor.submit(render_track, input_path, renders, precision, output_format)
+                       for input_path, renders in tasks]
+            for future in as_completed(futures):
+                results, records = future.result()
+                for record in records:
+                    metrics.record(record)
+                for record in results:
+                    manifest.write(json.dumps(record) + '\n')
+                    if record['status'] == 'done':
+                        done += 1
+                        audio_seconds += record['audio_seconds'] or 0.0
+                    else:
+                        failed += 1
+                        print(f"FAILED {record['input']} [{preset_name(record['preset'])}]: {record['error']}",
+                              file=sys.stderr)
+                manifest.flush()
+                track_seconds = sum(record['seconds'] for record in results)
+                print(f"[{done + failed}/{total}] {results[0]['input']} ({track_seconds:.1f}s)")
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        print("Interrupted; rerun the same command to resume", file=sys.stderr)
+        return 130
+    executor.shutdown()
+    if args.metrics:
+        metrics.REGISTRY.write_prometheus(args.metrics)
+
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {done}, failed {failed} in {elapsed:.1f}s "
+          f"({audio_seconds / elapsed:.1f}x realtime over {max(1, args.jobs)} workers)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
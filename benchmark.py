@@ -0,0 +1,575 @@
+"""Benchmarks for the audio processing engines.
+
+Run with ``python benchmark.py``. Signals are synthetic so the numbers are
+reproducible on any host.
+
+``--suite quick|standard|full`` (quick by default) times the stages of
+``SUITE_STAGES`` over a matrix of channel counts (mono, stereo, 5.1),
+sample rates (22.05-96 kHz), durations (10 s to 60 min for ``full``),
+qualities and test materials, reporting wall time, real-time factor and
+peak allocation. Besides the ``AudioProcessor`` stages the registry holds
+the comparisons earlier changes were measured with: the old per-channel
+librosa stretch, the fused tempo + bass pass, the streaming renderer and
+the waveform peak pyramid. ``--json`` saves the results and ``--compare``
+flags regressions against a saved baseline, exiting non-zero when any stage
+got slower or hungrier than ``--threshold``.
+
+``--fused`` and ``--memory`` are checks rather than timings: the fused
+path's parity with the sequential chain, and the peak RSS of each
+precision and of streamed renders.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import librosa
+import numpy as np
+import soundfile as sf
+from scipy import signal
+
+import metrics
+from audio_processor import ENGINE_VERSION, FUSED_MAX_BOOST_DB, QUALITIES, AudioProcessor
+from utils import create_audio_visualization_data
+from waveform import PeakPyramid
+
+# Test material, see make_material
+MATERIALS = ('music', 'speech', 'percussive')
+
+# Octave-ish bands and the largest level difference allowed per band between
+# the fused tempo + bass render and the sequential chain
+PARITY_BANDS = (20, 60, 120, 250, 500, 1000, 4000, 16000)
+FUSED_TOLERANCE_DB = 0.5
+
+# Stages a suite run times unless --stages picks others from SUITE_STAGES;
+# durations per --suite preset
+SUITE_DEFAULT_STAGES = ('load_audio', 'save_audio', 'change_tempo', 'boost_bass', 'apply_high_quality_bass_boost',
+                        'normalize_audio')
+SUITE_CHANNELS = (1, 2, 6)
+SUITE_SAMPLE_RATES = (22050, 44100, 48000, 96000)
+SUITE_DURATIONS = {
+    'quick': (10.0,),
+    'standard': (10.0, 60.0),
+    'full': (10.0, 60.0, 600.0, 3600.0),
+}
+
+# Points per waveform view, and the span of the track a peak_view case
+# shows from its middle
+SUITE_VIEW_POINTS = 1000
+SUITE_PEAK_VIEW_ZOOM = 0.01
+
+# Cases whose input is larger than this are skipped (60 min of 96 kHz 5.1 is 8 GB)
+SUITE_MAX_INPUT_BYTES = 4 * 1024**3
+
+# Slowdown or memory growth against the baseline that counts as a regression,
+# ignoring differences below the noise floor of each metric
+REGRESSION_THRESHOLD = 0.15
+REGRESSION_MIN_DELTA = {'seconds': 0.005, 'peak_alloc_bytes': 1024**2}
+
+# Peak RSS of a float32 render may be at most this fraction of the float64 one's
+PRECISION_MEMORY_RATIO = 0.6
+
+# Streamed renders run in constant memory: peak RSS growth at the longer of
+# two durations may exceed the shorter one's by at most this much
+STREAM_MEMORY_SLACK_BYTES = 16 * 1024**2
+
+
+def make_test_signal(duration, sample_rate=44100, channels=2, seed=0):
+    """Synthetic (channels, samples) float32 signal: tones plus noise"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    audio = np.empty((channels, t.size), dtype=np.float32)
+    for c in range(channels):
+        audio[c] = 0.3 * np.sin(2 * np.pi * 110 * (c + 1) * t) + 0.05 * rng.standard_normal(t.size)
+    return audio
+
+
+def make_long_signal(duration, sample_rate=44100, channels=2):
+    """make_test_signal generated in blocks, so the float64 noise never spans the whole track"""
+    audio = np.empty((channels, int(duration * sample_rate)), dtype=np.float32)
+    block = 1 << 20
+    for start in range(0, audio.shape[-1], block):
+        length = audio[:, start:start + block].shape[-1]
+        audio[:, start:start + block] = make_test_signal(length / sample_rate, sample_rate, channels, seed=start)
+    return audio
+
+
+def make_material(kind, duration, sample_rate=44100, channels=2, seed=0):
+    """Synthetic (channels, samples) float32 test material of one kind.
+
+    music is make_test_signal; speech is a 120 Hz pulse train through two
+    formant resonances, voiced in four syllables per second with pauses;
+    percussive is a 120 BPM pattern of decaying kicks and noise hits.
+    """
+    if kind == 'music':
+        return make_test_signal(duration, sample_rate, channels, seed)
+    rng = np.random.default_rng(seed)
+    n = int(duration * sample_rate)
+    t = np.arange(n) / sample_rate
+    if kind == 'speech':
+        pulses = np.zeros(n)
+        pulses[::sample_rate // 120] = 1.0
+        voiced = pulses
+        for formant in (700, 1200):
+            b, a = signal.iirpeak(formant, 5, fs=sample_rate)
+            voiced = voiced + signal.lfilter(b, a, pulses)
+        syllables = np.clip(np.sin(2 * np.pi * 4 * t), 0, None) * (np.sin(2 * np.pi * 0.5 * t) > -0.5)
+        mono = 0.3 * voiced * syllables / np.abs(voiced).max()
+    elif kind == 'percussive':
+        beat = t % 0.5
+        kick = np.sin(2 * np.pi * (50 + 100 * np.exp(-beat * 30)) * beat) * np.exp(-beat * 8)
+        offbeat = (t + 0.25) % 0.5
+        hits = rng.standard_normal(n) * np.exp(-offbeat * 40)
+        mono = 0.5 * kick + 0.2 * hits
+    else:
+        raise ValueError(f"Unknown material '{kind}'")
+    audio = np.empty((channels, n), dtype=np.float32)
+    for c in range(channels):
+        audio[c] = mono + 0.005 * rng.standard_normal(n)
+    return audio
+
+
+def per_channel_time_stretch(audio_data, rate, hop_length):
+    """The previous change_tempo: one librosa time_stretch per channel"""
+    stretched_channels = []
+    for channel in audio_data:
+        stretched_channels.append(librosa.effects.time_stretch(channel, rate=rate, hop_length=hop_length))
+    return np.array(stretched_channels)
+
+
+def best_time(func, repeat):
+    """Best wall time of repeat runs of func"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def band_levels(audio, sample_rate=44100):
+    """Level in dB of each PARITY_BANDS band of the channel average"""
+    freqs, power = signal.welch(np.atleast_2d(audio).mean(axis=0), sample_rate, nperseg=8192)
+    bands = zip(PARITY_BANDS[:-1], PARITY_BANDS[1:])
+    return np.array([10 * np.log10(power[(freqs >= lo) & (freqs < hi)].sum()) for lo, hi in bands])
+
+
+def benchmark_fused(duration=30.0, rates=(0.8, 1.25), boosts=(1, 2, FUSED_MAX_BOOST_DB), sample_rate=44100):
+    """Fused tempo + bass render against change_tempo then boost_bass.
+
+    Reports the parity of the two outputs: the largest per-band level
+    difference, which must stay within FUSED_TOLERANCE_DB, and the waveform
+    SNR for reference. Boosts above FUSED_MAX_BOOST_DB run sequentially in
+    both, so only boosts up to it are compared by default. The suite's
+    change_tempo_and_boost_bass stage times the fused path.
+    """
+    processor = AudioProcessor()
+    results = []
+    for material in MATERIALS:
+        audio = make_material(material, duration, sample_rate)
+        for rate in rates:
+            for boost in boosts:
+                stretched = processor.change_tempo(audio, rate)
+                reference = processor.boost_bass(stretched, sample_rate, boost, out=stretched)
+                output = processor.change_tempo_and_boost_bass(audio, sample_rate, rate, boost)
+                error = output - reference
+                band_error = float(np.abs(band_levels(output, sample_rate) - band_levels(reference, sample_rate)).max())
+                results.append({
+                    'material': material,
+                    'rate': rate,
+                    'bass_boost': boost,
+                    'band_error_db': band_error,
+                    'snr_db': float(10 * np.log10(np.sum(reference.astype(np.float64) ** 2) / np.sum(error.astype(np.float64) ** 2))),
+                    'passed': band_error <= FUSED_TOLERANCE_DB,
+                })
+    return results
+
+
+def _peak_rss_of_chain(precision, duration, rate, bass_boost):
+    """Run tempo -> bass -> save in this process; peak RSS growth in bytes"""
+    # Generated in blocks so the float64 noise doesn't set the high-water mark
+    audio = make_long_signal(duration)
+
+    processor = AudioProcessor(precision=precision)
+    processor.boost_bass(processor.change_tempo(audio[:, :44100], rate), 44100, bass_boost)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    stretched = processor.change_tempo(audio, rate)
+    boosted = processor.boost_bass(stretched, 44100, bass_boost, out=stretched)
+    processor.save_audio(boosted, 44100, io.BytesIO())
+
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) * 1024
+
+
+def benchmark_memory(duration=600.0, rate=0.8, bass_boost=8):
+    """Peak RSS of the render chain on a long stereo file, per precision"""
+    # A fresh process per run, since the peak RSS counter never goes down
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for precision in ('standard', 'mastering'):
+        with context.Pool(1) as pool:
+            peak = pool.apply(_peak_rss_of_chain, (precision, duration, rate, bass_boost))
+        results.append({
+            'precision': precision,
+            'duration': duration,
+            'input_bytes': int(duration * 44100) * 2 * 4,
+            'peak_rss_bytes': peak,
+        })
+    return results
+
+
+def _peak_rss_of_stream(duration, rate, bass_boost, quality):
+    """Stream-render a WAV file of this duration in this process; peak RSS growth in bytes"""
+    from stream_renderer import StreamRenderer
+
+    renderer = StreamRenderer()
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'input.wav')
+        output_path = os.path.join(workdir, 'output.wav')
+        # Written in blocks so the input never sits in memory
+        with sf.SoundFile(path, 'w', 44100, 2, 'PCM_16') as f:
+            for start in range(0, int(duration), 10):
+                f.write(make_test_signal(min(10, duration - start), seed=start).T)
+        warm_up_path = os.path.join(workdir, 'warm_up.wav')
+        sf.write(warm_up_path, make_test_signal(1.0).T, 44100)
+        renderer.render(warm_up_path, output_path, rate, bass_boost, quality)
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        renderer.render(path, output_path, rate, bass_boost, quality)
+
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) * 1024
+
+
+def benchmark_stream_memory(durations=(150.0, 600.0), rate=0.8, bass_boost=8, quality="Standard"):
+    """Peak RSS of a streamed render per duration, and whether it stayed flat.
+
+    Returns (rows, flat): flat is False when the longest render's peak grew
+    past the shortest one's by more than STREAM_MEMORY_SLACK_BYTES, i.e.
+    memory started to scale with the track length.
+    """
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    for duration in durations:
+        with context.Pool(1) as pool:
+            peak = pool.apply(_peak_rss_of_stream, (duration, rate, bass_boost, quality))
+        rows.append({
+            'duration': duration,
+            'input_bytes': int(duration * 44100) * 2 * 4,
+            'peak_rss_bytes': peak,
+        })
+    flat = rows[-1]['peak_rss_bytes'] - rows[0]['peak_rss_bytes'] <= STREAM_MEMORY_SLACK_BYTES
+    return rows, flat
+
+
+def peak_allocation(func):
+    """Peak bytes allocated through Python and numpy while func runs"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Suite stages build the zero-argument call to time on one case from
+# (processor, audio, sample_rate, workdir, rate, bass_boost, quality)
+
+
+def _write_input(audio, sample_rate, workdir, name):
+    """Path of audio written as a 16-bit file called name in workdir"""
+    path = os.path.join(workdir, name)
+    sf.write(path, audio.T, sample_rate, subtype='PCM_16')
+    return path
+
+
+def _load_audio_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    # A FLAC upload of the test signal, decoded without the decode cache
+    path = _write_input(audio, sample_rate, workdir, 'input.flac')
+    return lambda: processor.load_audio(path)
+
+
+def _save_audio_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    path = os.path.join(workdir, 'output.wav')
+    return lambda: processor.save_audio(audio, sample_rate, path)
+
+
+def _change_tempo_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    return lambda: processor.change_tempo(audio, rate, quality)
+
+
+def _tempo_and_bass_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    return lambda: processor.change_tempo_and_boost_bass(audio, sample_rate, rate, bass_boost, quality)
+
+
+def _per_channel_stretch_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    return lambda: per_channel_time_stretch(audio, rate, hop_length=512)
+
+
+def _boost_bass_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    return lambda: processor.boost_bass(audio, sample_rate, bass_boost)
+
+
+def _high_quality_bass_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    return lambda: processor.apply_high_quality_bass_boost(audio, sample_rate, bass_boost)
+
+
+def _normalize_audio_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    return lambda: processor.normalize_audio(audio)
+
+
+def _stream_render_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    from stream_renderer import StreamRenderer
+
+    path = _write_input(audio, sample_rate, workdir, 'input.wav')
+    output_path = os.path.join(workdir, 'streamed.wav')
+    renderer = StreamRenderer(precision=processor.precision)
+    return lambda: renderer.render(path, output_path, rate, bass_boost, quality)
+
+
+def _peak_pyramid_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    return lambda: PeakPyramid.from_audio(audio, sample_rate)
+
+
+def _peak_view_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    pyramid = PeakPyramid.from_audio(audio, sample_rate)
+    duration = audio.shape[-1] / sample_rate
+    start = duration * (1 - SUITE_PEAK_VIEW_ZOOM) / 2
+    return lambda: pyramid.view(start, start + duration * SUITE_PEAK_VIEW_ZOOM, SUITE_VIEW_POINTS)
+
+
+def _visualization_stage(processor, audio, sample_rate, workdir, rate, bass_boost, quality):
+    return lambda: create_audio_visualization_data(audio, sample_rate, SUITE_VIEW_POINTS)
+
+
+# name -> (stage call factory, whether the stage runs once per quality)
+SUITE_STAGES = {
+    'load_audio': (_load_audio_stage, False),
+    'save_audio': (_save_audio_stage, False),
+    'change_tempo': (_change_tempo_stage, True),
+    'change_tempo_and_boost_bass': (_tempo_and_bass_stage, True),
+    'per_channel_time_stretch': (_per_channel_stretch_stage, False),
+    'boost_bass': (_boost_bass_stage, False),
+    'apply_high_quality_bass_boost': (_high_quality_bass_stage, False),
+    'normalize_audio': (_normalize_audio_stage, False),
+    'stream_render': (_stream_render_stage, True),
+    'peak_pyramid': (_peak_pyramid_stage, False),
+    'peak_view': (_peak_view_stage, False),
+    'visualization': (_visualization_stage, False),
+}
+
+
+def _suite_signal(material, duration, sample_rate, channels):
+    """Test signal of a suite case; music is generated in blocks"""
+    if material == 'music':
+        return make_long_signal(duration, sample_rate, channels)
+    return make_material(material, duration, sample_rate, channels)
+
+
+def benchmark_suite(durations, channel_counts=SUITE_CHANNELS, sample_rates=SUITE_SAMPLE_RATES,
+                    stages=SUITE_DEFAULT_STAGES, qualities=("Standard",), materials=('music',), rate=0.8, bass_boost=8,
+                    precision='standard', repeat=3, report=None):
+    """Wall time, x realtime and peak allocation of every stage per case of the matrix.
+
+    Cases are channels x sample rate x duration x material; stages that
+    depend on the quality run once per quality, and the others' rows have
+    no quality. Tracks over a minute are timed once. report, if given, is
+    called with each result row as it is measured.
+    """
+    processor = AudioProcessor(precision=precision)
+    results = []
+    skipped = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for duration in durations:
+            for sample_rate in sample_rates:
+                for channels in channel_counts:
+                    input_bytes = int(duration * sample_rate) * channels * processor.dtype.itemsize
+                    if input_bytes > SUITE_MAX_INPUT_BYTES:
+                        skipped.append({'channels': channels, 'sample_rate': sample_rate, 'duration': duration})
+                        continue
+                    for material in materials:
+                        audio = _suite_signal(material, duration, sample_rate, channels).astype(processor.dtype,
+                                                                                               copy=False)
+                        for stage in stages:
+                            stage_call, per_quality = SUITE_STAGES[stage]
+                            for quality in (qualities if per_quality else (None,)):
+                                settings = (workdir, rate, bass_boost, quality or "Standard")
+                                # Warm up FFT plans and filter caches on one second first
+                                stage_call(processor, audio[:, :sample_rate], sample_rate, *settings)()
+                                call = stage_call(processor, audio, sample_rate, *settings)
+                                seconds = best_time(call, repeat if duration <= 60 else 1)
+                                row = {
+                                    'stage': stage,
+                                    'quality': quality,
+                                    'material': material,
+                                    'channels': channels,
+                                    'sample_rate': sample_rate,
+                                    'duration': duration,
+                                    'seconds': seconds,
+                                    'realtime_factor': duration / seconds,
+                                    'peak_alloc_bytes': peak_allocation(call),
+                                    'input_bytes': input_bytes,
+                                }
+                                results.append(row)
+                                if report is not None:
+                                    report(row)
+                        del audio
+    return {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'engine_version': ENGINE_VERSION,
+            'precision': precision,
+            'qualities': list(qualities),
+            'materials': list(materials),
+            'rate': rate,
+            'bass_boost': bass_boost,
+            'repeat': repeat,
+        },
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+def _case_key(row, meta):
+    # Results from before the quality and material axes timed one quality on music
+    quality = row.get('quality', meta.get('quality') if SUITE_STAGES.get(row['stage'], (None, False))[1] else None)
+    return row['stage'], quality, row.get('material', 'music'), row['channels'], row['sample_rate'], row['duration']
+
+
+def compare_results(current, baseline, threshold=REGRESSION_THRESHOLD):
+    """Per-case ratios of current to baseline seconds and peak allocation.
+
+    A metric regresses when it grew by more than threshold and by more
+    than its REGRESSION_MIN_DELTA. Cases missing from either run are left out.
+    """
+    baseline_rows = {_case_key(row, baseline['meta']): row for row in baseline['results']}
+    comparisons = []
+    for row in current['results']:
+        base = baseline_rows.get(_case_key(row, current['meta']))
+        if base is None:
+            continue
+        comparison = {'stage': row['stage'], 'quality': row['quality'], 'material': row['material'],
+                      'channels': row['channels'], 'sample_rate': row['sample_rate'], 'duration': row['duration'],
+                      'regressions': []}
+        for metric, min_delta in REGRESSION_MIN_DELTA.items():
+            ratio = row[metric] / base[metric] if base[metric] else 1.0
+            comparison[f'{metric}_ratio'] = ratio
+            if ratio > 1 + threshold and row[metric] - base[metric] > min_delta:
+                comparison['regressions'].append(metric)
+        comparisons.append(comparison)
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the audio processing stages")
+    parser.add_argument('--duration', type=float, default=None,
+                        help="Test signal length in seconds (default per --suite, or 600 with --memory, 30 with --fused)")
+    parser.add_argument('--rate', type=float, default=0.8, help="Tempo factor")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per measurement (best is kept)")
+    parser.add_argument('--memory', action='store_true',
+                        help="Check peak RSS of the render chain per precision, and that streamed renders stay "
+                             "flat from a quarter of --duration to all of it, instead")
+    parser.add_argument('--fused', action='store_true',
+                        help="Check the fused tempo + bass render against the sequential chain instead")
+    parser.add_argument('--suite', choices=list(SUITE_DURATIONS), default='quick',
+                        help="Durations of the stage suite (default quick)")
+    parser.add_argument('--channels', type=int, nargs='+', default=list(SUITE_CHANNELS), help="Suite channel counts")
+    parser.add_argument('--sample-rates', type=int, nargs='+', default=list(SUITE_SAMPLE_RATES),
+                        help="Suite sample rates")
+    parser.add_argument('--stages', nargs='+', choices=list(SUITE_STAGES), default=list(SUITE_DEFAULT_STAGES),
+                        help="Suite stages")
+    parser.add_argument('--qualities', nargs='+', choices=QUALITIES, default=["Standard"],
+                        help="Qualities of the suite stages that depend on one")
+    parser.add_argument('--materials', nargs='+', choices=MATERIALS, default=['music'], help="Suite test materials")
+    parser.add_argument('--precision', choices=['standard', 'mastering'], default='standard',
+                        help="Suite processing precision")
+    parser.add_argument('--json', metavar='PATH', help="Write the suite results to PATH as JSON")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="Flag suite regressions against a JSON file written by --json")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="Relative growth counted as a regression (default 0.15)")
+    args = parser.parse_args()
+    # A sampled tracemalloc run would skew the timing it lands in
+    metrics.set_memory_sampling(0)
+
+    if args.fused:
+        rows = benchmark_fused(duration=args.duration or 30.0)
+        print(f"{'material':>10} {'rate':>5} {'bass':>5} {'band err (dB)':>14} {'SNR (dB)':>9}")
+        for row in rows:
+            print(f"{row['material']:>10} {row['rate']:>5} {row['bass_boost']:>5} "
+                  f"{row['band_error_db']:>14.3f} {row['snr_db']:>9.1f}{'' if row['passed'] else '  FAIL'}")
+        failed = sum(not row['passed'] for row in rows)
+        print(f"Parity: {len(rows) - failed}/{len(rows)} within {FUSED_TOLERANCE_DB} dB per band")
+        raise SystemExit(1 if failed else 0)
+
+    if args.memory:
+        print(f"{'precision':>10} {'input (MB)':>11} {'peak RSS (MB)':>14}")
+        peaks = {}
+        for row in benchmark_memory(duration=args.duration or 600.0, rate=args.rate):
+            print(f"{row['precision']:>10} {row['input_bytes'] / 1e6:>11.1f} {row['peak_rss_bytes'] / 1e6:>14.1f}")
+            peaks[row['precision']] = row['peak_rss_bytes']
+        halved = peaks['standard'] <= PRECISION_MEMORY_RATIO * peaks['mastering']
+        print(f"float32 peak: {peaks['standard'] / peaks['mastering']:.2f}x float64 "
+              f"({'within' if halved else 'OVER'} {PRECISION_MEMORY_RATIO})")
+        duration = args.duration or 600.0
+        rows, flat = benchmark_stream_memory(durations=(duration / 4, duration), rate=args.rate)
+        print(f"{'streamed (s)':>12} {'input (MB)':>11} {'peak RSS (MB)':>14}")
+        for row in rows:
+            print(f"{row['duration']:>12g} {row['input_bytes'] / 1e6:>11.1f} {row['peak_rss_bytes'] / 1e6:>14.1f}")
+        print(f"Streaming memory: {'flat' if flat else 'GREW'} within {STREAM_MEMORY_SLACK_BYTES / 1024**2:.0f} MB")
+        raise SystemExit(0 if flat and halved else 1)
+
+    # --duration runs the suite for one track length
+    durations = (args.duration,) if args.duration else SUITE_DURATIONS[args.suite]
+    print(f"{'stage':>30} {'quality':>9} {'material':>10} {'ch':>3} {'rate':>6} {'length (s)':>10} {'time (s)':>9} "
+          f"{'realtime':>9} {'peak (MB)':>10}")
+
+    def report(row):
+        print(f"{row['stage']:>30} {row['quality'] or '-':>9} {row['material']:>10} {row['channels']:>3} "
+              f"{row['sample_rate']:>6} {row['duration']:>10g} {row['seconds']:>9.3f} {row['realtime_factor']:>8.0f}x "
+              f"{row['peak_alloc_bytes'] / 1e6:>10.1f}", flush=True)
+
+    suite = benchmark_suite(durations, args.channels, args.sample_rates, args.stages, qualities=args.qualities,
+                            materials=args.materials, rate=args.rate, precision=args.precision, repeat=args.repeat,
+                            report=report)
+    for case in suite['skipped']:
+        print(f"Skipped {case['channels']} ch {case['sample_rate']} Hz {case['duration']:g} s: input over "
+              f"{SUITE_MAX_INPUT_BYTES / 1024**3:.0f} GB")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(suite, f, indent=2)
+        print(f"Wrote {len(suite['results'])} results to {args.json}")
+    if not args.compare:
+        return
+
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    comparisons = compare_results(suite, baseline, args.threshold)
+    print(f"\nAgainst {args.compare} (engine {baseline['meta']['engine_version']}, {baseline['meta']['created']}):")
+    print(f"{'stage':>30} {'quality':>9} {'material':>10} {'ch':>3} {'rate':>6} {'length (s)':>10} {'time':>7} "
+          f"{'peak':>7}")
+    for row in comparisons:
+        print(f"{row['stage']:>30} {row['quality'] or '-':>9} {row['material']:>10} {row['channels']:>3} "
+              f"{row['sample_rate']:>6} {row['duration']:>10g} {row['seconds_ratio']:>6.2f}x "
+              f"{row['peak_alloc_bytes_ratio']:>6.2f}x"
+              f"{'  REGRESSION: ' + ', '.join(row['regressions']) if row['regressions'] else ''}")
+    regressed = sum(bool(row['regressions']) for row in comparisons)
+    print(f"{regressed}/{len(comparisons)} cases regressed by more than {args.threshold:.0%}")
+    raise SystemExit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""Processing-time estimates from a header probe and a per-host cost model.
+
+    python estimator.py song.mp3 --tempo 0.8 --bass 8 --quality Standard
+    python estimator.py --calibrate
+    python estimator.py --from-benchmark results.json
+
+A render is a plan of stages (decode, tempo, bass or the fused tempo_bass,
+save; or one streamed pass for long tracks), each costing a host-specific
+number of seconds per million channel-samples of its input. The variant of
+a stage picks its rate: the codec for decode (or 'cached' when the decode
+cache already holds the track), the quality for tempo, the output format
+for save.
+
+Rates start from ``DEFAULT_RATES`` and are refined from measured stage
+timings with exponentially decaying weights, so the model follows the
+host as real jobs finish. ``JobManager`` feeds it every finished render,
+``--calibrate`` times a synthetic render of every variant, and
+``--from-benchmark`` fits it from ``benchmark.py --suite --json`` results.
+The model is saved as JSON in the cache directory and shared by the app,
+the API server and batch runs on the host.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+import metrics
+from audio_processor import FUSED_MAX_BOOST_DB, OUTPUT_FORMATS, QUALITIES, QUALITY_ENGINES, fuses_tempo_and_bass
+from jobs import STREAMING_THRESHOLD_SECONDS
+
+# Seconds per million channel-samples, by stage and variant, measured on one
+# x86 core with --calibrate; only the starting point until jobs are observed
+DEFAULT_RATES = {
+    'decode': {'WAV': 0.004, 'FLAC': 0.018, 'OGG': 0.033, 'MP3': 0.018, 'other': 0.05, 'cached': 0.0005},
+    'tempo': {"Standard": 0.14, "High": 0.26, "Fast": 0.052, "Vinyl": 0.026},
+    'bass': {'': 0.012},
+    'tempo_bass': {"Standard": 0.14, "High": 0.27},
+    'save': {'wav16': 0.026, 'wav24': 0.032, 'flac': 0.051, 'ogg': 0.2},
+    'stream': {"Standard": 0.12, "High": 0.24, "Fast": 0.048, "Vinyl": 0.047, 'none': 0.03},
+}
+
+# Weight of a default rate, in million channel-samples (about 11 s of stereo)
+PRIOR_WEIGHT = 1.0
+
+# Weight kept by older observations at each new one
+MODEL_DECAY = 0.8
+
+# Header probe fallback for files libsndfile can't read (m4a): assumed bitrate
+FALLBACK_BITRATE = 192000
+
+
+def default_model_path():
+    """Per-host cost model file under the system temp dir"""
+    return os.path.join(tempfile.gettempdir(), 'ai-audio-processor', 'cost_model.json')
+
+
+def probe_audio(processor, source, size_bytes=None):
+    """Header-only probe of a path or file object: duration, sample rate, channels, format.
+
+    Containers libsndfile can't parse get a guess from the file size, with
+    'estimated' set.
+    """
+    info = processor.get_audio_info(source)
+    if info is not None:
+        return {**info, 'estimated': False}
+
+    if size_bytes is None:
+        size_bytes = os.path.getsize(source)
+    return {
+        'duration': size_bytes * 8 / FALLBACK_BITRATE,
+        'sample_rate': 44100,
+        'channels': 2,
+        'format': 'other',
+        'estimated': True,
+    }
+
+
+def render_plan_work(info, tempo_factor, bass_boost, quality, output_format, decoded=False):
+    """[(stage, variant, million channel-samples)] a render of the probed file runs.
+
+    decoded says the decode cache already holds the track.
+    """
+    channel_samples = info['duration'] * info['sample_rate'] * info['channels'] / 1e6
+    output_samples = channel_samples / tempo_factor
+
+    if info['duration'] > STREAMING_THRESHOLD_SECONDS:
+        return [('stream', quality if tempo_factor != 1.0 else 'none', channel_samples * (2 if bass_boost > 0 else 1))]
+
+    if decoded:
+        codec = 'cached'
+    else:
+        codec = info['format'] if info['format'] in DEFAULT_RATES['decode'] else 'other'
+    plan = [('decode', codec, channel_samples)]
+    fused = fuses_tempo_and_bass(tempo_factor, bass_boost, quality)
+    if fused:
+        plan.append(('tempo_bass', quality, channel_samples))
+    else:
+        if tempo_factor != 1.0:
+            plan.append(('tempo', quality, channel_samples))
+        if bass_boost > 0:
+            plan.append(('bass', '', output_samples))
+    plan.append(('save', output_format, output_samples))
+    return plan
+
+
+class CostModel:
+    """Per-host seconds per million channel-samples of every stage variant"""
+
+    def __init__(self, path=None, decay=MODEL_DECAY):
+        self.path = path
+        self.decay = decay
+        # "stage/variant" -> [decayed seconds, decayed million channel-samples]
+        self.totals = {}
+        self.observations = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=None):
+        """Model saved at path (default: the host's), or a fresh one"""
+        model = cls(path or default_model_path())
+        try:
+            with open(model.path) as f:
+                saved = json.load(f)
+            model.totals = saved['totals']
+            model.observations = saved['observations']
+        except (OSError, ValueError, KeyError):
+            pass
+        return model
+
+    def save(self):
+        """Write the model atomically to its path"""
+        if self.path is None:
+            return
+        with self._lock:
+            payload = json.dumps({'totals': self.totals, 'observations': self.observations, 'updated': time.time()})
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(payload)
+        os.replace(temp_path, self.path)
+
+    def rate(self, stage, variant):
+        """Seconds per million channel-samples"""
+        with self._lock:
+            totals = self.totals.get(f"{stage}/{variant}")
+        prior = DEFAULT_RATES[stage].get(variant, max(DEFAULT_RATES[stage].values()))
+        if totals is None:
+            return prior
+        seconds, work = totals
+        return (seconds + prior * PRIOR_WEIGHT) / (work + PRIOR_WEIGHT)
+
+    def realtime_factor(self, stage, variant, sample_rate=44100, channels=2):
+        """Seconds of audio a stage variant processes per second, at this rate and channel count"""
+        return 1e6 / (self.rate(stage, variant) * sample_rate * channels)
+
+    def observe(self, stage, variant, work, seconds):
+        """Record that a stage variant took seconds for work million channel-samples"""
+        if work <= 0:
+            return
+        key = f"{stage}/{variant}"
+        with self._lock:
+            previous_seconds, previous_work = self.totals.get(key, (0.0, 0.0))
+            self.totals[key] = [previous_seconds * self.decay + seconds, previous_work * self.decay + work]
+            self.observations += 1
+
+    def estimate(self, info, tempo_factor, bass_boost, quality="Standard", output_format='wav16', decoded=False):
+        """Estimated seconds of a render: {'seconds', 'stages': [(stage, variant, work, seconds)]}"""
+        plan = render_plan_work(info, tempo_factor, bass_boost, quality, output_format, decoded)
+        stages = [(stage, variant, work, work * self.rate(stage, variant)) for stage, variant, work in plan]
+        return {'seconds': sum(seconds for _, _, _, seconds in stages), 'stages': stages}
+
+    def observe_render(self, plan, stage_seconds):
+        """Learn from a finished render: plan from estimate(), stage_seconds maps stage -> seconds"""
+        for stage, variant, work, _ in plan:
+            if stage in stage_seconds:
+                self.observe(stage, variant, work, stage_seconds[stage])
+
+    def fit_benchmark(self, suite):
+        """Observe the stage timings of a benchmark.py --suite JSON result"""
+        meta = suite['meta']
+        variants = {
+            'load_audio': ('decode', 'FLAC'),
+            'change_tempo': ('tempo', None),
+            'boost_bass': ('bass', ''),
+            'save_audio': ('save', 'wav24' if meta['precision'] == 'mastering' else 'wav16'),
+        }
+        for row in suite['results']:
+            if row['stage'] in variants:
+                stage, variant = variants[row['stage']]
+                if stage == 'tempo':
+                    # Results from before the suite's quality axis carry it in meta
+                    variant = row.get('quality') or meta['quality']
+                work = row['duration'] * row['sample_rate'] * row['channels'] / 1e6
+                self.observe(stage, variant, work, row['seconds'])
+
+    def calibrate(self, processor, seconds=10.0, sample_rate=44100):
+        """Observe a timed synthetic render of every stage variant on this host"""
+        import io
+
+        import numpy as np
+        import soundfile as sf
+
+        from stream_renderer import StreamRenderer
+
+        rng = np.random.default_rng(0)
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        clip = (0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * rng.standard_normal((2, t.size))).astype(processor.dtype)
+        work = clip.size / 1e6
+
+        def timed(func):
+            func(clip[:, :8192])
+            start = time.perf_counter()
+            func(clip)
+            return time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as workdir:
+            for file_format in ('WAV', 'FLAC', 'OGG', 'MP3'):
+                path = os.path.join(workdir, f'clip.{file_format.lower()}')
+                sf.write(path, clip.T, sample_rate, format=file_format)
+                # The first load in a process also pays one-time set-up
+                processor.load_audio(path)
+                start = time.perf_counter()
+                processor.load_audio(path)
+                self.observe('decode', file_format, work, time.perf_counter() - start)
+            for quality in QUALITIES:
+                self.observe('tempo', quality, work, timed(
+                    lambda audio, quality=quality: processor.change_tempo(audio, 0.8, quality)))
+                if QUALITY_ENGINES[quality][0].spectral:
+                    self.observe('tempo_bass', quality, work, timed(
+                        lambda audio, quality=quality: processor.change_tempo_and_boost_bass(
+                            audio, sample_rate, 0.8, FUSED_MAX_BOOST_DB, quality)))
+                path = os.path.join(workdir, 'clip.wav')
+                start = time.perf_counter()
+                StreamRenderer(fft_workers=processor.fft_workers).render(
+                    path, os.path.join(workdir, 'streamed.wav'), 0.8, 8, quality)
+                self.observe('stream', quality, 2 * work, time.perf_counter() - start)
+            self.observe('bass', '', work, timed(lambda audio: processor.boost_bass(audio, sample_rate, 8)))
+            for output_format in OUTPUT_FORMATS:
+                self.observe('save', output_format, work, timed(
+                    lambda audio, output_format=output_format: processor.save_audio(
+                        audio, sample_rate, io.BytesIO(), output_format)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate render times with this host's cost model")
+    parser.add_argument('input', nargs='?', help="Audio file to estimate a render of")
+    parser.add_argument('--tempo', type=float, default=1.0, help="Tempo factor")
+    parser.add_argument('--bass', type=float, default=0.0, help="Bass boost in dB")
+    parser.add_argument('--quality', choices=QUALITIES, default="Standard")
+    parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default='wav16', help="Output format")
+    parser.add_argument('--calibrate', action='store_true', help="Time a synthetic render of every stage and save")
+    parser.add_argument('--from-benchmark', metavar='PATH', help="Fit from benchmark.py --suite --json results and save")
+    parser.add_argument('--model', default=None, help="Cost model file (default: the host's)")
+    args = parser.parse_args()
+    # Calibration timings must not include a sampled tracemalloc run
+    metrics.set_memory_sampling(0)
+
+    from audio_processor import AudioProcessor
+
+    processor = AudioProcessor()
+    model = CostModel.load(args.model)
+    if args.calibrate:
+        model.calibrate(processor)
+    if args.from_benchmark:
+        with open(args.from_benchmark) as f:
+            model.fit_benchmark(json.load(f))
+    if args.calibrate or args.from_benchmark:
+        model.save()
+        print(f"Saved {model.path} ({model.observations} observations)")
+
+    print(f"{'stage':>11} {'variant':>9} {'s per M samples':>16}")
+    for stage, variants in DEFAULT_RATES.items():
+        for variant in variants:
+            print(f"{stage:>11} {variant or '-':>9} {model.rate(stage, variant):>16.4f}")
+
+    if args.input:
+        info = probe_audio(processor, args.input)
+        estimate = model.estimate(info, args.tempo, args.bass, args.quality, args.format)
+        print(f"\n{args.input}: {info['duration']:.1f}s, {info['sample_rate']} Hz, {info['channels']} ch, "
+              f"{info['format']}{' (guessed from size)' if info['estimated'] else ''}")
+        for stage, variant, work, seconds in estimate['stages']:
+            print(f"  {stage:>11} {variant or '-':>9} {work:>8.1f} M samples {seconds:>7.2f}s")
+        print(f"  Estimated total {estimate['seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
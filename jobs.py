@@ -0,0 +1,570 @@
+"""Background render and download jobs on a bounded process pool.
+
+The Streamlit script thread only submits work and polls job state; the DSP
+and yt-dlp downloads run in worker processes, so one user's render does not
+block their session and concurrent renders do not share one GIL.
+
+Workers report per-stage progress through a queue that a thread in the
+parent drains into the job table. Cancellation is cooperative: a running
+job checks its flag at every progress report and stops at the next one.
+When the pool already holds ``max_pending`` unfinished jobs, new
+submissions are refused with ``JobQueueFull`` so callers can back off.
+
+Every render is probed (header only) when it is submitted and gets an
+estimate from the host's ``estimator.CostModel``; job status carries the
+estimate and a remaining-time ETA. The parent times stage boundaries from
+the progress reports and feeds them back into the model when a render
+finishes. With ``max_backlog_seconds`` set, renders are also refused while
+the estimated work ahead of them per worker is longer than that.
+
+Workers also forward the ``metrics`` record of every instrumented
+operation through the progress queue. The parent adds them to its
+registry, so ``metrics.render_prometheus()`` covers the whole pool, and
+keeps each job's own records, which job status lists as ``operations``.
+A job is only finished once both its future is done and the drain thread
+has seen the ``JOB_END`` marker its worker queues after its last report
+and record, so stage timings and the cost model see all of them.
+
+Downloads go through the host's ``render_cache.DownloadCache``: a video
+that any process on the host already downloaded is linked into the job's
+directory, and jobs for a video being downloaded wait for that download.
+
+Workers are spawned when the manager is created and warm up in the
+background (``startup.start_warm_up``), so the first job doesn't pay for
+imports and first-call set-up.
+"""
+
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+# Tracks longer than this are rendered block by block in constant memory
+STREAMING_THRESHOLD_SECONDS = 600
+
+# Stage name -> (label, start, end) of its slice of a render's progress bar
+RENDER_STAGES = {
+    'decode': ("Loading audio file...", 0.0, 0.2),
+    'tempo': ("Applying tempo changes...", 0.2, 0.7),
+    'bass': ("Boosting bass frequencies...", 0.7, 0.9),
+    'tempo_bass': ("Applying tempo changes and bass boost...", 0.2, 0.9),
+    'save': ("Saving processed audio...", 0.9, 1.0),
+    'stream': ("Rendering long track in streaming mode...", 0.0, 1.0),
+}
+
+# Downloads keep the site's container, so there is no conversion stage after them
+DOWNLOAD_STAGES = {
+    'download': ("Downloading audio from video...", 0.0, 1.0),
+}
+
+# Progress-queue stage a worker reports after everything else a job queued
+JOB_END = 'end'
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobQueueFull(Exception):
+    """Raised when the pool already has as many unfinished jobs as allowed"""
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker when its job has been cancelled"""
+
+
+def default_jobs_dir():
+    """Directory for job inputs and outputs under the system temp dir"""
+    return os.path.join(tempfile.gettempdir(), 'ai-audio-processor', 'jobs')
+
+
+# Worker-process state, set up by _init_worker
+_progress_queue = None
+_cancel_flags = None
+_worker_state = {}
+
+
+def _init_worker(progress_queue, cancel_flags, memory_sample_every):
+    global _progress_queue, _cancel_flags
+    import metrics
+
+    _progress_queue = progress_queue
+    _cancel_flags = cancel_flags
+    # Operation records go to the parent's registry, tagged (None, 'metrics', record)
+    metrics.set_sink(lambda record: progress_queue.put((None, 'metrics', record)))
+    metrics.set_memory_sampling(memory_sample_every)
+
+    # Imports and first-call set-up run while the worker waits for its first job
+    import startup
+
+    startup.start_warm_up()
+
+
+def _report(job_id, stage, fraction):
+    """Send progress to the parent and stop if the job was cancelled"""
+    if _cancel_flags is not None and _cancel_flags.get(job_id):
+        raise JobCancelled()
+    if _progress_queue is not None:
+        _progress_queue.put((job_id, stage, fraction))
+
+
+def _run_job(func, job_id, *args):
+    """Run func(job_id, *args) in a worker, then queue the job's JOB_END marker"""
+    try:
+        return func(job_id, *args)
+    finally:
+        if _progress_queue is not None:
+            _progress_queue.put((job_id, JOB_END, None))
+
+
+def _worker_resources():
+    """Per-process AudioProcessor and caches, created on first use"""
+    if 'processor' not in _worker_state:
+        import startup
+        from audio_processor import AudioProcessor
+        from render_cache import DecodeCache, RenderCache
+        from stage_graph import IntermediateCache
+
+        # Before the first job reports progress, so its stage timings
+        # (and the cost model) don't include the imports
+        startup.wait_warm_up()
+        _worker_state['processor'] = AudioProcessor(decode_cache=DecodeCache())
+        _worker_state['intermediate_cache'] = IntermediateCache()
+        _worker_state['render_cache'] = RenderCache()
+    return _worker_state['processor'], _worker_state['intermediate_cache'], _worker_state['render_cache']
+
+
+def render_file(processor, intermediate_cache, input_path, input_digest, tempo_factor, bass_boost, quality,
+                output_path, report=None, output_format=None):
+    """Render input_path into output_path, reporting (stage, fraction).
+
+    output_format is a key of OUTPUT_FORMATS, by default WAV at the
+    processor's precision; the file is encoded block by block.
+    """
+    from audio_processor import DEFAULT_OUTPUT_FORMATS
+    from stage_graph import build_render_graph, render_plan
+
+    # Long tracks go through the block-streaming renderer
+    output_format = output_format or DEFAULT_OUTPUT_FORMATS[processor.precision]
+    info = processor.get_audio_info(input_path)
+    if info is not None:
+        duration = info['duration']
+    else:
+        # Containers libsndfile can't read (downloaded m4a, webm) stream through audioread
+        from stream_renderer import stream_duration
+
+        duration = stream_duration(input_path)
+    if duration is not None and duration > STREAMING_THRESHOLD_SECONDS:
+        from stream_renderer import StreamRenderer
+
+        stream_progress = (lambda fraction: report('stream', fraction)) if report is not None else None
+        if report is not None:
+            report('stream', 0.0)
+        StreamRenderer(fft_workers=processor.fft_workers, precision=processor.precision).render(
+            input_path, output_path, tempo_factor, bass_boost, quality, progress=stream_progress,
+            output_format=output_format)
+        return output_path
+
+    def on_stage(name, cached):
+        if report is not None:
+            report(name, 1.0 if cached else 0.0)
+
+    # Memoized chain; stages whose settings didn't change come from the cache
+    graph = build_render_graph(processor, intermediate_cache, progress=report)
+    target, params = render_plan(tempo_factor, bass_boost, quality)
+    audio_data, sample_rate = graph.run(
+        target,
+        sources={'input': ((input_path, input_digest), input_digest)},
+        params=params,
+        on_stage=on_stage
+    )
+
+    if report is not None:
+        report('save', 0.0)
+    processor.save_audio(audio_data, sample_rate, output_path, output_format=output_format)
+    return output_path
+
+
+def _prestart_worker():
+    """Occupy a worker until it has warmed up, so the pool spawns every worker at once"""
+    _worker_resources()
+
+
+def _run_render(job_id, input_path, input_digest, tempo_factor, bass_boost, quality, output_format, output_path):
+    import metrics
+
+    processor, intermediate_cache, render_cache = _worker_resources()
+    with metrics.labelled(job_id=job_id):
+        render_file(processor, intermediate_cache, input_path, input_digest, tempo_factor, bass_boost, quality,
+                    output_path, report=lambda stage, fraction: _report(job_id, stage, fraction),
+                    output_format=output_format)
+
+    # Share the result with every later session through the render cache
+    key = render_cache.make_key(input_digest, tempo_factor, bass_boost, quality, output_format)
+    render_cache.put_file(key, output_path, output_format)
+    _report(job_id, 'save', 1.0)
+    return output_path
+
+
+def _run_download(job_id, url, output_dir, info=None):
+    import metrics
+    from render_cache import DownloadCache
+    from video_downloader import VideoDownloader
+
+    def progress_hook(status):
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+        if status.get('status') == 'downloading' and total:
+            _report(job_id, 'download', min(status.get('downloaded_bytes', 0) / total, 1.0))
+
+    _report(job_id, 'download', 0.0)
+    with metrics.labelled(job_id=job_id):
+        # Other jobs for the same video wait for one download; cancellation is checked meanwhile
+        downloader = VideoDownloader(download_cache=DownloadCache())
+        audio_file_path = downloader.download_audio(url, output_dir, progress_hook=progress_hook, info=info,
+                                                    wait_hook=lambda: _report(job_id, 'download', 0.0))
+    _report(job_id, 'download', 1.0)
+    return audio_file_path
+
+
+class JobManager:
+    """Submits renders and downloads to a bounded process pool and tracks them"""
+
+    def __init__(self, max_workers=None, max_pending=None, jobs_dir=None, max_backlog_seconds=None, cost_model=None,
+                 prestart=True):
+        import metrics
+        from audio_processor import AudioProcessor
+        from estimator import CostModel
+        from render_cache import DecodeCache
+
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.max_workers
+        self.max_backlog_seconds = max_backlog_seconds
+        self.jobs_dir = jobs_dir or default_jobs_dir()
+        os.makedirs(self.jobs_dir, exist_ok=True)
+
+        # Per-host render cost model, refined by every finished render
+        self.cost_model = cost_model or CostModel.load()
+        # Only used for header probes and decode-cache lookups in this process
+        self._probe_processor = AudioProcessor()
+        self._decode_cache = DecodeCache()
+
+        # Spawned workers don't inherit the parent's threads or locks
+        context = multiprocessing.get_context('spawn')
+        self._manager = context.Manager()
+        self._cancel_flags = self._manager.dict()
+        self._progress_queue = context.Queue()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self._progress_queue, self._cancel_flags, metrics.MEMORY_SAMPLE_EVERY)
+        )
+
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._progress_thread = threading.Thread(target=self._drain_progress, daemon=True)
+        self._progress_thread.start()
+
+        # Spawn and warm up every worker now rather than on the first jobs
+        if prestart:
+            for _ in range(self.max_workers):
+                self._executor.submit(_prestart_worker)
+
+    def submit_render(self, input_bytes, suffix, input_digest, tempo_factor, bass_boost, quality,
+                      output_format='wav16'):
+        """Queue a render of input_bytes into one of OUTPUT_FORMATS and return its job ID"""
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+        input_path = os.path.join(job_dir, f"input{suffix}")
+        with open(input_path, 'wb') as f:
+            f.write(input_bytes)
+        return self._submit_render(job_id, input_path, input_digest, tempo_factor, bass_boost, quality,
+                                   output_format)
+
+    def submit_render_file(self, source_path, input_digest, tempo_factor, bass_boost, quality,
+                           output_format='wav16'):
+        """Queue a render of the audio file at source_path, e.g. a finished download, and return its job ID.
+
+        The file is hard-linked into the job (copied across file systems),
+        so it is never read into memory here.
+        """
+        from render_cache import link_or_copy
+
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+        input_path = os.path.join(job_dir, f"input{os.path.splitext(source_path)[1]}")
+        link_or_copy(source_path, input_path)
+        return self._submit_render(job_id, input_path, input_digest, tempo_factor, bass_boost, quality,
+                                   output_format)
+
+    def _submit_render(self, job_id, input_path, input_digest, tempo_factor, bass_boost, quality, output_format):
+        from audio_processor import OUTPUT_FORMATS
+        from estimator import probe_audio
+
+        output_path = os.path.join(os.path.dirname(input_path), "output" + OUTPUT_FORMATS[output_format][3])
+        estimate = self.cost_model.estimate(probe_audio(self._probe_processor, input_path),
+                                            tempo_factor, bass_boost, quality, output_format,
+                                            decoded=self._decode_cache.contains(input_digest))
+
+        return self._submit(job_id, 'render', RENDER_STAGES, _run_render,
+                            input_path, input_digest, tempo_factor, bass_boost, quality, output_format, output_path,
+                            estimate=estimate)
+
+    def submit_download(self, url, info=None):
+        """Queue a download of url and return its job ID.
+
+        info is url's already extracted VideoDownloader.extract_info() dict,
+        which saves the worker from extracting it again.
+        """
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+        return self._submit(job_id, 'download', DOWNLOAD_STAGES, _run_download, url, job_dir, info)
+
+    def _submit(self, job_id, kind, stages, func, *args, estimate=None):
+        with self._lock:
+            unfinished = sum(1 for job in self._jobs.values() if job['state'] not in FINISHED_STATES)
+            if self._closed or unfinished >= self.max_pending:
+                shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
+                raise JobQueueFull(f"Too many jobs in progress ({unfinished}), try again shortly")
+            if estimate is not None and self.max_backlog_seconds is not None:
+                backlog = self._backlog_seconds(time.time())
+                if backlog > self.max_backlog_seconds:
+                    shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
+                    raise JobQueueFull(f"About {backlog:.0f}s of renders queued per worker, try again shortly")
+
+            self._jobs[job_id] = {
+                'id': job_id,
+                'kind': kind,
+                'state': QUEUED,
+                'stage': None,
+                'message': "Waiting for a free worker...",
+                'progress': 0.0,
+                'result': None,
+                'error': None,
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'estimated_seconds': estimate['seconds'] if estimate is not None else None,
+                '_stages': stages,
+                '_plan': estimate['stages'] if estimate is not None else None,
+                # (stage, time of its first report, first fraction) in order
+                '_stage_starts': [],
+                # metrics records of the job's operations, from its worker
+                '_operations': [],
+                # Whether the drain thread has seen the job's JOB_END marker
+                '_ended': False,
+            }
+            future = self._executor.submit(_run_job, func, job_id, *args)
+            self._jobs[job_id]['_future'] = future
+        future.add_done_callback(lambda done: self._future_done(job_id, done))
+        return job_id
+
+    def _drain_progress(self):
+        """Apply worker progress reports to the job table and collect their metrics"""
+        import metrics
+
+        while True:
+            try:
+                job_id, stage, fraction = self._progress_queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._closed:
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+
+            if job_id is None and stage == 'metrics':
+                record = fraction
+                metrics.record(record)
+                with self._lock:
+                    job = self._jobs.get(record.get('job_id'))
+                    if job is not None:
+                        job['_operations'].append(record)
+                continue
+
+            if stage == JOB_END:
+                with self._lock:
+                    job = self._jobs.get(job_id)
+                    if job is None:
+                        continue
+                    job['_ended'] = True
+                    done = job['_future'].done()
+                if done:
+                    self._finish(job_id)
+                continue
+
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job['state'] in FINISHED_STATES:
+                    continue
+                label, start, end = job['_stages'][stage]
+                now = time.time()
+                if job['started'] is None:
+                    job['started'] = now
+                if stage != job['stage']:
+                    job['_stage_starts'].append((stage, now, fraction))
+                job['state'] = RUNNING
+                job['stage'] = stage
+                job['message'] = label
+                job['progress'] = max(job['progress'], start + (end - start) * fraction)
+
+    def _stage_seconds(self, job):
+        """Wall time of each stage that ran, from consecutive stage reports to the finish"""
+        starts = job['_stage_starts']
+        ends = [started for _, started, _ in starts[1:]] + [job['finished']]
+        # A stage whose first report is complete came from the stage cache
+        return {stage: end - started for (stage, started, fraction), end in zip(starts, ends) if fraction < 1.0}
+
+    def _remaining_seconds(self, job, now):
+        """Estimated seconds until an unfinished render is done, or None without an estimate"""
+        if job['estimated_seconds'] is None:
+            return None
+        if job['started'] is None:
+            return job['estimated_seconds']
+        elapsed = now - job['started']
+        if elapsed > job['estimated_seconds'] and job['progress'] > 0:
+            # Running over the estimate: extrapolate from progress instead
+            return elapsed * (1 - job['progress']) / job['progress']
+        return max(job['estimated_seconds'] - elapsed, 0.0)
+
+    def _backlog_seconds(self, now):
+        """Estimated seconds of unfinished renders per worker; call with the lock held"""
+        remaining = [self._remaining_seconds(job, now) for job in self._jobs.values()
+                     if job['state'] not in FINISHED_STATES]
+        return sum(seconds for seconds in remaining if seconds is not None) / self.max_workers
+
+    def backlog_seconds(self):
+        """Estimated seconds of queued and running renders per worker"""
+        with self._lock:
+            return self._backlog_seconds(time.time())
+
+    def estimate_render(self, source, input_digest, tempo_factor, bass_boost, quality, output_format='wav16',
+                        size_bytes=None):
+        """Estimated seconds to render an audio file path or file object with these settings"""
+        from estimator import probe_audio
+
+        info = probe_audio(self._probe_processor, source, size_bytes)
+        return self.cost_model.estimate(info, tempo_factor, bass_boost, quality, output_format,
+                                        decoded=self._decode_cache.contains(input_digest))['seconds']
+
+    def _future_done(self, job_id, future):
+        """Done-callback of a job's future: finish it if its JOB_END marker came first"""
+        from concurrent.futures.process import BrokenProcessPool
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            # Jobs that never started, or whose worker died, send no marker
+            if not (job['_ended'] or future.cancelled() or isinstance(future.exception(), BrokenProcessPool)):
+                return
+        self._finish(job_id)
+
+    def _finish(self, job_id):
+        """Settle a job's state once its worker has nothing more to report, and learn from its timings"""
+        stage_seconds = None
+        with self._lock:
+            job = self._jobs.get(job_id)
+            # The marker and the done-callback may both get here
+            if job is None or job['finished'] is not None:
+                return
+            future = job['_future']
+            job['finished'] = time.time()
+            if future.cancelled() or self._cancel_flags.get(job_id):
+                job['state'] = CANCELLED
+                job['message'] = "Cancelled"
+            elif future.exception() is not None:
+                job['state'] = FAILED
+                job['error'] = str(future.exception())
+                job['message'] = "Failed"
+            else:
+                job['state'] = DONE
+                job['result'] = future.result()
+                job['progress'] = 1.0
+                job['message'] = "Done"
+                # Stages slowed down by a sampled allocation trace would skew the model
+                traced = any(record['peak_bytes'] is not None for record in job['_operations'])
+                if job['_plan'] is not None and not traced:
+                    stage_seconds = self._stage_seconds(job)
+            plan = job['_plan']
+        self._cancel_flags.pop(job_id, None)
+
+        # Refine the cost model with how long this render's stages really took
+        if stage_seconds:
+            self.cost_model.observe_render(plan, stage_seconds)
+            try:
+                self.cost_model.save()
+            except OSError:
+                pass
+
+    def status(self, job_id):
+        """Public fields of a job, or None for an unknown ID"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            status = {key: value for key, value in job.items() if not key.startswith('_')}
+            status['operations'] = [
+                {key: record[key] for key in ('operation', 'parent', 'wall_seconds', 'cpu_seconds',
+                                              'bytes_in', 'bytes_out', 'peak_bytes', 'ok')}
+                for record in job['_operations']
+            ]
+            status['eta_seconds'] = (self._remaining_seconds(job, time.time())
+                                     if job['state'] not in FINISHED_STATES else None)
+            return status
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns False if it already finished"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['state'] in FINISHED_STATES:
+                return False
+            future = job['_future']
+        # Queued jobs never start; running ones stop at their next report
+        if not future.cancel():
+            self._cancel_flags[job_id] = True
+        return True
+
+    def forget(self, job_id):
+        """Drop a finished job and delete its files"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['state'] not in FINISHED_STATES:
+                return False
+            del self._jobs[job_id]
+        shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
+        return True
+
+    def counts(self):
+        """Number of tracked jobs and how many of them are unfinished"""
+        with self._lock:
+            unfinished = sum(1 for job in self._jobs.values() if job['state'] not in FINISHED_STATES)
+            return {'jobs': len(self._jobs), 'unfinished_jobs': unfinished}
+
+    def forget_finished(self, older_than):
+        """Forget jobs that finished more than older_than seconds ago"""
+        cutoff = time.time() - older_than
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job['state'] in FINISHED_STATES and job['finished'] < cutoff]
+        for job_id in expired:
+            self.forget(job_id)
+        return len(expired)
+
+    def shutdown(self, wait=True):
+        self._closed = True
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        self._manager.shutdown()
@@ -0,0 +1,224 @@
+"""Load test for the HTTP API in api_server.py.
+
+    python loadtest.py --start-server --scenario status --concurrency 32 --duration 10
+    python loadtest.py --url http://127.0.0.1:8502 --scenario render --concurrency 4
+
+Scenarios:
+
+    status  hammers GET /jobs/<id> for one finished job (event-loop overhead)
+    render  each client uploads a short synthetic track, polls until the render
+            is done and downloads the result (end-to-end job latency)
+
+Reports requests per second and p50/p99 latency per endpoint. Uses only the
+standard library; clients keep their connections alive.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+import soundfile as sf
+
+from benchmark import make_test_signal
+
+
+class Client:
+    """Minimal keep-alive HTTP/1.1 client on one connection"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=b'', headers=None):
+        """Return (status, response body bytes)"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", f"Content-Length: {len(body)}"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        self.writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        return status, await self.reader.readexactly(length)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Recorder:
+    """Latency samples per endpoint"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        # Timings that span several requests, such as a whole job
+        self.aggregates = set()
+
+    def add(self, name, seconds, ok=True, request=True):
+        self.samples.setdefault(name, []).append(seconds)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        if not request:
+            self.aggregates.add(name)
+
+    def report(self, elapsed):
+        total = sum(len(samples) for name, samples in self.samples.items() if name not in self.aggregates)
+        print(f"{total} requests in {elapsed:.2f}s: {total / elapsed:.1f} req/s")
+        print(f"{'endpoint':<18} {'count':>7} {'errors':>7} {'per s':>8} {'p50 ms':>9} {'p99 ms':>9}")
+        for name, samples in sorted(self.samples.items()):
+            p50, p99 = np.percentile(np.array(samples) * 1000, [50, 99])
+            print(f"{name:<18} {len(samples):>7} {self.errors.get(name, 0):>7} "
+                  f"{len(samples) / elapsed:>8.1f} {p50:>9.2f} {p99:>9.2f}")
+
+
+async def timed(recorder, name, coroutine, expected=(200,)):
+    start = time.perf_counter()
+    status, body = await coroutine
+    recorder.add(name, time.perf_counter() - start, ok=status in expected)
+    return status, body
+
+
+def test_upload(duration):
+    """WAV bytes of a short synthetic stereo track"""
+    buffer = io.BytesIO()
+    sf.write(buffer, make_test_signal(duration).T, 44100, format='WAV')
+    return buffer.getvalue()
+
+
+async def wait_for_job(client, recorder, job_id, poll_interval):
+    while True:
+        _, body = await timed(recorder, 'GET /jobs/<id>', client.request('GET', f"/jobs/{job_id}"))
+        status = json.loads(body)
+        if status['state'] in ('done', 'failed', 'cancelled'):
+            return status
+        await asyncio.sleep(poll_interval)
+
+
+async def status_client(host, port, recorder, job_id, deadline):
+    client = Client(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            await timed(recorder, 'GET /jobs/<id>', client.request('GET', f"/jobs/{job_id}"))
+    finally:
+        await client.close()
+
+
+async def render_client(host, port, recorder, upload, deadline, poll_interval):
+    client = Client(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            status, body = await timed(recorder, 'POST /jobs', client.request(
+                'POST', '/jobs?tempo=0.8&bass=5&filename=load.wav', upload
+            ), expected=(202,))
+            if status == 503:
+                await asyncio.sleep(0.5)
+                continue
+            job_id = json.loads(body)['job_id']
+            job = await wait_for_job(client, recorder, job_id, poll_interval)
+            if job['state'] == 'done':
+                await timed(recorder, 'GET result', client.request('GET', f"/jobs/{job_id}/result"))
+            await timed(recorder, 'DELETE /jobs/<id>', client.request('DELETE', f"/jobs/{job_id}"))
+            recorder.add('job end-to-end', time.perf_counter() - start, ok=job['state'] == 'done', request=False)
+    finally:
+        await client.close()
+
+
+async def run(args):
+    parts = urlsplit(args.url)
+    host, port = parts.hostname, parts.port or 80
+    upload = test_upload(args.track_seconds)
+    recorder = Recorder()
+
+    # One finished job for the status scenario to poll
+    job_id = None
+    if args.scenario == 'status':
+        client = Client(host, port)
+        _, body = await client.request('POST', '/jobs?tempo=1.0&bass=0&filename=load.wav', upload)
+        job_id = json.loads(body)['job_id']
+        await wait_for_job(client, Recorder(), job_id, 0.1)
+        await client.close()
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+    if args.scenario == 'status':
+        clients = [status_client(host, port, recorder, job_id, deadline) for _ in range(args.concurrency)]
+    else:
+        clients = [render_client(host, port, recorder, upload, deadline, args.poll_interval)
+                   for _ in range(args.concurrency)]
+    await asyncio.gather(*clients)
+    recorder.report(time.perf_counter() - start)
+
+
+def wait_for_server(url, process, timeout=60):
+    """Block until the server answers /health"""
+    parts = urlsplit(url)
+
+    async def probe():
+        client = Client(parts.hostname, parts.port or 80)
+        try:
+            status, _ = await client.request('GET', '/health')
+            return status == 200
+        finally:
+            await client.close()
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception("API server exited during startup")
+        try:
+            if asyncio.run(probe()):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise Exception("API server did not start in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the audio processor HTTP API")
+    parser.add_argument('--url', default='http://127.0.0.1:8502', help="Base URL of the API server")
+    parser.add_argument('--scenario', choices=['status', 'render'], default='status')
+    parser.add_argument('--concurrency', type=int, default=16, help="Concurrent client connections")
+    parser.add_argument('--duration', type=float, default=10.0, help="Test length in seconds")
+    parser.add_argument('--track-seconds', type=float, default=5.0, help="Length of the uploaded test track")
+    parser.add_argument('--poll-interval', type=float, default=0.1, help="Seconds between job status polls")
+    parser.add_argument('--start-server', action='store_true', help="Start api_server.py on --url for the test")
+    args = parser.parse_args()
+
+    server = None
+    if args.start_server:
+        parts = urlsplit(args.url)
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api_server.py'),
+             '--host', parts.hostname, '--port', str(parts.port or 80)],
+            stdout=subprocess.DEVNULL
+        )
+        wait_for_server(args.url, server)
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
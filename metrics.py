@@ -0,0 +1,349 @@
+"""Per-operation timing, CPU, byte and memory metrics.
+
+Every ``AudioProcessor`` and ``VideoDownloader`` operation runs under
+``instrumented``, which records its wall time, process CPU time, bytes in
+and out (array sizes, file sizes or buffer lengths) and whether it failed,
+for about 20 microseconds per call. One operation in every
+``MEMORY_SAMPLE_EVERY`` also traces allocations with tracemalloc and
+records its peak above the starting point. Tracing is what costs: a traced
+phase-vocoder render takes about 20% longer and a traced WSOLA render,
+with its per-frame Python loop, about four times as long, so it is
+sampled rather than always on. tracemalloc's peak covers the whole
+process, so a sample only starts while no other operation is running,
+and records no peak if another thread's operation overlapped it.
+
+Records are aggregated per operation by the process's ``MetricsRegistry``
+and exported two ways:
+
+- Prometheus text format: ``render_prometheus()``, served as
+  ``GET /metrics`` by the API server and written by ``batch.py --metrics``
+- one JSON line per record on the ``audio_metrics`` logger, sent to a file
+  or stderr with ``configure_log()`` (``--metrics-log`` on the CLIs)
+
+Job and batch worker processes hand their records to a sink set with
+``set_sink`` instead, which forwards them to the parent, so one registry
+and one log cover the whole pool. Labels set with ``labelled()`` (such as
+the job ID) go into the JSON records but not into Prometheus series;
+operations under ``unrecorded()``, such as the startup warm-up, are not
+recorded at all.
+"""
+
+import functools
+import inspect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Upper bounds of the operation duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Trace allocations for one operation in this many (0 turns memory sampling off)
+MEMORY_SAMPLE_EVERY = 50
+
+logger = logging.getLogger('audio_metrics')
+
+_local = threading.local()
+_sample_lock = threading.Lock()
+_sample_counter = 0
+# Instrumented operations running in this process, on any thread
+_in_flight = 0
+# Thread whose operation started the running memory sample, and whether
+# another thread's operation ran during it
+_sampling_thread = None
+_overlapped = False
+_sink = None
+
+
+def payload_bytes(value):
+    """Size in bytes of an array, buffer, file path, file object or tuple of them"""
+    if value is None:
+        return 0
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, (str, os.PathLike)):
+        try:
+            return os.path.getsize(value)
+        except OSError:
+            return 0
+    if isinstance(value, (tuple, list)):
+        return sum(payload_bytes(item) for item in value)
+    if hasattr(value, 'getbuffer'):
+        return value.getbuffer().nbytes
+    if hasattr(value, 'fileno'):
+        try:
+            return os.fstat(value.fileno()).st_size
+        except (OSError, ValueError):
+            return 0
+    return 0
+
+
+class MetricsRegistry:
+    """Thread-safe per-operation totals and duration histograms"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def record(self, record):
+        """Aggregate one operation record and log it as a JSON line"""
+        with self._lock:
+            totals = self._operations.get(record['operation'])
+            if totals is None:
+                totals = self._operations[record['operation']] = {
+                    'count': 0, 'errors': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                    'bytes_in': 0, 'bytes_out': 0, 'memory_samples': 0, 'peak_bytes': 0,
+                    'buckets': [0] * len(self.buckets),
+                }
+            totals['count'] += 1
+            totals['errors'] += 0 if record['ok'] else 1
+            totals['wall_seconds'] += record['wall_seconds']
+            totals['cpu_seconds'] += record['cpu_seconds']
+            totals['bytes_in'] += record['bytes_in']
+            totals['bytes_out'] += record['bytes_out']
+            if record['peak_bytes'] is not None:
+                totals['memory_samples'] += 1
+                totals['peak_bytes'] = max(totals['peak_bytes'], record['peak_bytes'])
+            for i, bound in enumerate(self.buckets):
+                if record['wall_seconds'] <= bound:
+                    totals['buckets'][i] += 1
+                    break
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(record))
+
+    def snapshot(self):
+        """operation -> copy of its totals"""
+        with self._lock:
+            return {operation: {**totals, 'buckets': list(totals['buckets'])}
+                    for operation, totals in self._operations.items()}
+
+    def render_prometheus(self):
+        """All totals in the Prometheus text exposition format"""
+        operations = sorted(self.snapshot().items())
+        lines = []
+
+        def family(name, kind, help_text, key):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for operation, totals in operations:
+                lines.append(f'{name}{{operation="{operation}"}} {totals[key]}')
+
+        lines.append("# HELP audio_operation_duration_seconds Wall time of audio and download operations")
+        lines.append("# TYPE audio_operation_duration_seconds histogram")
+        for operation, totals in operations:
+            cumulative = 0
+            for bound, count in zip(self.buckets, totals['buckets']):
+                cumulative += count
+                lines.append(f'audio_operation_duration_seconds_bucket{{operation="{operation}",le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'audio_operation_duration_seconds_bucket{{operation="{operation}",le="+Inf"}} '
+                         f'{totals["count"]}')
+            lines.append(f'audio_operation_duration_seconds_sum{{operation="{operation}"}} {totals["wall_seconds"]}')
+            lines.append(f'audio_operation_duration_seconds_count{{operation="{operation}"}} {totals["count"]}')
+        family('audio_operation_cpu_seconds_total', 'counter', "Process CPU time of operations", 'cpu_seconds')
+        family('audio_operation_errors_total', 'counter', "Operations that raised", 'errors')
+        family('audio_operation_input_bytes_total', 'counter', "Bytes of operation inputs", 'bytes_in')
+        family('audio_operation_output_bytes_total', 'counter', "Bytes of operation outputs", 'bytes_out')
+        family('audio_operation_memory_samples_total', 'counter', "Operations traced with tracemalloc",
+               'memory_samples')
+        family('audio_operation_memory_peak_bytes', 'gauge', "Largest traced allocation peak of an operation",
+               'peak_bytes')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Write render_prometheus() atomically to path, e.g. for a textfile collector"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.render_prometheus())
+        os.replace(temp_path, path)
+
+
+# The process's registry; records from worker processes are added to the parent's
+REGISTRY = MetricsRegistry()
+
+
+def record(operation_record):
+    """Hand a finished operation's record to the sink, or to this process's registry"""
+    (_sink or REGISTRY.record)(operation_record)
+
+
+def set_sink(sink):
+    """Send this process's records to sink(record) instead of REGISTRY; None restores it"""
+    global _sink
+    _sink = sink
+
+
+def set_memory_sampling(every):
+    """Trace allocations for one operation in every `every` (0 turns it off)"""
+    global MEMORY_SAMPLE_EVERY
+    MEMORY_SAMPLE_EVERY = every
+
+
+def configure_log(path=None):
+    """Log every record as a JSON line to path (appended), or to stderr when path is None or '-'"""
+    if path is None or path == '-':
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+@contextmanager
+def labelled(**labels):
+    """Add labels (e.g. job_id) to the records of operations in this block on this thread"""
+    previous = getattr(_local, 'labels', {})
+    _local.labels = {**previous, **labels}
+    try:
+        yield
+    finally:
+        _local.labels = previous
+
+
+@contextmanager
+def unrecorded():
+    """Run operations in this block on this thread without recording them, e.g. synthetic warm-up calls"""
+    previous = getattr(_local, 'unrecorded', False)
+    _local.unrecorded = True
+    try:
+        yield
+    finally:
+        _local.unrecorded = previous
+
+
+def _operation_started(top_level):
+    """Count a starting operation in; whether it starts a memory sample with tracemalloc"""
+    global _sample_counter, _in_flight, _sampling_thread, _overlapped
+    with _sample_lock:
+        _in_flight += 1
+        if _sampling_thread is not None and _sampling_thread != threading.get_ident():
+            _overlapped = True
+        # Only top-level operations start samples, and only with nothing else running
+        if not top_level or _in_flight > 1 or MEMORY_SAMPLE_EVERY <= 0 or tracemalloc.is_tracing():
+            return False
+        _sample_counter += 1
+        if _sample_counter % MEMORY_SAMPLE_EVERY:
+            return False
+        tracemalloc.start()
+        _sampling_thread = threading.get_ident()
+        _overlapped = False
+        return True
+
+
+def _operation_finished(ends_sample):
+    """Count a finished operation out; whether another thread's operation overlapped the sample"""
+    global _in_flight, _sampling_thread
+    with _sample_lock:
+        _in_flight -= 1
+        overlapped = _overlapped
+        if ends_sample:
+            tracemalloc.stop()
+            _sampling_thread = None
+        return overlapped
+
+
+class Measurement:
+    """One running operation; set bytes_in and bytes_out before it ends"""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.parent = None
+        self.starts_sample = False
+        self.traced = False
+        # Highest traced memory seen so far, including finished nested operations
+        self.peak_seen = 0
+        self.base = 0
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        self.parent = stack[-1] if stack else None
+        self.starts_sample = _operation_started(self.parent is None)
+        # Nested in a traced operation of this thread: traced too, at no extra cost
+        self.traced = self.starts_sample or (self.parent is not None and self.parent.traced)
+        if self.traced:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None and self.parent.traced:
+                self.parent.peak_seen = max(self.parent.peak_seen, peak)
+            tracemalloc.reset_peak()
+            self.base = self.peak_seen = current
+        stack.append(self)
+        self.started = time.perf_counter()
+        # Process CPU time: includes the FFT worker threads an operation fans out to
+        self.cpu_started = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        wall_seconds = time.perf_counter() - self.started
+        cpu_seconds = time.process_time() - self.cpu_started
+        _local.stack.pop()
+        peak_bytes = None
+        if self.traced:
+            peak = max(self.peak_seen, tracemalloc.get_traced_memory()[1])
+            if self.parent is not None and self.parent.traced:
+                self.parent.peak_seen = max(self.parent.peak_seen, peak)
+            peak_bytes = peak - self.base
+        if _operation_finished(self.starts_sample):
+            # Other threads' allocations are in the process-wide peak
+            peak_bytes = None
+        if getattr(_local, 'unrecorded', False):
+            return False
+
+        record({
+            'operation': self.operation,
+            # Enclosing operation, whose wall and CPU time include this one's
+            'parent': self.parent.operation if self.parent is not None else None,
+            'time': time.time(),
+            'pid': os.getpid(),
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'peak_bytes': peak_bytes,
+            'ok': exc_type is None,
+            'error': None if exc_type is None else exc_type.__name__,
+            **getattr(_local, 'labels', {}),
+        })
+        return False
+
+
+def instrumented(operation, bytes_in=None, bytes_out=None):
+    """Decorator measuring every call of a function as one operation.
+
+    bytes_in and bytes_out name the parameters whose payload_bytes() are
+    the operation's input and output; by default there is no input and the
+    output is the return value.
+    """
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Measurement(operation) as measurement:
+                arguments = None
+                if bytes_in is not None or bytes_out is not None:
+                    arguments = signature.bind(*args, **kwargs).arguments
+                if bytes_in is not None:
+                    measurement.bytes_in = payload_bytes(arguments.get(bytes_in))
+                result = func(*args, **kwargs)
+                measurement.bytes_out = payload_bytes(arguments.get(bytes_out) if bytes_out is not None else result)
+            return result
+        return wrapper
+    return decorate
+
+
+def render_prometheus():
+    """Prometheus text of this process's registry"""
+    return REGISTRY.render_prometheus()
@@ -0,0 +1,93 @@
+"""Low-latency previews of a short window of one track.
+
+While the sliders move, the app renders only ``window_seconds`` of output
+starting at a seek point instead of the whole track. The window goes
+through the same tempo -> bass chain as the full render, with a short
+pre-roll so the phase vocoder and the bass filter have settled by the time
+the audible part starts. Optionally the window is resampled to a lower
+proxy rate first, which roughly halves the cost again. The full-quality
+render still only happens on explicit export.
+"""
+
+import io
+import time
+from collections import OrderedDict
+from math import gcd
+
+import numpy as np
+
+# Input rendered before the window and dropped afterwards
+PREVIEW_PREROLL_SECONDS = 0.5
+
+# Sample rate of the fast-preview proxy
+PREVIEW_PROXY_RATE = 22050
+
+
+class PreviewRenderer:
+    """Renders short windows of one decoded track, remembering recent ones"""
+
+    def __init__(self, processor, audio_data, sample_rate, proxy_rate=PREVIEW_PROXY_RATE, max_cached=8):
+        self.processor = processor
+        self.audio_data = audio_data
+        self.sample_rate = sample_rate
+        self.proxy_rate = proxy_rate
+        self.max_cached = max_cached
+        self.last_render_seconds = None
+        self._cache = OrderedDict()
+
+    @property
+    def duration(self):
+        """Length of the track in seconds"""
+        return self.audio_data.shape[-1] / self.sample_rate
+
+    def _to_proxy(self, window):
+        """Resample a window to the proxy rate; (window, sample_rate)"""
+        from scipy import signal
+
+        if self.proxy_rate is None or self.proxy_rate >= self.sample_rate:
+            return window, self.sample_rate
+        divisor = gcd(self.proxy_rate, self.sample_rate)
+        window = signal.resample_poly(window, self.proxy_rate // divisor, self.sample_rate // divisor, axis=-1)
+        return window.astype(np.float32, copy=False), self.proxy_rate
+
+    def render(self, start_seconds, window_seconds, tempo_factor, bass_boost, quality="Standard", proxy=False):
+        """WAV bytes of window_seconds of processed output starting at start_seconds of input"""
+        key = (round(start_seconds, 2), window_seconds, tempo_factor, bass_boost, quality, proxy)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.last_render_seconds = 0.0
+            return self._cache[key]
+
+        started = time.perf_counter()
+        sample_rate = self.sample_rate
+        n_samples = self.audio_data.shape[-1]
+
+        # Input span that stretches to window_seconds of output
+        span = int(window_seconds * tempo_factor * sample_rate)
+        start = min(max(int(start_seconds * sample_rate), 0), max(n_samples - span, 0))
+        preroll = min(int(PREVIEW_PREROLL_SECONDS * sample_rate), start)
+        window = np.array(self.audio_data[..., start - preroll:start + span], dtype=np.float32)
+        if proxy:
+            # Only the window is resampled, so there's no per-track setup cost
+            window, proxy_rate = self._to_proxy(window)
+            preroll = preroll * proxy_rate // sample_rate
+            sample_rate = proxy_rate
+
+        # Same chain as a full render, on the window only
+        if tempo_factor != 1.0 and bass_boost > 0:
+            window = self.processor.change_tempo_and_boost_bass(window, sample_rate, tempo_factor, bass_boost, quality)
+        elif tempo_factor != 1.0:
+            window = self.processor.change_tempo(window, tempo_factor, quality)
+        elif bass_boost > 0:
+            window = self.processor.boost_bass(window, sample_rate, bass_boost, out=window)
+        window = window[..., int(round(preroll / tempo_factor)):]
+
+        output_buffer = io.BytesIO()
+        self.processor.save_audio(window, sample_rate, output_buffer)
+        preview = output_buffer.getvalue()
+
+        self._cache[key] = preview
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        self.last_render_seconds = time.perf_counter() - started
+        return preview
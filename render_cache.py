@@ -0,0 +1,333 @@
+"""Content-addressed on-disk caches for rendered and decoded audio.
+
+Renders are keyed by a hash of the input file bytes plus every parameter
+that affects the output (tempo, bass, quality, output format and the DSP
+engine version), so repeating a render returns the stored file without
+decoding anything.
+Decoded PCM is keyed by the input hash alone and stored as float32 ``.npy``
+files that later loads memory-map without copying, with the track's
+waveform peak pyramid in a ``.npz`` next to it.
+Downloaded audio is keyed by the extractor and video ID, so a URL pasted
+by many users is downloaded once per host; concurrent requests for one
+video wait on a lock file for the first download instead of starting
+their own, and slot lock files cap how many downloads run at once.
+
+Cache directories can be shared by several sessions and processes: writes
+are atomic renames and recency is tracked through file modification times.
+"""
+
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from audio_processor import ENGINE_VERSION, OUTPUT_FORMATS
+
+
+# Downloads running at once across every process on the host
+MAX_CONCURRENT_DOWNLOADS = 4
+
+# Lock files download keys are spread over; keys sharing one only wait for each other
+LOCK_STRIPES = 256
+
+# Seconds between attempts to take a lock file held by another process
+LOCK_POLL_SECONDS = 0.1
+
+
+def default_cache_dir(name):
+    """Per-host cache directory under the system temp dir"""
+    return os.path.join(tempfile.gettempdir(), 'ai-audio-processor', name)
+
+
+def link_or_copy(source_path, path):
+    """Hard-link source_path to path, or copy it where links aren't possible"""
+    try:
+        os.link(source_path, path)
+    except OSError:
+        # Another file system, or path exists; a missing source raises again
+        shutil.copyfile(source_path, path)
+
+
+def _try_lock(path):
+    """Open file holding an exclusive flock on path, or None while another holder has it"""
+    import fcntl
+
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+@contextmanager
+def _held(f):
+    import fcntl
+
+    try:
+        yield
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+class DiskCache:
+    """Size-bounded LRU of files in one directory, with hit/miss counters"""
+
+    def __init__(self, cache_dir, max_bytes, suffix):
+        # suffix may be a tuple when entries come in several file types
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _touch(self, path):
+        """Mark an entry as recently used for LRU eviction"""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _write_atomic(self, path, write):
+        """Call write(file) on a temp file, then rename it into place"""
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        self.evict()
+
+    def _entries(self):
+        """(mtime, size, name) of every entry currently in the cache"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                # Removed by another process meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits its budget"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        """Hit/miss counters and current size of the cache"""
+        entries = self._entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+        }
+
+
+class RenderCache(DiskCache):
+    """Size-bounded LRU cache of rendered outputs stored as files, one extension per format"""
+
+    def __init__(self, cache_dir=None, max_bytes=2 * 1024**3):
+        suffixes = tuple(sorted({extension for _, _, _, extension, _ in OUTPUT_FORMATS.values()}))
+        super().__init__(cache_dir or default_cache_dir('renders'), max_bytes, suffixes)
+
+    def make_key(self, input_digest, tempo_factor, bass_boost, quality, output_format):
+        """Cache key for rendering the input with this content digest and settings"""
+        params = (f"{input_digest}|{float(tempo_factor)!r}|{float(bass_boost)!r}|{quality}|{output_format}"
+                  f"|{ENGINE_VERSION}")
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def path_for(self, key, output_format):
+        """File path an entry with this key is stored under"""
+        return os.path.join(self.cache_dir, key + OUTPUT_FORMATS[output_format][3])
+
+    def get_path(self, key, output_format):
+        """Path of the cached file for key, or None on a miss.
+
+        The file is served from where it is rather than read into memory;
+        it stays valid until evicted.
+        """
+        path = self.path_for(key, output_format)
+        if not os.path.exists(path):
+            self._count(hit=False)
+            return None
+
+        self._touch(path)
+        self._count(hit=True)
+        return path
+
+    def put_file(self, key, source_path, output_format):
+        """Copy the file at source_path in under key and evict old entries beyond the byte budget"""
+        if os.path.getsize(source_path) > self.max_bytes:
+            return None
+        path = self.path_for(key, output_format)
+
+        def copy(f):
+            with open(source_path, 'rb') as source:
+                shutil.copyfileobj(source, f)
+
+        self._write_atomic(path, copy)
+        return path
+
+
+class DecodeCache(DiskCache):
+    """Decoded PCM stored once as float32 .npy and memory-mapped on later loads"""
+
+    def __init__(self, cache_dir=None, max_bytes=8 * 1024**3):
+        super().__init__(cache_dir or default_cache_dir('decoded'), max_bytes, ('.npy', '.npz'))
+
+    def _path(self, digest, sample_rate):
+        # The sample rate is part of the name, as .npy has no room for metadata
+        return os.path.join(self.cache_dir, f"{digest}.{sample_rate}.npy")
+
+    def load(self, digest):
+        """Return (read-only memmap, sample_rate) for digest, or None on a miss"""
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), f"{digest}.*.npy")):
+            try:
+                audio_data = np.load(path, mmap_mode='r')
+            except (OSError, ValueError):
+                continue
+            self._touch(path)
+            self._count(hit=True)
+            return audio_data, int(path.rsplit('.', 2)[1])
+
+        self._count(hit=False)
+        return None
+
+    def contains(self, digest):
+        """Whether decoded audio for digest is cached, without counting a hit or miss"""
+        return bool(glob.glob(os.path.join(glob.escape(self.cache_dir), f"{digest}.*.npy")))
+
+    def store(self, digest, audio_data, sample_rate):
+        """Save decoded audio as float32 .npy under digest"""
+        audio_data = np.asarray(audio_data, dtype=np.float32)
+        if audio_data.nbytes > self.max_bytes:
+            return
+        self._write_atomic(self._path(digest, sample_rate), lambda f: np.save(f, audio_data))
+
+    def load_peaks(self, digest):
+        """Dict of the arrays stored by store_peaks for digest, or None on a miss"""
+        path = os.path.join(self.cache_dir, f"{digest}.peaks.npz")
+        try:
+            with np.load(path) as arrays:
+                peaks = dict(arrays)
+        except (OSError, ValueError):
+            self._count(hit=False)
+            return None
+        self._touch(path)
+        self._count(hit=True)
+        return peaks
+
+    def store_peaks(self, digest, arrays):
+        """Save a track's waveform peak arrays (see waveform.PeakPyramid) under digest"""
+        self._write_atomic(os.path.join(self.cache_dir, f"{digest}.peaks.npz"), lambda f: np.savez(f, **arrays))
+
+
+class DownloadCache(DiskCache):
+    """Downloaded audio shared by every process on the host, one file per video"""
+
+    def __init__(self, cache_dir=None, max_bytes=4 * 1024**3, max_downloads=MAX_CONCURRENT_DOWNLOADS):
+        super().__init__(cache_dir or default_cache_dir('downloads'), max_bytes, '.download')
+        self.max_downloads = max_downloads
+        # flock files: held by whoever downloads a key, or by a running download
+        self.lock_dir = os.path.join(self.cache_dir, 'locks')
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def make_key(self, video_key, audio_format=None):
+        """Cache key of a video_downloader.download_key() in its native container or transcoded to audio_format"""
+        return hashlib.sha256(f"{video_key}|{audio_format or 'native'}".encode()).hexdigest()
+
+    def _paths(self, key):
+        # The container's extension is part of the name, e.g. <key>.m4a.download
+        return glob.glob(os.path.join(glob.escape(self.cache_dir), f"{key}.*.download"))
+
+    def fetch(self, key, path):
+        """Link the file cached under key to path plus its extension; that path, or None on a miss"""
+        for cached_path in self._paths(key):
+            extension = cached_path[len(os.path.join(self.cache_dir, key)):-len('.download')]
+            try:
+                link_or_copy(cached_path, path + extension)
+            except FileNotFoundError:
+                # Evicted meanwhile
+                continue
+            self._touch(cached_path)
+            self._count(hit=True)
+            return path + extension
+
+        self._count(hit=False)
+        return None
+
+    def put_file(self, key, source_path):
+        """Link (or copy) the downloaded file at source_path in under key and evict beyond the byte budget"""
+        if os.path.getsize(source_path) > self.max_bytes:
+            return None
+        path = os.path.join(self.cache_dir, f"{key}{os.path.splitext(source_path)[1] or '.bin'}.download")
+        temp_path = os.path.join(self.cache_dir, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            link_or_copy(source_path, temp_path)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        self.evict()
+        return path
+
+    def _wait_for(self, paths, wait):
+        """Lock the first free file of paths, calling wait() between attempts"""
+        while True:
+            for path in paths:
+                f = _try_lock(path)
+                if f is not None:
+                    return f
+            if wait is not None:
+                wait()
+            time.sleep(LOCK_POLL_SECONDS)
+
+    def single_flight(self, key, wait=None):
+        """Context holding key's lock across the host: look up, and download on a miss, inside it.
+
+        A concurrent holder is downloading the same video, so waiting and
+        then looking up again finds its file. wait() is called while
+        blocked, e.g. to check for cancellation.
+        """
+        stripe = int(key[:8], 16) % LOCK_STRIPES
+        return _held(self._wait_for([os.path.join(self.lock_dir, f"key{stripe}.lock")], wait))
+
+    def download_slot(self, wait=None):
+        """Context holding one of max_downloads slots shared by every process on the host"""
+        paths = [os.path.join(self.lock_dir, f"slot{i}.lock") for i in range(self.max_downloads)]
+        return _held(self._wait_for(paths, wait))
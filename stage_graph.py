@@ -0,0 +1,212 @@
+"""Incremental processing graph with memoized stage outputs.
+
+The render chain is modeled as a small DAG: decode -> tempo -> bass. Every
+stage output is stored under a fingerprint of its inputs' fingerprints and
+its own parameters, so changing a downstream parameter (the bass slider)
+only re-runs the downstream stages and reuses the slow phase-vocoder output.
+
+When tempo and bass both apply, the quality uses the phase vocoder and the
+boost is small enough to fuse with parity, renders target the fused decode -> tempo_bass stage instead, which applies
+the bass boost inside the stretch in a single pass (see ``render_plan``).
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from audio_processor import ENGINE_VERSION, fuses_tempo_and_bass
+
+
+def _value_nbytes(value):
+    """Approximate memory held by a stage output"""
+    if isinstance(value, np.memmap):
+        # File-backed pages, not process memory
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_value_nbytes(item) for item in value)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return 0
+
+
+def _freeze(value):
+    """Make cached arrays read-only so no later stage can modify them in place"""
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _freeze(item)
+    return value
+
+
+class IntermediateCache:
+    """Thread-safe in-memory LRU of stage outputs with a byte budget"""
+
+    def __init__(self, max_bytes=512 * 1024**2):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint):
+        """Return the stored value, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(fingerprint)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, fingerprint, value):
+        """Store value and evict least recently used entries over budget"""
+        size = _value_nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if fingerprint in self._entries:
+                self._bytes -= self._entries.pop(fingerprint)[1]
+            self._entries[fingerprint] = (_freeze(value), size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class StageGraph:
+    """DAG of named stages whose outputs are memoized by fingerprint"""
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else IntermediateCache()
+        self.stages = {}
+
+    def add_source(self, name):
+        """Register an input whose value and fingerprint are passed to run()"""
+        self.stages[name] = (None, ())
+
+    def add_stage(self, name, func, inputs=()):
+        """Register func(*input_values, **params) as stage name"""
+        for input_name in inputs:
+            if input_name not in self.stages:
+                raise ValueError(f"Unknown input stage '{input_name}' for '{name}'")
+        self.stages[name] = (func, tuple(inputs))
+
+    def fingerprint(self, name, input_fingerprints, params):
+        """Fingerprint of a stage run: its inputs, parameters and the engine version"""
+        parts = [ENGINE_VERSION, name] + list(input_fingerprints)
+        parts += [f"{key}={params[key]!r}" for key in sorted(params)]
+        return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+    def run(self, target, sources, params, on_stage=None):
+        """Evaluate target, re-running only stages whose fingerprint changed.
+
+        sources maps source names to (value, fingerprint) pairs, params maps
+        stage names to keyword arguments, and on_stage(name, cached) is
+        called as each stage is resolved.
+        """
+        resolved = dict(sources)
+        return self._resolve(target, resolved, params, on_stage)[0]
+
+    def _resolve(self, name, resolved, params, on_stage):
+        if name in resolved:
+            return resolved[name]
+
+        func, inputs = self.stages[name]
+        if func is None:
+            raise ValueError(f"No value given for source '{name}'")
+        upstream = [self._resolve(input_name, resolved, params, on_stage) for input_name in inputs]
+        stage_params = params.get(name, {})
+        fingerprint = self.fingerprint(name, [fp for _, fp in upstream], stage_params)
+
+        value = self.cache.get(fingerprint)
+        cached = value is not None
+        if on_stage is not None:
+            on_stage(name, cached)
+        if not cached:
+            input_values = [item for item, _ in upstream]
+            value = func(*input_values, **stage_params)
+            # Pass-through stages hand back their input, which is cached already
+            if not any(value is input_value for input_value in input_values):
+                self.cache.put(fingerprint, value)
+
+        resolved[name] = (value, fingerprint)
+        return resolved[name]
+
+
+def build_render_graph(processor, cache=None, progress=None):
+    """The decode -> tempo -> bass chain used by process_audio.
+
+    progress, if given, is called as progress(stage, fraction) while the
+    tempo or tempo_bass stage runs.
+    """
+    graph = StageGraph(cache)
+
+    def stage_progress(name):
+        return (lambda fraction: progress(name, fraction)) if progress is not None else None
+
+    def decode(source):
+        path, digest = source
+        return processor.load_audio(path, digest=digest)
+
+    def tempo(decoded, tempo_factor, quality):
+        audio_data, sample_rate = decoded
+        if tempo_factor == 1.0:
+            return decoded
+        return processor.change_tempo(audio_data, tempo_factor, quality, progress=stage_progress('tempo')), sample_rate
+
+    def bass(stretched, bass_boost):
+        audio_data, sample_rate = stretched
+        if bass_boost <= 0:
+            return stretched
+        return processor.boost_bass(audio_data, sample_rate, bass_boost), sample_rate
+
+    def tempo_bass(decoded, tempo_factor, quality, bass_boost):
+        audio_data, sample_rate = decoded
+        return processor.change_tempo_and_boost_bass(
+            audio_data, sample_rate, tempo_factor, bass_boost, quality, progress=stage_progress('tempo_bass')
+        ), sample_rate
+
+    graph.add_source('input')
+    graph.add_stage('decode', decode, inputs=['input'])
+    graph.add_stage('tempo', tempo, inputs=['decode'])
+    graph.add_stage('bass', bass, inputs=['tempo'])
+    graph.add_stage('tempo_bass', tempo_bass, inputs=['decode'])
+    return graph
+
+
+def render_plan(tempo_factor, bass_boost, quality):
+    """(target stage, params) that render these settings with build_render_graph.
+
+    The fused tempo_bass stage is the target when both effects apply, the
+    quality's engine can take the bass boost as a spectral gain and the
+    boost is within FUSED_MAX_BOOST_DB; otherwise it is bass, after tempo.
+    """
+    params = {
+        'tempo': {'tempo_factor': tempo_factor, 'quality': quality},
+        'bass': {'bass_boost': bass_boost},
+        'tempo_bass': {'tempo_factor': tempo_factor, 'quality': quality, 'bass_boost': bass_boost},
+    }
+    fused = fuses_tempo_and_bass(tempo_factor, bass_boost, quality)
+    return ('tempo_bass' if fused else 'bass'), params
@@ -0,0 +1,230 @@
+"""Cold-start warm-up and a startup profile.
+
+    python startup.py
+    python startup.py --json startup.json
+
+The app's modules import scipy.signal, scipy.fft, librosa and yt-dlp in
+the functions that use them, so importing them takes a fraction of a
+second; librosa is only needed at all to decode containers libsndfile
+can't read (m4a, webm). What is left of a cold start (the scipy imports
+and the first FFT plans) is paid by ``warm_up``, which pushes a
+tiny synthetic clip through decode, every tempo engine, both bass
+boosts and every encoder. ``start_warm_up`` runs it once per process on a daemon
+thread: job workers start it as they are spawned, and the app when its
+server starts. A request that arrives mid-warm-up shares the work, since
+Python imports each module once under a lock.
+
+The profile reports how long each entry module and each deferred library
+takes to import in a fresh interpreter, and the latency of a first render
+request (decode, tempo and bass, encode of a few seconds of audio) in a
+cold process, after the warm-up, and once steady.
+"""
+
+import argparse
+import importlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import metrics
+
+# Modules the app, the API server and job workers import at startup
+ENTRY_MODULES = ('audio_processor', 'video_downloader', 'render_cache', 'jobs', 'preview', 'estimator', 'batch',
+                 'api_server')
+
+# Libraries imported on first use instead
+DEFERRED_MODULES = ('scipy.signal', 'scipy.fft', 'librosa.core.audio', 'yt_dlp')
+
+# Length of the warm-up clip: a few FFT frames of every engine
+WARM_UP_SAMPLES = 8192
+
+# Length of the profiled render request
+REQUEST_SECONDS = 5.0
+
+_warm_up_lock = threading.Lock()
+_warm_up_thread = None
+# Warm-up step -> seconds, filled in as the warm-up runs
+_warm_up_steps = {}
+
+
+def warm_up(processor=None):
+    """Import and exercise every stage of the chain on a tiny clip; step -> seconds"""
+    import numpy as np
+    import soundfile as sf
+
+    from audio_processor import FUSED_MAX_BOOST_DB, OUTPUT_FORMATS, QUALITIES, QUALITY_ENGINES, AudioProcessor
+
+    processor = processor or AudioProcessor()
+    steps = {}
+
+    def step(name, func):
+        started = time.perf_counter()
+        func()
+        steps[name] = _warm_up_steps[name] = time.perf_counter() - started
+
+    rng = np.random.default_rng(0)
+    clip = (0.1 * rng.standard_normal((2, WARM_UP_SAMPLES))).astype(processor.dtype)
+    # Synthetic calls: kept out of the exported operation counts and latencies
+    with metrics.unrecorded():
+        fd, path = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        try:
+            sf.write(path, clip.T, 44100)
+            step('decode', lambda: processor.load_audio(path))
+        finally:
+            os.unlink(path)
+        for quality in QUALITIES:
+            step(f'tempo/{quality}', lambda quality=quality: processor.change_tempo(clip, 0.8, quality))
+            if QUALITY_ENGINES[quality][0].spectral:
+                step(f'tempo_bass/{quality}',
+                     lambda quality=quality: processor.change_tempo_and_boost_bass(
+                         clip, 44100, 0.8, FUSED_MAX_BOOST_DB, quality))
+        step('bass', lambda: processor.boost_bass(clip, 44100, 6))
+        step('bass_hq', lambda: processor.apply_high_quality_bass_boost(clip, 44100, 6))
+        for output_format in OUTPUT_FORMATS:
+            step(f'save/{output_format}',
+                 lambda output_format=output_format: processor.save_audio(clip, 44100, io.BytesIO(), output_format))
+        step('stream_renderer', lambda: importlib.import_module('stream_renderer'))
+    return steps
+
+
+def _background_warm_up(processor):
+    try:
+        warm_up(processor)
+    except Exception:
+        # Only a head start: whatever failed here fails again, reported, in the request that needs it
+        pass
+
+
+def start_warm_up(processor=None):
+    """Run warm_up once per process on a daemon thread; returns the thread"""
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=_background_warm_up, args=(processor,), name='warm-up',
+                                               daemon=True)
+            _warm_up_thread.start()
+        return _warm_up_thread
+
+
+def wait_warm_up(timeout=None):
+    """Block until a started warm-up has finished; False if it is still running"""
+    thread = _warm_up_thread
+    if thread is None:
+        return True
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+def warm_up_steps():
+    """Seconds of every warm-up step that has finished in this process"""
+    return dict(_warm_up_steps)
+
+
+def _import_seconds(module):
+    """Seconds to import module in a fresh interpreter"""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def _request(processor, path):
+    """One render request: decode, tempo with bass, encode"""
+    audio_data, sample_rate = processor.load_audio(path)
+    processed = processor.change_tempo_and_boost_bass(audio_data, sample_rate, 0.8, 6)
+    processor.save_audio(processed, sample_rate, io.BytesIO(), 'ogg')
+
+
+def measure_requests(warm):
+    """Latency of the first and a later request in this (fresh) process"""
+    import numpy as np
+    import soundfile as sf
+
+    from audio_processor import AudioProcessor
+
+    started = time.perf_counter()
+    processor = AudioProcessor()
+    warm_up_seconds = None
+    if warm:
+        start_warm_up()
+        wait_warm_up()
+        warm_up_seconds = time.perf_counter() - started
+
+    rng = np.random.default_rng(1)
+    t = np.arange(int(REQUEST_SECONDS * 44100)) / 44100
+    clip = (0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * rng.standard_normal((2, t.size))).astype(np.float32)
+    fd, path = tempfile.mkstemp(suffix='.flac')
+    os.close(fd)
+    try:
+        sf.write(path, clip.T, 44100)
+        timings = []
+        for _ in range(3):
+            started = time.perf_counter()
+            _request(processor, path)
+            timings.append(time.perf_counter() - started)
+    finally:
+        os.unlink(path)
+    return {'first': timings[0], 'steady': min(timings[1:]), 'warm_up': warm_up_seconds,
+            'steps': warm_up_steps()}
+
+
+def _fresh_requests(warm):
+    """measure_requests in a fresh interpreter"""
+    command = [sys.executable, os.path.abspath(__file__), '--measure-requests']
+    if warm:
+        command.append('--warm')
+    result = subprocess.run(command, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def profile():
+    """Import times of entry and deferred modules and cold/warm first-request latency"""
+    return {
+        'imports': {module: _import_seconds(module) for module in ENTRY_MODULES},
+        'deferred': {module: _import_seconds(module) for module in DEFERRED_MODULES},
+        'cold': _fresh_requests(warm=False),
+        'warm': _fresh_requests(warm=True),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile import time and first-request latency")
+    parser.add_argument('--json', metavar='PATH', help="Also write the profile to PATH as JSON")
+    parser.add_argument('--measure-requests', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--warm', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_requests:
+        print(json.dumps(measure_requests(args.warm)))
+        return
+
+    results = profile()
+    print("Import time in a fresh interpreter:")
+    for module, seconds in results['imports'].items():
+        print(f"  {module:>20} {seconds * 1000:7.0f} ms")
+    print("Deferred until first use:")
+    for module, seconds in results['deferred'].items():
+        print(f"  {module:>20} {seconds * 1000:7.0f} ms")
+    print(f"Render request of {REQUEST_SECONDS:g}s of audio:")
+    cold, warm = results['cold'], results['warm']
+    print(f"  {'cold first':>20} {cold['first'] * 1000:7.0f} ms")
+    print(f"  {'warmed-up first':>20} {warm['first'] * 1000:7.0f} ms (after a {warm['warm_up'] * 1000:.0f} ms warm-up)")
+    print(f"  {'steady':>20} {cold['steady'] * 1000:7.0f} ms")
+    print("Warm-up steps:")
+    for name, seconds in warm['steps'].items():
+        print(f"  {name:>20} {seconds * 1000:7.0f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
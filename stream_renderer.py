@@ -0,0 +1,512 @@
+"""Block-streaming render pipeline.
+
+Renders a file through the same tempo -> bass -> gain chain as
+``app.process_audio`` without ever holding the whole track in memory.
+Blocks are read with soundfile (or, for containers libsndfile can't read
+such as m4a and webm, from audioread's decoder the way ``librosa.load``
+decodes them), pushed through stages that keep their state between blocks, and encoded into the output format as they are
+ready through ``AudioEncoder``.
+
+Peak normalization needs the peak of the whole output, so when the bass
+stage is active the chain renders into a temporary float file first and
+a second pass applies the gain. Both passes work block by block.
+
+Tolerance: the streamed output matches the whole-array path
+(``AudioProcessor.change_tempo`` / ``boost_bass`` / ``save_audio``) to
+within one 16-bit LSB per sample (absolute error <= 2**-15), for every
+quality option and PCM or FLAC output, with the same dither. The only
+differences come from the float32 intermediate file used for the gain
+pass (float64 with ``precision='mastering'``); OGG output is lossy and
+only matches to the codec's accuracy.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import soundfile as sf
+from scipy import signal
+
+from audio_processor import (
+    DEFAULT_OUTPUT_FORMATS, PRECISIONS, QUALITY_ENGINES, WSOLA, AudioEncoder, BassBoostFilter, PhaseVocoder,
+    VinylResampler, _zero_padded, fuses_tempo_and_bass, speed_ratio
+)
+from metrics import instrumented
+
+
+class StreamingTimeStretcher:
+    """Stateful phase vocoder that stretches audio one block at a time.
+
+    Runs the same ``PhaseVocoder`` kernel as ``AudioProcessor.change_tempo``
+    but only keeps a few frames of history between calls: pending input
+    samples, the analysis frames later steps still need, the shared phase
+    accumulator and the overlap-add tail. Buffers use ``dtype``, as in
+    ``PhaseVocoder``.
+    """
+
+    def __init__(self, channels, rate, hop_length=512, n_fft=2048, workers=-1, spectral_gain=None,
+                 dtype=np.float32):
+        self.channels = channels
+        self.rate = float(rate)
+        self.vocoder = PhaseVocoder(hop_length=hop_length, n_fft=n_fft, workers=workers, dtype=dtype,
+                                    spectral_gain=spectral_gain)
+        self.dtype = self.vocoder.dtype
+        self.complex_dtype = self.vocoder.complex_dtype
+        self.hop_length = hop_length
+        self.n_fft = n_fft
+
+        # Input side: samples waiting to be framed, starting with the
+        # n_fft // 2 zeros of a centered STFT
+        self._pending = np.zeros((channels, n_fft // 2), dtype=self.dtype)
+        self._samples_in = 0
+        self._frames_in = 0
+
+        # Phase vocoder state: analysis frames not yet consumed, indexed
+        # from ``_frame_base``
+        self._frames = np.zeros((channels, 1 + n_fft // 2, 0), dtype=self.complex_dtype)
+        self._frame_base = 0
+        self._step = 0
+        self._phase_acc = None
+
+        # Synthesis side: overlap-add tail and window envelope tail
+        self._ola = np.zeros((channels, n_fft - hop_length), dtype=self.dtype)
+        self._ola_norm = np.zeros(n_fft - hop_length, dtype=self.dtype)
+        self._trim = n_fft // 2
+        self._samples_out = 0
+
+    def process(self, block):
+        """Push a (channels, samples) block and return the finished output"""
+        self._samples_in += block.shape[-1]
+        self._pending = np.concatenate([self._pending, block.astype(self.dtype, copy=False)], axis=-1)
+        self._analyze(final=False)
+        return self._synthesize(self._vocode(final=False))
+
+    def flush(self):
+        """Finish the stream and return the remaining output samples"""
+        # Trailing zero padding of a centered STFT
+        self._pending = np.concatenate(
+            [self._pending, np.zeros((self.channels, self.n_fft // 2), dtype=self.dtype)], axis=-1
+        )
+        self._analyze(final=True)
+        output = self._synthesize(self._vocode(final=True), final=True)
+
+        # Trim or pad to the length of the whole-array stretch
+        remaining = int(round(self._samples_in / self.rate)) - (self._samples_out - output.shape[-1])
+        if output.shape[-1] > remaining:
+            output = output[:, :max(remaining, 0)]
+        elif output.shape[-1] < remaining:
+            output = np.pad(output, ((0, 0), (0, remaining - output.shape[-1])))
+        return output
+
+    def _analyze(self, final):
+        """Turn pending input samples into STFT frames"""
+        n_fft, hop = self.n_fft, self.hop_length
+        available = (self._pending.shape[-1] - n_fft) // hop + 1
+        if final:
+            # A centered STFT has exactly 1 + len(y) // hop frames
+            available = min(available, 1 + self._samples_in // hop - self._frames_in)
+        if available <= 0:
+            return
+
+        spectrum = self.vocoder.analyze(self._pending, 0, available)
+        self._frames = np.concatenate([self._frames, spectrum], axis=-1)
+        self._pending = self._pending[:, available * hop:]
+        self._frames_in += available
+
+    def _vocode(self, final):
+        """Run the phase vocoder over every step whose frames are available"""
+        if final:
+            # Two zero columns simplify the boundary
+            zeros = np.zeros(self._frames.shape[:-1] + (2,), dtype=self.complex_dtype)
+            self._frames = np.concatenate([self._frames, zeros], axis=-1)
+            last_step = int(np.ceil(self._frames_in / self.rate))
+        else:
+            # Step t needs frames floor(t * rate) and floor(t * rate) + 1
+            last_frame = self._frame_base + self._frames.shape[-1] - 2
+            last_step = int(np.floor(last_frame / self.rate)) + 1 if last_frame >= 0 else 0
+            while last_step > self._step and int((last_step - 1) * self.rate) > last_frame:
+                last_step -= 1
+
+        if last_step <= self._step:
+            return np.zeros(self._frames.shape[:-1] + (0,), dtype=self.complex_dtype)
+
+        steps = np.arange(self._step, last_step) * self.rate
+        stretched, self._phase_acc = self.vocoder.vocode(self._frames, steps - self._frame_base, self._phase_acc)
+        self._step = last_step
+
+        # Drop frames no later step can reach
+        consumed = int(self._step * self.rate) - self._frame_base
+        if consumed > 0:
+            self._frames = self._frames[..., consumed:]
+            self._frame_base += consumed
+        return stretched
+
+    def _synthesize(self, spectrum, final=False):
+        """Overlap-add stretched frames and return the finished samples"""
+        hop = self.hop_length
+        n_columns = spectrum.shape[-1]
+        tail = self._ola.shape[-1]
+
+        buffer = np.zeros((self.channels, n_columns * hop + tail), dtype=self.dtype)
+        norm = np.zeros(buffer.shape[-1], dtype=self.dtype)
+        buffer[:, :tail] = self._ola
+        norm[:tail] = self._ola_norm
+        self.vocoder.synthesize(spectrum, buffer)
+        self.vocoder.envelope(n_columns, norm)
+
+        # Everything before the last n_fft - hop samples is final
+        finished = buffer.shape[-1] if final else n_columns * hop
+        output = buffer[:, :finished]
+        self._ola = buffer[:, finished:].copy()
+        self._ola_norm = norm[finished:].copy()
+
+        # Normalize by the sum of squared windows
+        norm = norm[:finished]
+        nonzero = norm > np.finfo(self.dtype).tiny
+        output[:, nonzero] /= norm[nonzero]
+
+        # Drop the n_fft // 2 samples contributed by the centering pad
+        if self._trim:
+            trimmed = min(self._trim, output.shape[-1])
+            output = output[:, trimmed:]
+            self._trim -= trimmed
+
+        self._samples_out += output.shape[-1]
+        return output
+
+
+class StreamingWSOLA:
+    """WSOLA time stretch ("Fast") applied one block at a time.
+
+    Frames are processed as soon as all the input they can read has
+    arrived, with the same ``WSOLA`` search and overlap-add as
+    ``AudioProcessor.change_tempo``, so the output samples are the same.
+    Between calls only the input later frames can still read, the search
+    state and the overlap-add tail are kept.
+    """
+
+    def __init__(self, channels, rate, frame_length=2048, tolerance=512, workers=-1, dtype=np.float32):
+        self.channels = channels
+        self.rate = float(rate)
+        self.wsola = WSOLA(frame_length, tolerance, workers=workers, dtype=dtype)
+        self.dtype = self.wsola.dtype
+
+        # Input kept for later frames, starting at input sample _base
+        self._input = np.zeros((channels, 0), dtype=self.dtype)
+        self._base = 0
+        self._samples_in = 0
+
+        self._frame = 0
+        self._shift = None
+        self._ola = np.zeros((channels, self.wsola.hop_length), dtype=self.dtype)
+        self._trim = frame_length // 2
+        self._samples_out = 0
+
+    def process(self, block):
+        """Push a (channels, samples) block and return the finished output"""
+        self._samples_in += block.shape[-1]
+        self._input = np.concatenate([self._input, block.astype(self.dtype, copy=False)], axis=-1)
+
+        # Frames whose whole input span has arrived
+        wsola = self.wsola
+        reach = 2 * wsola.tolerance + wsola.frame_length // 2
+        last = max(int((self._samples_in - reach) / (wsola.hop_length * self.rate)) + 2, self._frame)
+        while last > self._frame and wsola.input_span(last - 1, last, self.rate)[1] > self._samples_in:
+            last -= 1
+        return self._run(last)
+
+    def flush(self):
+        """Finish the stream and return the remaining output samples"""
+        length = int(round(self._samples_in / self.rate))
+        output = self._run(-(-length // self.wsola.hop_length) + 1, final=True)
+
+        # Trim or pad to the length of the whole-array stretch
+        remaining = length - (self._samples_out - output.shape[-1])
+        if output.shape[-1] > remaining:
+            output = output[:, :max(remaining, 0)]
+        elif output.shape[-1] < remaining:
+            output = np.pad(output, ((0, 0), (0, remaining - output.shape[-1])))
+        return output
+
+    def _run(self, last, final=False):
+        """Search and overlap-add frames up to last, and return the finished samples"""
+        wsola = self.wsola
+        hop = wsola.hop_length
+        n_frames = max(last - self._frame, 0)
+
+        buffer = np.zeros((self.channels, (n_frames + 1) * hop), dtype=self.dtype)
+        buffer[:, :hop] = self._ola
+        if n_frames:
+            lo, hi = wsola.input_span(self._frame, last, self.rate)
+            segment = _zero_padded(self._input, lo - self._base, hi - self._base, self.dtype)
+            positions, self._shift = wsola.choose_positions(
+                segment.mean(axis=0), lo, np.arange(self._frame, last), self.rate, self._shift
+            )
+            wsola.synthesize(segment, lo, positions, buffer)
+            self._frame = last
+
+            # Drop input no later frame reads
+            consumed = wsola.input_span(last, last + 1, self.rate)[0] - self._base
+            if consumed > 0:
+                self._input = self._input[:, consumed:]
+                self._base += consumed
+
+        # Everything before the last hop samples is final
+        finished = buffer.shape[-1] if final else n_frames * hop
+        output = buffer[:, :finished]
+        self._ola = buffer[:, finished:].copy()
+
+        # Drop the half frame before the first frame's center
+        if self._trim:
+            trimmed = min(self._trim, output.shape[-1])
+            output = output[:, trimmed:]
+            self._trim -= trimmed
+
+        self._samples_out += output.shape[-1]
+        return output
+
+
+class StreamingResampler:
+    """Polyphase "Vinyl" speed change applied one block at a time.
+
+    Each chunk is resampled together with ``context`` input samples on both
+    sides, longer than half of ``resample_poly``'s default filter, and only
+    the outputs whose taps fall inside the chunk are kept. That gives the
+    same samples as ``AudioProcessor.change_speed`` on the whole signal.
+    Chunks start on multiples of the ratio's numerator so every kept output
+    lands on the same sample grid.
+    """
+
+    def __init__(self, channels, rate, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        ratio = speed_ratio(rate)
+        self.up, self.down = ratio.denominator, ratio.numerator
+
+        # resample_poly's default filter is 10 * max(up, down) taps per side at the upsampled rate
+        half_taps = 10 * max(self.up, self.down) // self.up + 2
+        self.context = self.down * -(-half_taps // self.down)
+
+        # Zeros before the first sample, as resample_poly pads
+        self._history = np.zeros((channels, self.context), dtype=self.dtype)
+        self._pending = np.zeros((channels, 0), dtype=self.dtype)
+        self._samples_in = 0
+        self._samples_out = 0
+
+    def process(self, block):
+        """Push a (channels, samples) block and return the finished output"""
+        self._samples_in += block.shape[-1]
+        self._pending = np.concatenate([self._pending, block.astype(self.dtype, copy=False)], axis=-1)
+        # Keep context samples of look-ahead for the last outputs
+        ready = (self._pending.shape[-1] - self.context) // self.down * self.down
+        if ready <= 0:
+            return np.zeros((self._pending.shape[0], 0), dtype=self.dtype)
+        return self._emit(ready)
+
+    def flush(self):
+        """Finish the stream and return the remaining output samples"""
+        ready = -(-self._pending.shape[-1] // self.down) * self.down
+        self._pending = np.pad(self._pending, ((0, 0), (0, ready + self.context - self._pending.shape[-1])))
+        output = self._emit(ready)
+        remaining = -(-self._samples_in * self.up // self.down) - (self._samples_out - output.shape[-1])
+        return output[:, :max(remaining, 0)]
+
+    def _emit(self, ready):
+        """Resample the next ready pending samples"""
+        chunk = np.concatenate([self._history, self._pending[:, :ready + self.context]], axis=-1)
+        resampled = signal.resample_poly(chunk, self.up, self.down, axis=-1)
+        first = self.context * self.up // self.down
+        output = resampled[:, first:first + ready * self.up // self.down].astype(self.dtype, copy=False)
+
+        self._history = chunk[:, ready:ready + self.context]
+        self._pending = self._pending[:, ready:]
+        self._samples_out += output.shape[-1]
+        return output
+
+
+class PeakTracker:
+    """Running peak over all channels, used for the normalization gain stage"""
+
+    def __init__(self):
+        self.peak = 0.0
+
+    def process(self, block):
+        if block.shape[-1]:
+            self.peak = max(self.peak, float(np.max(np.abs(block))))
+        return block
+
+    def gain(self, target_peak=0.95):
+        """Gain that brings the overall peak to target_peak"""
+        if self.peak > 0:
+            return target_peak / self.peak
+        return 1.0
+
+
+class AudioreadSource:
+    """Blocks of a file decoded by audioread, for containers libsndfile can't read (m4a, webm).
+
+    Has the part of soundfile.SoundFile that StreamRenderer reads from;
+    samples are scaled from int16 as librosa.load scales them. frames is
+    derived from the decoder's duration, so it may be off by a few.
+    """
+
+    def __init__(self, path):
+        import audioread
+
+        self._file = audioread.audio_open(path)
+        self.samplerate = self._file.samplerate
+        self.channels = self._file.channels
+        self.frames = int(round(self._file.duration * self.samplerate))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._file.close()
+        return False
+
+    def blocks(self, blocksize, dtype='float32', always_2d=True):
+        """(blocksize, channels) arrays in order; the last one may be shorter"""
+        pending = np.zeros((0, self.channels), dtype=dtype)
+        for buffer in self._file:
+            samples = np.frombuffer(buffer, dtype='<i2').reshape(-1, self.channels).astype(dtype) / 32768
+            pending = np.concatenate([pending, samples])
+            while pending.shape[0] >= blocksize:
+                yield pending[:blocksize]
+                pending = pending[blocksize:]
+        if pending.shape[0]:
+            yield pending
+
+
+def open_audio(path):
+    """Block source for path: soundfile.SoundFile, or an AudioreadSource for other containers"""
+    try:
+        return sf.SoundFile(path)
+    except RuntimeError:
+        return AudioreadSource(path)
+
+
+def stream_duration(path):
+    """Seconds of audio in a file libsndfile can't read, from audioread; None if it can't be opened"""
+    try:
+        with AudioreadSource(path) as source:
+            return source.frames / source.samplerate
+    except Exception:
+        return None
+
+
+class StreamRenderer:
+    """Render a file through tempo, bass and gain stages in constant memory.
+
+    precision is a key of PRECISIONS, as for AudioProcessor: every stage
+    and the intermediate file of the gain pass work in its dtype.
+    """
+
+    def __init__(self, block_size=65536, fft_workers=-1, precision='standard'):
+        self.block_size = block_size
+        self.fft_workers = fft_workers
+        self.precision = precision
+        self.dtype = np.dtype(PRECISIONS[precision])
+
+    @instrumented('stream_render', bytes_in='input_path', bytes_out='output_path')
+    def render(self, input_path, output_path, tempo_factor, bass_boost, quality="Standard", progress=None,
+               output_format=None):
+        """Stream input_path through the processing chain into output_path.
+
+        output_format is a key of OUTPUT_FORMATS, by default WAV at the
+        renderer's precision. progress, if given, is called with the
+        fraction of input read.
+        """
+        try:
+            output_format = output_format or DEFAULT_OUTPUT_FORMATS[self.precision]
+            with open_audio(input_path) as source:
+                sample_rate = source.samplerate
+                channels = source.channels
+
+                # Phase-vocoder qualities take small bass boosts as a spectral
+                # gain, as in change_tempo_and_boost_bass
+                stages = []
+                bass_filter = BassBoostFilter(sample_rate, bass_boost, dtype=self.dtype) if bass_boost > 0 else None
+                fused = fuses_tempo_and_bass(tempo_factor, bass_boost, quality)
+                if tempo_factor != 1.0:
+                    stages.append(self._tempo_stage(channels, tempo_factor, quality, bass_filter if fused else None))
+                peaks = None
+                if bass_filter is not None:
+                    if not fused:
+                        stages.append(bass_filter)
+                    peaks = PeakTracker()
+                    stages.append(peaks)
+
+                if peaks is None:
+                    # Nothing needs the global peak, write straight through
+                    with AudioEncoder.for_format(output_path, sample_rate, channels, output_format) as sink:
+                        self._run(source, stages, sink, progress)
+                    return output_path
+
+                # First pass into an unclipped float file, then apply the gain
+                fd, temp_path = tempfile.mkstemp(suffix='.wav', dir=os.path.dirname(os.path.abspath(output_path)))
+                os.close(fd)
+                try:
+                    subtype = 'DOUBLE' if self.dtype == np.float64 else 'FLOAT'
+                    with AudioEncoder(temp_path, sample_rate, channels, 'WAV', subtype) as sink:
+                        self._run(source, stages, sink, progress)
+                    self._apply_gain(temp_path, output_path, peaks.gain(), output_format)
+                finally:
+                    os.unlink(temp_path)
+                return output_path
+
+        except Exception as e:
+            raise Exception(f"Failed to render audio stream: {str(e)}")
+
+    def _tempo_stage(self, channels, tempo_factor, quality, bass_filter=None):
+        """Streaming counterpart of the quality option's time-stretch engine.
+
+        A phase-vocoder stage applies bass_filter's response as a spectral gain.
+        """
+        engine_class, options = QUALITY_ENGINES[quality]
+        if engine_class is VinylResampler:
+            return StreamingResampler(channels, tempo_factor, dtype=self.dtype)
+        if engine_class is WSOLA:
+            return StreamingWSOLA(channels, tempo_factor, workers=self.fft_workers, dtype=self.dtype, **options)
+        if engine_class is PhaseVocoder:
+            n_fft = options.get('n_fft', 2048)
+            spectral_gain = bass_filter.frequency_response(n_fft) if bass_filter is not None else None
+            return StreamingTimeStretcher(channels, tempo_factor, workers=self.fft_workers,
+                                          spectral_gain=spectral_gain, dtype=self.dtype, **options)
+        raise ValueError(f"No streaming stage for quality '{quality}'")
+
+    def _run(self, source, stages, sink, progress=None):
+        """Pull blocks from source through every stage into sink"""
+        frames_read = 0
+        for block in source.blocks(blocksize=self.block_size, dtype='float32', always_2d=True):
+            self._write(sink, self._push(stages, block.T))
+            frames_read += block.shape[0]
+            if progress is not None and source.frames > 0:
+                progress(min(frames_read / source.frames, 1.0))
+        self._write(sink, self._flush(stages))
+
+    def _push(self, stages, block):
+        for stage in stages:
+            block = stage.process(block)
+        return block
+
+    def _flush(self, stages):
+        """Drain stateful stages, feeding each tail through the later stages"""
+        tail = None
+        for i, stage in enumerate(stages):
+            if isinstance(stage, (StreamingTimeStretcher, StreamingWSOLA, StreamingResampler)):
+                flushed = stage.flush()
+                tail = flushed if tail is None else np.concatenate([tail, flushed], axis=-1)
+            elif tail is not None:
+                tail = stage.process(tail)
+        return tail
+
+    def _write(self, sink, block):
+        if block is not None and block.shape[-1]:
+            sink.write(block)
+
+    def _apply_gain(self, temp_path, output_path, gain, output_format):
+        """Second pass: scale the float render into the final output file"""
+        with sf.SoundFile(temp_path) as source:
+            with AudioEncoder.for_format(output_path, source.samplerate, source.channels, output_format) as sink:
+                for block in source.blocks(blocksize=self.block_size, dtype='float64', always_2d=True):
+                    sink.write((block * gain).T)
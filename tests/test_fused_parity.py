@@ -0,0 +1,30 @@
+"""Fused tempo + bass against the sequential chain (benchmark.py --fused)"""
+
+import pytest
+
+from audio_processor import FUSED_MAX_BOOST_DB, QUALITIES, fuses_tempo_and_bass
+from benchmark import FUSED_TOLERANCE_DB, benchmark_fused
+from stage_graph import render_plan
+
+# Fixed so the check is repeatable: parity failed at 5 s with 15 dB before the
+# fused path was limited to FUSED_MAX_BOOST_DB
+PARITY_DURATION = 5.0
+PARITY_RATES = (0.5, 0.8, 1.25, 2.0)
+PARITY_BOOSTS = (1.0, 2.0, FUSED_MAX_BOOST_DB)
+
+
+def test_fused_parity_within_tolerance():
+    rows = benchmark_fused(duration=PARITY_DURATION, rates=PARITY_RATES, boosts=PARITY_BOOSTS)
+    failed = [(row['material'], row['rate'], row['bass_boost'], round(row['band_error_db'], 2))
+              for row in rows if not row['passed']]
+    assert not failed, f"band level off by more than {FUSED_TOLERANCE_DB} dB: {failed}"
+
+
+@pytest.mark.parametrize('quality', QUALITIES)
+@pytest.mark.parametrize('bass_boost', (0, FUSED_MAX_BOOST_DB, FUSED_MAX_BOOST_DB + 0.5, 15))
+def test_render_plan_fuses_only_within_limit(quality, bass_boost):
+    target, _ = render_plan(0.8, bass_boost, quality)
+    fused = 0 < bass_boost <= FUSED_MAX_BOOST_DB and quality in ("Standard", "High")
+    assert fuses_tempo_and_bass(0.8, bass_boost, quality) == fused
+    assert target == ('tempo_bass' if fused else 'bass')
+    assert not fuses_tempo_and_bass(1.0, bass_boost, quality)
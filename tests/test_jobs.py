@@ -0,0 +1,78 @@
+"""JobManager finishing jobs only after their last progress report and metrics record"""
+
+import time
+
+import pytest
+
+import jobs
+from jobs import DONE, RENDER_STAGES, JobManager
+
+PLAN = [('decode', 'wav', 1.0), ('tempo', 'Standard', 1.0), ('save', 'wav16', 1.0)]
+
+
+class RecordingCostModel:
+    """Cost model stand-in that keeps what observe_render learned"""
+
+    def __init__(self):
+        self.observed = []
+
+    def observe_render(self, plan, stage_seconds):
+        self.observed.append(stage_seconds)
+
+    def save(self):
+        pass
+
+
+def _reporting_job(job_id, traced):
+    """Report every stage and return at once, leaving the reports queued behind the result"""
+    import metrics
+    import startup
+    from audio_processor import AudioProcessor
+
+    # Warm-up operations on another thread would overlap the sampled one
+    startup.wait_warm_up()
+    for stage, _, _ in PLAN:
+        jobs._report(job_id, stage, 0.0)
+    if traced:
+        metrics.set_memory_sampling(1)
+        with metrics.labelled(job_id=job_id):
+            processor = AudioProcessor()
+            processor.normalize_audio(processor.dtype.type(0.5) * 2)
+    return 'result'
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = JobManager(max_workers=1, jobs_dir=str(tmp_path), cost_model=RecordingCostModel(), prestart=False)
+    yield manager
+    manager.shutdown()
+
+
+def _wait(manager, job_id, observations=None):
+    """Status of the job once done and, if given, once the cost model has that many observations"""
+    deadline = time.time() + 60
+    while manager.status(job_id)['state'] != DONE or len(manager.cost_model.observed) < (observations or 0):
+        assert time.time() < deadline
+        time.sleep(0.01)
+    return manager.status(job_id)
+
+
+@pytest.mark.parametrize('repeat', range(3))
+def test_stage_timings_include_every_report(manager, repeat):
+    job_id = manager._submit(f'job{repeat}', 'render', RENDER_STAGES, _reporting_job, False,
+                             estimate={'seconds': 1.0, 'stages': PLAN})
+    assert _wait(manager, job_id, observations=1)['result'] == 'result'
+    assert [list(observed) for observed in manager.cost_model.observed] == [['decode', 'tempo', 'save']]
+
+
+def test_traced_render_is_not_observed(manager):
+    job_id = manager._submit('traced', 'render', RENDER_STAGES, _reporting_job, True,
+                             estimate={'seconds': 1.0, 'stages': PLAN})
+    status = _wait(manager, job_id)
+    assert [record['peak_bytes'] is not None for record in status['operations']] == [True]
+
+    # A later untraced job on the same worker is the first one observed
+    job_id = manager._submit('untraced', 'render', RENDER_STAGES, _reporting_job, False,
+                             estimate={'seconds': 1.0, 'stages': PLAN})
+    _wait(manager, job_id, observations=1)
+    assert len(manager.cost_model.observed) == 1
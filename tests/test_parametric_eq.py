@@ -0,0 +1,38 @@
+"""ParametricEQ's FFT path for long inputs against its SOS path"""
+
+import numpy as np
+
+import audio_processor
+from audio_processor import AudioProcessor, ParametricEQ
+from benchmark import make_test_signal
+
+BASS_BANDS = [(60, 0.7, 0.3 * (10 ** (6 / 20) - 1)), (120, 0.7, 0.3 * (10 ** (6 / 20) - 1))]
+
+
+def test_long_input_takes_fft_path_and_matches_sos_in_interior():
+    audio = make_test_signal(3.0)
+    eq = ParametricEQ(44100, BASS_BANDS, fft_threshold=audio.shape[-1] - 1)
+    fft_output = eq.apply(audio)
+    assert eq.method == 'fft'
+
+    sos_output = ParametricEQ(44100, BASS_BANDS, fft_threshold=audio.shape[-1]).apply(audio)
+    interior = slice(audio.shape[-1] // 4, 3 * audio.shape[-1] // 4)
+    assert np.abs(fft_output[:, interior] - sos_output[:, interior]).max() < 1e-4
+
+
+def test_high_quality_bass_boost_uses_the_threshold(monkeypatch):
+    methods = []
+    apply = ParametricEQ.apply
+
+    def recording_apply(self, audio_data):
+        output = apply(self, audio_data)
+        methods.append(self.method)
+        return output
+
+    monkeypatch.setattr(ParametricEQ, 'apply', recording_apply)
+    audio = make_test_signal(2.0)
+    processor = AudioProcessor()
+    processor.apply_high_quality_bass_boost(audio, 44100, 6)
+    monkeypatch.setattr(audio_processor, 'EQ_FFT_THRESHOLD', audio.shape[-1] // 2)
+    processor.apply_high_quality_bass_boost(audio, 44100, 6)
+    assert methods == ['sos', 'fft']
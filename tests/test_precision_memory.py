@@ -0,0 +1,13 @@
+"""float32 processing halves the render chain's peak RSS (benchmark.py --memory)"""
+
+from benchmark import PRECISION_MEMORY_RATIO, benchmark_memory
+
+# Long enough that the track, not the interpreter, dominates the peak
+PRECISION_MEMORY_DURATION = 120.0
+
+
+def test_standard_precision_halves_peak_rss():
+    # benchmark_memory runs each precision in its own spawned process
+    peaks = {row['precision']: row['peak_rss_bytes'] for row in benchmark_memory(duration=PRECISION_MEMORY_DURATION)}
+    assert peaks['standard'] <= PRECISION_MEMORY_RATIO * peaks['mastering'], {
+        precision: round(peak / 1e6, 1) for precision, peak in peaks.items()}
@@ -0,0 +1,13 @@
+"""Streamed renders keep peak memory independent of the track length (benchmark.py --memory)"""
+
+from benchmark import STREAM_MEMORY_SLACK_BYTES, benchmark_stream_memory
+
+# Short enough for a test run; the extra 90 s of stereo float32 input is 32 MB,
+# so a render that held the track would grow past the slack
+STREAM_MEMORY_DURATIONS = (30.0, 120.0)
+
+
+def test_stream_memory_does_not_scale_with_duration():
+    rows, flat = benchmark_stream_memory(durations=STREAM_MEMORY_DURATIONS)
+    peaks = {row['duration']: round(row['peak_rss_bytes'] / 1e6, 1) for row in rows}
+    assert flat, f"peak RSS (MB) grew by more than {STREAM_MEMORY_SLACK_BYTES / 1024**2:.0f} MB with duration: {peaks}"
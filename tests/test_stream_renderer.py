@@ -0,0 +1,41 @@
+"""StreamRenderer against the whole-array chain at mastering precision"""
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from audio_processor import QUALITIES, AudioProcessor
+from benchmark import make_test_signal
+from stream_renderer import StreamRenderer
+
+# Largest difference allowed, in 24-bit LSBs; a float32 stream is about 10-30 off
+MASTERING_TOLERANCE_LSB = 4
+
+
+@pytest.fixture(scope='module')
+def input_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp('stream') / 'input.wav'
+    sf.write(path, make_test_signal(2.0).T, 44100, subtype='PCM_24')
+    return str(path)
+
+
+@pytest.mark.parametrize('quality', QUALITIES)
+@pytest.mark.parametrize('bass_boost', (0, 2, 6))
+def test_mastering_stream_matches_whole_array(input_path, tmp_path, quality, bass_boost):
+    processor = AudioProcessor(precision='mastering')
+    audio, sample_rate = processor.load_audio(input_path)
+    if bass_boost > 0:
+        expected = processor.change_tempo_and_boost_bass(audio, sample_rate, 0.8, bass_boost, quality)
+    else:
+        expected = processor.change_tempo(audio, 0.8, quality)
+    processor.save_audio(expected, sample_rate, str(tmp_path / 'expected.wav'))
+
+    # Small blocks, so every stage carries state across many calls
+    StreamRenderer(block_size=8192, precision='mastering').render(
+        input_path, str(tmp_path / 'streamed.wav'), 0.8, bass_boost, quality)
+
+    expected, _ = sf.read(tmp_path / 'expected.wav')
+    streamed, _ = sf.read(tmp_path / 'streamed.wav')
+    assert sf.info(tmp_path / 'streamed.wav').subtype == 'PCM_24'
+    assert streamed.shape == expected.shape
+    assert np.abs(streamed - expected).max() <= MASTERING_TOLERANCE_LSB * 2**-23
@@ -0,0 +1,83 @@
+"""VideoDownloader against a local HTTP server serving a media file"""
+
+import functools
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from render_cache import DownloadCache
+from video_downloader import InfoCache, VideoDownloader
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    """Serves the test directory and records every request"""
+
+    def __init__(self, *args, requests, **kwargs):
+        self.requests = requests
+        super().__init__(*args, **kwargs)
+
+    def send_head(self):
+        self.requests.append((self.command, self.path))
+        return super().send_head()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def media_server(tmp_path):
+    """(URL of a one-second OGG tone, list of requests the server received)"""
+    served = tmp_path / 'served'
+    served.mkdir()
+    tone = 0.3 * np.sin(2 * np.pi * 440 * np.arange(44100) / 44100)
+    sf.write(served / 'tone.ogg', np.stack([tone, tone]).T, 44100, format='OGG', subtype='VORBIS')
+
+    requests = []
+    handler = functools.partial(CountingHandler, directory=str(served), requests=requests)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/tone.ogg', requests
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_download_with_cached_info_makes_one_request(media_server, tmp_path):
+    url, requests = media_server
+    downloader = VideoDownloader(info_cache=InfoCache())
+    downloader.get_video_info(url)
+    assert requests
+
+    requests.clear()
+    path = downloader.download_audio(url, str(tmp_path / 'out'))
+    assert requests == [('GET', '/tone.ogg')]
+    # The path comes from yt-dlp's result, in the site's own container
+    assert os.path.dirname(path) == str(tmp_path / 'out')
+    assert sf.info(path).frames == 44100
+
+
+def test_cached_download_makes_no_request(media_server, tmp_path):
+    url, requests = media_server
+    downloader = VideoDownloader(info_cache=InfoCache(), download_cache=DownloadCache(str(tmp_path / 'cache')))
+    first = downloader.download_audio(url, str(tmp_path / 'first'))
+
+    requests.clear()
+    second = downloader.download_audio(url, str(tmp_path / 'second'))
+    assert requests == []
+    assert os.path.samefile(first, second)
+
+
+def test_ingest_expands_each_normalized_url_once(media_server, tmp_path):
+    url, requests = media_server
+    spellings = [url, url + '?utm_source=feed', url + '?fbclid=abc']
+    results = list(VideoDownloader(info_cache=InfoCache()).ingest(spellings, str(tmp_path / 'out')))
+
+    assert [(result['status'], result['inputs']) for result in results] == [('done', spellings)]
+    # One extraction and one download
+    assert len(requests) == 2
@@ -1,4 +1,5 @@
 import os
+import hashlib
 from pathlib import Path
 
 def get_file_size(uploaded_file):
@@ -16,6 +17,18 @@ def get_file_size(uploaded_file):
     
     return f"{size_bytes:.1f} {size_names[i]}"
 
+def content_digest(data):
+    """SHA-256 hex digest identifying a file by its contents"""
+    return hashlib.sha256(data).hexdigest()
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """SHA-256 hex digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def format_duration(seconds):
     """Format duration in seconds to MM:SS format"""
     if seconds is None:
@@ -61,23 +74,14 @@ def get_processing_recommendations(tempo_factor, bass_boost):
     
     return recommendations
 
-def estimate_processing_time(file_size_mb, tempo_factor, bass_boost, quality):
-    """Estimate processing time based on parameters"""
-    base_time = file_size_mb * 0.5  # Base processing time per MB
-    
-    # Tempo change adds processing time
-    if tempo_factor != 1.0:
-        base_time *= 1.5
-    
-    # Bass boost adds minimal time
-    if bass_boost > 0:
-        base_time *= 1.1
-    
-    # Quality setting affects time
-    if quality == "High":
-        base_time *= 1.5
+def estimate_processing_time(info, tempo_factor, bass_boost, quality, output_format='wav16'):
+    """Estimate processing time in seconds for a file probed with estimator.probe_audio.
+
+    Uses this host's cost model, which learns from finished renders.
+    """
+    from estimator import CostModel
     
-    return max(base_time, 2.0)  # Minimum 2 seconds
+    return CostModel.load().estimate(info, tempo_factor, bass_boost, quality, output_format)['seconds']
 
 def create_audio_visualization_data(audio_data, sample_rate, max_points=1000):
     """Create data for audio waveform visualization"""
@@ -1,17 +1,178 @@
-import yt_dlp
 import tempfile
 import os
 import re
+import copy
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit
 import io
 
+from metrics import instrumented
+
+# Extracted info is reused for this long; the format URLs in it stay valid for hours
+INFO_TTL_SECONDS = 600
+
+# Most extracted info dicts kept per process
+INFO_CACHE_ENTRIES = 64
+
+# Query parameters that only track where a link was shared
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'igshid', 'ref', 'ref_src', 'pp'}
+
+# Downloads running at once in one ingest() call
+INGEST_WORKERS = 8
+
+# Politeness per site during ingestion: requests at once, and seconds between their starts
+HOST_CONNECTIONS = 2
+HOST_INTERVAL_SECONDS = 0.5
+
+# Hosts that are the same site for politeness limits
+SITE_ALIASES = {'youtu.be': 'youtube.com', 'music.youtube.com': 'youtube.com'}
+
+
+def url_host(url):
+    """Lower-case host of a URL without www. or m."""
+    host = urlsplit(url.strip()).netloc.lower()
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return host
+
+
+def normalize_url(url):
+    """Cache key of a video URL: scheme, www./m. and tracking parameters don't matter"""
+    parts = urlsplit(url.strip())
+    host = url_host(url)
+    
+    # YouTube's short, embed and shorts links name the same video as watch?v=
+    if host == 'youtu.be':
+        return f"youtube:{parts.path.strip('/').split('/')[0]}"
+    if host in ('youtube.com', 'music.youtube.com'):
+        video_id = parse_qs(parts.query).get('v')
+        if video_id:
+            return f"youtube:{video_id[0]}"
+        match = re.match(r'/(?:shorts|embed|live)/([\w-]+)', parts.path)
+        if match:
+            return f"youtube:{match.group(1)}"
+    
+    params = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                    if name not in TRACKING_PARAMS and not name.startswith('utm_'))
+    return f"{host}{parts.path.rstrip('/') or '/'}" + (f"?{urlencode(params)}" if params else '')
+
+
+def video_key(info):
+    """'<extractor>:<video ID>' of an info dict, or None when the ID doesn't identify the video"""
+    # Generic IDs are only file names, which different sites share
+    if info.get('id') and info.get('extractor_key') not in (None, 'Generic'):
+        return f"{info['extractor_key'].lower()}:{info['id']}"
+    return None
+
+
+def download_key(url, info):
+    """What a download of url is shared under on the host: its video key, else the normalized page URL"""
+    return video_key(info) or normalize_url(info.get('webpage_url') or url)
+
+
+class InfoCache:
+    """yt-dlp info dicts by normalized URL and video ID, each kept for ttl seconds"""
+
+    def __init__(self, ttl=INFO_TTL_SECONDS, max_entries=INFO_CACHE_ENTRIES, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        # key -> (expiry time, info), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def keys_for(url, info=None):
+        """The URL's key, plus the video page's and the extractor's video ID once info is known"""
+        keys = [normalize_url(url)]
+        if info is not None:
+            if info.get('webpage_url'):
+                keys.append(normalize_url(info['webpage_url']))
+            if video_key(info) is not None:
+                keys.append(video_key(info))
+        return list(dict.fromkeys(keys))
+    
+    def get(self, url):
+        """Info extracted from url (or another URL of the same video) if still fresh, else None"""
+        key = normalize_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+    
+    def put(self, url, info):
+        expiry = self.clock() + self.ttl
+        with self._lock:
+            for key in self.keys_for(url, info):
+                self._entries[key] = (expiry, info)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def discard(self, url):
+        """Forget url's info under every key it was stored with"""
+        with self._lock:
+            entry = self._entries.pop(normalize_url(url), None)
+            if entry is not None:
+                for key in [key for key, (_, info) in self._entries.items() if info is entry[1]]:
+                    del self._entries[key]
+
+
+class HostLimiter:
+    """Politeness limits per site: at most per_host requests at once, started interval seconds apart"""
+
+    def __init__(self, per_host=HOST_CONNECTIONS, interval=HOST_INTERVAL_SECONDS, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.per_host = per_host
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self._semaphores = {}
+        # site -> earliest start of its next request
+        self._next_start = {}
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def limit(self, url):
+        """Context for one request to url's site, entered once the site's limits allow it"""
+        site = url_host(url)
+        site = SITE_ALIASES.get(site, site)
+        with self._lock:
+            semaphore = self._semaphores.setdefault(site, threading.Semaphore(self.per_host))
+        with semaphore:
+            with self._lock:
+                start = max(self.clock(), self._next_start.get(site, 0.0))
+                self._next_start[site] = start + self.interval
+            delay = start - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+            yield
+
+
+# Shared by every VideoDownloader in this process
+_info_cache = InfoCache()
+
 
 class VideoDownloader:
-    def __init__(self):
+    def __init__(self, info_cache=None, download_cache=None):
         self.supported_sites = [
             'youtube.com', 'youtu.be', 'soundcloud.com', 'vimeo.com',
             'dailymotion.com', 'facebook.com', 'instagram.com', 'tiktok.com'
         ]
+        # Info from get_video_info, reused by download_audio instead of extracting again
+        self.info_cache = info_cache if info_cache is not None else _info_cache
+        # Optional render_cache.DownloadCache sharing downloaded files across the host
+        self.download_cache = download_cache
     
     def is_valid_url(self, url):
         """Check if the URL is valid and from a supported site"""
@@ -37,78 +198,260 @@ class VideoDownloader:
         
         return True  # Allow other sites but warn user
     
-    def get_video_info(self, url):
-        """Get basic information about the video without downloading"""
-        try:
+    def extract_info(self, url):
+        """yt-dlp's info dict for url, without downloading; cached for INFO_TTL_SECONDS.
+
+        The dict is sanitized the way yt-dlp writes --write-info-json, so it
+        pickles and can be handed to download_audio in another process.
+        Treat it as read-only: it is shared with later callers.
+        """
+        import yt_dlp
+        
+        info = self.info_cache.get(url)
+        if info is None:
             ydl_opts = {
                 'quiet': True,
                 'no_warnings': True,
                 'extract_flat': False,
             }
-            
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False), remove_private_keys=True)
+            self.info_cache.put(url, info)
+        return info
+    
+    def cached_info(self, url):
+        """Info extracted from url within INFO_TTL_SECONDS, or None"""
+        return self.info_cache.get(url)
+    
+    @instrumented('expand_playlist')
+    def expand_playlist(self, url):
+        """URLs of the videos of a playlist or channel URL, or [url] for a single video.
+
+        Playlist entries are listed without extracting each video (yt-dlp's
+        --flat-playlist); a single video's info is extracted and cached.
+        """
+        import yt_dlp
+        
+        if self.info_cache.get(url) is not None:
+            return [url]
+        try:
+            ydl_opts = {
+                'quiet': True,
+                'no_warnings': True,
+                'extract_flat': 'in_playlist',
+            }
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 info = ydl.extract_info(url, download=False)
-                
-                return {
-                    'title': info.get('title', 'Unknown Title'),
-                    'duration': info.get('duration', 0),
-                    'uploader': info.get('uploader', 'Unknown'),
-                    'thumbnail': info.get('thumbnail', ''),
-                    'description': info.get('description', ''),
-                    'view_count': info.get('view_count', 0),
-                    'webpage_url': info.get('webpage_url', url)
-                }
+                if info.get('_type') in ('playlist', 'multi_video'):
+                    return [entry.get('webpage_url') or entry['url'] for entry in info.get('entries') or []
+                            if entry and (entry.get('webpage_url') or entry.get('url'))]
+                self.info_cache.put(url, ydl.sanitize_info(info, remove_private_keys=True))
+            return [url]
+        except Exception as e:
+            raise Exception(f"Failed to expand playlist: {str(e)}")
+    
+    def ingest(self, urls, output_dir=None, max_workers=INGEST_WORKERS, host_limiter=None, submit_render=None):
+        """Download every video of urls, expanding playlists, on a pool of max_workers threads.
+
+        Yields one result dict per video (or per URL that failed to expand)
+        as soon as it finishes: url, status ('done' or 'failed'), path or
+        error, seconds, and inputs, the entries of urls it came from. Each
+        video is downloaded into its own numbered directory under
+        output_dir, and repeated videos only once; inputs that normalize to
+        the same URL are expanded once.
+        host_limiter (by default a new HostLimiter) spaces out the requests
+        to each site.
+
+        submit_render(path) is called with every downloaded file as it
+        finishes, e.g. to queue it with JobManager.submit_render_file; what
+        it returns (the job ID) is the result's 'render_job', or what it
+        raised the result's 'render_error'.
+        """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        
+        if output_dir is None:
+            output_dir = tempfile.mkdtemp()
+        host_limiter = host_limiter or HostLimiter()
+        
+        def expand(url):
+            with host_limiter.limit(url):
+                return self.expand_playlist(url)
+        
+        # Normalized URL -> the inputs that spell it, e.g. youtu.be and watch?v= links
+        inputs = {}
+        for url in urls:
+            inputs.setdefault(normalize_url(url), []).append(url)
+        
+        seen = set()
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        try:
+            # future -> (is a playlist expansion, url, inputs it came from)
+            pending = {executor.submit(expand, spellings[0]): (True, spellings[0], spellings)
+                       for spellings in inputs.values()}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    expanding, url, spellings = pending.pop(future)
+                    if not expanding:
+                        yield dict(future.result(), inputs=spellings)
+                        continue
+                    try:
+                        video_urls = future.result()
+                    except Exception as e:
+                        yield {'url': url, 'status': 'failed', 'error': str(e), 'seconds': 0.0, 'inputs': spellings}
+                        continue
+                    for video_url in video_urls:
+                        if normalize_url(video_url) in seen:
+                            continue
+                        seen.add(normalize_url(video_url))
+                        item_dir = os.path.join(output_dir, str(len(seen)))
+                        pending[executor.submit(self._ingest_one, video_url, item_dir, host_limiter,
+                                                submit_render)] = (False, video_url, spellings)
+        finally:
+            # Also when the caller stops early: queued downloads never start
+            executor.shutdown(wait=True, cancel_futures=True)
+    
+    def _ingest_one(self, url, output_dir, host_limiter, submit_render):
+        """Download one video of ingest() and queue its render; the result dict"""
+        result = {'url': url}
+        start = time.perf_counter()
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            with host_limiter.limit(url):
+                result['path'] = self.download_audio(url, output_dir)
+            result['status'] = 'done'
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['seconds'] = time.perf_counter() - start
+        
+        if submit_render is not None and result['status'] == 'done':
+            try:
+                result['render_job'] = submit_render(result['path'])
+            except Exception as e:
+                # The download itself succeeded, e.g. the job queue is full
+                result['render_error'] = str(e)
+        return result
+    
+    @instrumented('get_video_info')
+    def get_video_info(self, url):
+        """Get basic information about the video without downloading"""
+        try:
+            info = self.extract_info(url)
+            
+            return {
+                'title': info.get('title', 'Unknown Title'),
+                'duration': info.get('duration', 0),
+                'uploader': info.get('uploader', 'Unknown'),
+                'thumbnail': info.get('thumbnail', ''),
+                'description': info.get('description', ''),
+                'view_count': info.get('view_count', 0),
+                'webpage_url': info.get('webpage_url', url)
+            }
         except Exception as e:
             raise Exception(f"Failed to get video info: {str(e)}")
     
-    def download_audio(self, url, output_dir=None):
-        """Download audio from video URL and return the file path"""
+    def _download_options(self, output_dir, progress_hook=None, audio_format=None):
+        """yt-dlp options for downloading the best audio into output_dir.
+
+        The stream is kept in its own container (usually m4a or webm, a
+        tenth of the size of WAV), which load_audio decodes directly;
+        audio_format (e.g. 'wav') transcodes it with ffmpeg instead.
+        """
+        ydl_opts = {
+            'format': 'bestaudio/best',
+            'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
+            'quiet': True,
+            'no_warnings': True,
+        }
+        if audio_format is not None:
+            ydl_opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': audio_format,
+                'preferredquality': '0',  # Best quality
+            }]
+        
+        # Report download progress (yt-dlp progress dicts) to the caller
+        if progress_hook is not None:
+            ydl_opts['progress_hooks'] = [progress_hook]
+        return ydl_opts
+    
+    @staticmethod
+    def _downloaded_path(result):
+        """Final file of a finished download, as yt-dlp recorded it after post-processing"""
+        downloads = result.get('requested_downloads') or []
+        if downloads and downloads[-1].get('filepath') and os.path.exists(downloads[-1]['filepath']):
+            return downloads[-1]['filepath']
+        raise Exception("Downloaded audio file not found")
+    
+    def _download(self, url, output_dir, progress_hook=None, info=None, audio_format=None):
+        """Download url's audio into output_dir with yt-dlp and return the file path"""
+        import yt_dlp
+        
+        with yt_dlp.YoutubeDL(self._download_options(output_dir, progress_hook, audio_format)) as ydl:
+            if info is None:
+                result = ydl.extract_info(url, download=True)
+            else:
+                try:
+                    # Formats are already known: select and download without extracting
+                    result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+                except yt_dlp.utils.DownloadError:
+                    # Format URLs may have expired; extract once more, as yt-dlp's --load-info-json does
+                    self.info_cache.discard(url)
+                    result = ydl.extract_info(url, download=True)
+        
+        return self._downloaded_path(result)
+    
+    @instrumented('download_audio')
+    def download_audio(self, url, output_dir=None, progress_hook=None, info=None, wait_hook=None,
+                       audio_format=None):
+        """Download audio from video URL and return the file path.
+
+        The file is the site's own audio stream, e.g. .m4a or .webm, unless
+        audio_format asks for a transcode (see _download_options).
+
+        info is the url's extract_info() dict, e.g. passed along from the
+        process that called get_video_info; without it the cache is checked
+        before extracting again.
+
+        With a download_cache, a video already downloaded on this host is
+        linked into output_dir instead, and concurrent calls for the same
+        video wait for one download. wait_hook() is called while waiting
+        for it or for a free download slot.
+        """
+        import yt_dlp
+        
         try:
             # Create temporary directory if none provided
             if output_dir is None:
                 output_dir = tempfile.mkdtemp()
             
-            # Configure yt-dlp options for audio extraction
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
-                'extractaudio': True,
-                'audioformat': 'wav',  # Use WAV for better compatibility with librosa
-                'audioquality': '0',  # Best quality
-                'quiet': True,
-                'no_warnings': True,
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'wav',
-                    'preferredquality': '192',
-                }],
-            }
+            if info is None:
+                info = self.info_cache.get(url)
+            if self.download_cache is None:
+                return self._download(url, output_dir, progress_hook, info, audio_format)
             
-            # Download the audio
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                
-                # Find the downloaded file
-                title = info.get('title', 'audio')
-                # Clean filename for filesystem compatibility
-                safe_title = re.sub(r'[<>:"/\\|?*]', '_', title)
-                
-                # Look for the downloaded file
-                for ext in ['.wav', '.mp3', '.m4a', '.webm']:
-                    potential_file = os.path.join(output_dir, f"{safe_title}{ext}")
-                    if os.path.exists(potential_file):
-                        return potential_file
-                
-                # If exact match not found, look for any audio file in the directory
-                for file in os.listdir(output_dir):
-                    if file.endswith(('.wav', '.mp3', '.m4a', '.webm', '.ogg')):
-                        return os.path.join(output_dir, file)
+            # The cache key needs the video ID, so extract before downloading
+            if info is None:
+                info = self.extract_info(url)
+            key = self.download_cache.make_key(download_key(url, info), audio_format)
+            with self.download_cache.single_flight(key, wait_hook):
+                # yt-dlp creates output_dir itself, but a cache hit links into it first
+                os.makedirs(output_dir, exist_ok=True)
+                name = yt_dlp.utils.sanitize_filename(info.get('title') or 'audio')
+                cached_path = self.download_cache.fetch(key, os.path.join(output_dir, name))
+                if cached_path is not None:
+                    return cached_path
                 
-                raise Exception("Downloaded audio file not found")
+                with self.download_cache.download_slot(wait_hook):
+                    audio_file_path = self._download(url, output_dir, progress_hook, info, audio_format)
+                self.download_cache.put_file(key, audio_file_path)
+                return audio_file_path
                 
         except Exception as e:
             raise Exception(f"Failed to download audio: {str(e)}")
     
+    @instrumented('download_audio_to_buffer')
     def download_audio_to_buffer(self, url):
         """Download audio directly to memory buffer"""
         try:
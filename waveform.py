@@ -0,0 +1,176 @@
+"""Min/max/RMS peak pyramids for drawing waveforms at any zoom.
+
+One pass over the decoded audio, a chunk at a time, takes the min, max
+and RMS of every ``PEAK_BLOCK``-sample block per channel. Each coarser
+level merges ``PEAK_FACTOR`` blocks of the level below, until one block
+covers the whole track. Min and max are stored as int16, rounded outwards
+so peaks are never understated, and RMS as float32: all levels together
+take about 1/100 of the size of the float32 PCM.
+
+A view of any span picks the coarsest level that still has at least the
+requested number of points and merges fewer than ``PEAK_FACTOR`` blocks
+per point. Drawing costs O(points) whatever the track length or zoom,
+and never reads the samples again.
+"""
+
+import numpy as np
+
+# Samples per block at the finest level
+PEAK_BLOCK = 256
+
+# Blocks of one level merged into one block of the next
+PEAK_FACTOR = 4
+
+# int16 full scale for stored min/max
+PEAK_SCALE = 32767
+
+# Blocks per chunk of the building pass
+PEAK_CHUNK_BLOCKS = 4096
+
+
+class PeakPyramid:
+    """Per-channel min/max/RMS of a track at block sizes PEAK_BLOCK * PEAK_FACTOR**level"""
+
+    def __init__(self, levels, sample_rate, n_samples, block=PEAK_BLOCK, factor=PEAK_FACTOR):
+        # levels[i] is (min int16, max int16, rms float32), each (channels, blocks)
+        self.levels = levels
+        self.sample_rate = sample_rate
+        self.n_samples = n_samples
+        self.block = block
+        self.factor = factor
+
+    @property
+    def channels(self):
+        return self.levels[0][0].shape[0]
+
+    @property
+    def duration(self):
+        """Length of the track in seconds"""
+        return self.n_samples / self.sample_rate
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for level in self.levels for array in level)
+
+    def block_size(self, level):
+        """Samples per block at a level"""
+        return self.block * self.factor ** level
+
+    def _counts(self, level, first, last):
+        """Samples in blocks first..last-1 of a level; only the track's last block is short"""
+        size = self.block_size(level)
+        return np.minimum(size, self.n_samples - np.arange(first, last, dtype=np.int64) * size)
+
+    @classmethod
+    def from_audio(cls, audio_data, sample_rate, block=PEAK_BLOCK, factor=PEAK_FACTOR):
+        """Build the pyramid of (channels, samples) or (samples,) audio in one streaming pass"""
+        audio_data = np.atleast_2d(audio_data)
+        channels, n_samples = audio_data.shape
+        n_blocks = max(-(-n_samples // block), 1)
+        mins = np.zeros((channels, n_blocks), dtype=np.float32)
+        maxs = np.zeros((channels, n_blocks), dtype=np.float32)
+        energy = np.zeros((channels, n_blocks), dtype=np.float64)
+
+        # Chunks keep the temporaries small and read a memory-mapped track once
+        chunk_samples = block * PEAK_CHUNK_BLOCKS
+        for start in range(0, n_samples, chunk_samples):
+            chunk = np.asarray(audio_data[:, start:start + chunk_samples], dtype=np.float32)
+            first = start // block
+            count = -(-chunk.shape[1] // block)
+            # Pad the track's last block with its final sample, which leaves
+            # min/max unchanged; the padding's energy is taken off again
+            padding = count * block - chunk.shape[1]
+            if padding:
+                chunk = np.pad(chunk, ((0, 0), (0, padding)), mode='edge')
+            frames = chunk.reshape(channels, count, block)
+            frames.min(axis=-1, out=mins[:, first:first + count])
+            frames.max(axis=-1, out=maxs[:, first:first + count])
+            np.square(frames).sum(axis=-1, dtype=np.float64, out=energy[:, first:first + count])
+            if padding:
+                energy[:, first + count - 1] -= padding * np.square(chunk[:, -1], dtype=np.float64)
+
+        counts = np.minimum(block, n_samples - np.arange(n_blocks, dtype=np.int64) * block)
+        levels = []
+        while True:
+            rms = np.sqrt(energy / np.maximum(counts, 1)).astype(np.float32)
+            levels.append((
+                np.clip(np.floor(mins * PEAK_SCALE), -PEAK_SCALE, PEAK_SCALE).astype(np.int16),
+                np.clip(np.ceil(maxs * PEAK_SCALE), -PEAK_SCALE, PEAK_SCALE).astype(np.int16),
+                rms,
+            ))
+            if mins.shape[1] <= 1:
+                break
+            # Next level: merge every factor blocks, the last group may be short
+            starts = np.arange(0, mins.shape[1], factor)
+            mins = np.minimum.reduceat(mins, starts, axis=1)
+            maxs = np.maximum.reduceat(maxs, starts, axis=1)
+            energy = np.add.reduceat(energy, starts, axis=1)
+            counts = np.add.reduceat(counts, starts)
+
+        return cls(levels, sample_rate, n_samples, block, factor)
+
+    def view(self, start_seconds=0.0, end_seconds=None, points=1000):
+        """Min/max/RMS envelope of a span in at most `points` buckets per channel.
+
+        Returns a dict of 'time' (bucket start, seconds) and 'min', 'max'
+        and 'rms' float32 arrays shaped (channels, buckets). Zoomed in past
+        the finest level, there are fewer buckets than points.
+        """
+        # A span starting at or past the end shows the track's last sample
+        start = min(max(int(start_seconds * self.sample_rate), 0), max(self.n_samples - 1, 0))
+        end = self.n_samples if end_seconds is None else min(int(np.ceil(end_seconds * self.sample_rate)), self.n_samples)
+        end = max(end, start + 1)
+        points = max(int(points), 1)
+
+        # Coarsest level that still has at least `points` blocks in the span
+        level = 0
+        while level + 1 < len(self.levels) and (end - start) / self.block_size(level + 1) >= points:
+            level += 1
+        size = self.block_size(level)
+        first = start // size
+        last = min(-(-end // size), self.levels[level][0].shape[1])
+        mins, maxs, rms = (array[:, first:last] for array in self.levels[level])
+
+        # Fewer than factor * points + 2 blocks here, merged into <= points buckets
+        group = -(-(last - first) // points)
+        starts = np.arange(0, last - first, group)
+        counts = self._counts(level, first, last)
+        energy = np.add.reduceat(np.square(rms, dtype=np.float64) * counts, starts, axis=1)
+        return {
+            'time': ((first + starts) * size / self.sample_rate),
+            'min': np.minimum.reduceat(mins, starts, axis=1).astype(np.float32) / PEAK_SCALE,
+            'max': np.maximum.reduceat(maxs, starts, axis=1).astype(np.float32) / PEAK_SCALE,
+            'rms': np.sqrt(energy / np.maximum(np.add.reduceat(counts, starts), 1)).astype(np.float32),
+        }
+
+    def to_arrays(self):
+        """Flat dict of arrays for np.savez"""
+        arrays = {'meta': np.array([self.sample_rate, self.n_samples, self.block, self.factor], dtype=np.int64)}
+        for i, (mins, maxs, rms) in enumerate(self.levels):
+            arrays[f'min{i}'] = mins
+            arrays[f'max{i}'] = maxs
+            arrays[f'rms{i}'] = rms
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Inverse of to_arrays"""
+        sample_rate, n_samples, block, factor = (int(value) for value in arrays['meta'])
+        levels = []
+        while f'min{len(levels)}' in arrays:
+            i = len(levels)
+            levels.append((arrays[f'min{i}'], arrays[f'max{i}'], arrays[f'rms{i}']))
+        return cls(levels, sample_rate, n_samples, block, factor)
+
+
+def cached_peak_pyramid(decode_cache, digest, audio_data, sample_rate):
+    """Peak pyramid of the decoded track with this digest, built and stored on a cache miss"""
+    if decode_cache is not None:
+        arrays = decode_cache.load_peaks(digest)
+        if arrays is not None:
+            return PeakPyramid.from_arrays(arrays)
+
+    pyramid = PeakPyramid.from_audio(audio_data, sample_rate)
+    if decode_cache is not None:
+        decode_cache.store_peaks(digest, pyramid.to_arrays())
+    return pyramid